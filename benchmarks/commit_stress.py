@@ -0,0 +1,105 @@
+"""Stress test of concurrent quiz completions
+
+Fires thousands of simultaneous `n|` callbacks from users standing on
+the last question and verifies that every result is persisted and
+survives reopening of the results store.
+
+    python -m benchmarks.commit_stress --users 5000 --backend journal
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from benchmarks.fake_api import FakeBotAPI, callback_update
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--backend", default="journal",
+                        choices=["journal", "sqlite", "json"])
+    return parser.parse_args()
+
+
+def reopen_results(config, backend: str) -> dict:
+    """Read persisted results with a fresh store instance
+    """
+    from src.bot import utils
+    from src.bot.results import JournalResultsStore, JsonResultsStore, \
+        SQLiteResultsStore
+
+    if backend == "journal":
+        store = JournalResultsStore(config.logs_path / "results",
+                                    scorer=utils.correct_questions)
+    elif backend == "sqlite":
+        store = SQLiteResultsStore(config.logs_path / "results.sqlite3",
+                                   scorer=utils.correct_questions)
+    else:
+        store = JsonResultsStore(config.logs_path / "results.json",
+                                 scorer=utils.correct_questions)
+    results = store.as_dict()
+    store.close()
+    return results
+
+
+async def run(users: int, backend: str) -> bool:
+    api = FakeBotAPI()
+    await api.start()
+
+    logs_path = tempfile.mkdtemp(prefix="quiz_stress_")
+    with open(os.path.join(logs_path, "results.json"), "w") as file:
+        file.write('{"results": {}, "total": {}}')
+    os.environ.update(API_SERVER=api.base_url, LOGS_PATH=logs_path,
+                      RESULTS_BACKEND=backend,
+                      # fake API has no flood limits
+                      SEND_RATE_LIMIT="false")
+    os.environ.setdefault("BOT_TOKEN", "123456:stress")
+
+    from aiogram import Bot, Dispatcher, types
+    from src.bot import handlers, utils  # noqa: F401 registers handlers
+    from src.bot.dependencies import banks, bot, config, dp
+
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+
+    user_ids = range(1, users + 1)
+    for user_id in user_ids:
+        await dp.storage.set_state(chat=user_id, user=user_id,
+                                   state=banks.current.state_of(10))
+        await dp.storage.set_data(chat=user_id, user=user_id,
+                                  data={"q_10": "2",
+                                        "bank": banks.current.version})
+    updates = [types.Update(**callback_update(user_id, user_id, "n|"))
+               for user_id in user_ids]
+
+    start = time.perf_counter()
+    outcomes = await asyncio.gather(
+        *(dp.process_update(update) for update in updates),
+        return_exceptions=True
+    )
+    elapsed = time.perf_counter() - start
+    await utils.async_results(config).close()
+
+    persisted = reopen_results(config, backend)["total"]
+    lost = [user_id for user_id in user_ids
+            if persisted.get(str(user_id)) != 1]
+    print(f"backend={backend} users={users} "
+          f"elapsed={elapsed:.2f}s rate={users / elapsed:.0f} completions/s")
+    errors = [outcome for outcome in outcomes
+              if isinstance(outcome, Exception)]
+    print(f"persisted={len(persisted)} lost={len(lost)} "
+          f"handler_errors={len(errors)} "
+          f"api_calls={dict(api.calls)}")
+
+    await (await bot.get_session()).close()
+    await api.stop()
+    return not lost
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    ok = asyncio.get_event_loop().run_until_complete(
+        run(args.users, args.backend))
+    raise SystemExit(0 if ok else 1)
@@ -0,0 +1,116 @@
+"""Message edits sent for rapid answer taps
+
+Virtual users pass the quiz tapping answers every `--interval`
+seconds. Taps are dispatched without waiting for the previous one,
+like updates of one polling batch, `n|` is sent once the taps are
+handled (the edit may still be waiting).
+Runs once for every edit delay, reports edits sent per tap and
+checks that persisted answers match the taps.
+
+    python -m benchmarks.edit_coalescing --users 100 --delays 0 0.3
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.fake_api import FakeBotAPI
+from benchmarks.load_test import random_session
+
+
+async def run(args: argparse.Namespace) -> bool:
+    api = FakeBotAPI()
+    await api.start()
+    logs_path = tempfile.mkdtemp(prefix="quiz_edits_")
+    os.environ.update(API_SERVER=api.base_url, LOGS_PATH=logs_path,
+                      SEND_RATE_LIMIT="false")
+    os.environ.setdefault("BOT_TOKEN", "123456:edits")
+
+    from aiogram import Bot, Dispatcher, types
+    from src.bot import handlers, metrics, utils  # noqa: F401
+    from src.bot.dependencies import banks, config, dp, edits
+    from src.bot.quiz import decode_indexes
+
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    bank = banks.current
+    answer_counts = {index: len(bank.questions[index].answers)
+                     for index in bank.quizzes["main"].pool}
+    rng = random.Random(args.seed)
+    update_ids = itertools.count(1)
+    ok = True
+    for delay in args.delays:
+        edits.delay = delay
+        sessions = {user_id: random_session(user_id, update_ids, rng,
+                                            answer_counts)
+                    for user_id in range(1, args.users + 1)}
+
+        async def play(updates) -> None:
+            taps = []
+            for raw_update in updates:
+                update = types.Update(**raw_update)
+                data = update.callback_query.data \
+                    if update.callback_query else ""
+                if data.startswith("a|"):
+                    taps.append(asyncio.ensure_future(
+                        dp.updates_handler.notify(update)))
+                    await asyncio.sleep(args.interval)
+                else:
+                    await asyncio.gather(*taps)
+                    taps.clear()
+                    await dp.updates_handler.notify(update)
+
+        api.calls.clear()
+        coalesced = metrics.MESSAGE_EDITS.value("coalesced")
+        start = time.perf_counter()
+        await asyncio.gather(*(play(updates)
+                               for updates, _ in sessions.values()))
+        await edits.close()
+        elapsed = time.perf_counter() - start
+        edits._closing = False
+
+        # n| returns after the result is written; concurrent taps may
+        # be handled in another order, so only the sets are compared
+        results = utils.async_results(config)
+        mismatched = 0
+        for user_id, (_updates, expected) in sessions.items():
+            stored = await results.get(str(user_id)) or {}
+            mismatched += stored.get("bank") != bank.version or any(
+                set(decode_indexes(stored.get(index, ""))) != set(selected)
+                for index, selected in expected.items())
+        taps = sum(update.get("callback_query", {}).get("data", "")
+                   .startswith("a|")
+                   for updates, _ in sessions.values() for update in updates)
+        sent = api.calls["editmessagetext"]
+        coalesced = metrics.MESSAGE_EDITS.value("coalesced") - coalesced
+        print(f"delay={delay}s taps={taps} edits={sent} "
+              f"({sent / taps:.2f} per tap) coalesced={coalesced:.0f} "
+              f"keyboard_removals={api.calls['editmessagereplymarkup']} "
+              f"elapsed={elapsed:.2f}s mismatched={mismatched}")
+        ok = ok and mismatched == 0
+
+    await utils.async_results(config).close()
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    await (await dp.bot.get_session()).close()
+    await api.stop()
+    return ok
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--interval", type=float, default=0.1,
+                        help="seconds between taps of a user")
+    parser.add_argument("--delays", type=float, nargs="+",
+                        default=[0, 0.3], help="edit delays to compare")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    ok = asyncio.get_event_loop().run_until_complete(run(parse_args()))
+    raise SystemExit(0 if ok else 1)
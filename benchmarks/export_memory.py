@@ -0,0 +1,106 @@
+"""Memory of streaming export with growing number of attempts
+
+Writes random attempts of the whole quiz into files of every results
+backend, then exports them into CSV with difficulty report and
+measures peak of python allocations. Journal and SQLite are read
+line by line and should stay flat, legacy json file is loaded whole.
+
+    python -m benchmarks.export_memory --attempts 20000 80000
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import List
+
+os.environ.setdefault("BOT_TOKEN", "123456:export")
+
+from src.bot.dependencies import banks  # noqa: E402
+from src.bot.export import CsvWriter, DifficultyReport, export  # noqa: E402
+from src.bot.quiz import encode_indexes  # noqa: E402
+from src.bot.results import Attempt, JournalResultsStore, \
+    SQLiteResultsStore, read_history  # noqa: E402
+from src.config import Config  # noqa: E402
+
+
+def random_attempts(count: int, rng: random.Random) -> List[tuple]:
+    bank = banks.current
+    quiz = bank.default_quiz
+    started = time.time() - count
+    attempts = []
+    for number in range(count):
+        answers = {"bank": bank.version}
+        for index in quiz.pool:
+            size = len(bank.questions[index].answers)
+            answers[index] = encode_indexes(
+                rng.sample(range(size), rng.randint(1, size)))
+        attempt = Attempt(
+            user_id=str(rng.randrange(count)), quiz=quiz.name,
+            score=len(bank.correct_questions(answers)),
+            questions=quiz.length, finished_at=started + number,
+            name=f"user {number}")
+        attempts.append((attempt, answers))
+    return attempts
+
+
+def write_files(logs_path: Path, attempts: List[tuple]) -> None:
+    """Files of every backend as the bot leaves them
+    """
+    directory = logs_path / "results"
+    directory.mkdir()
+    with open(directory / JournalResultsStore.ATTEMPTS_NAME, "w",
+              encoding="utf-8") as file:
+        for seq, (attempt, answers) in enumerate(attempts, start=1):
+            file.write(json.dumps(dict(seq=seq, **attempt._asdict(),
+                                       answers=answers),
+                                  ensure_ascii=False) + "\n")
+
+    with open(logs_path / "results.json", "w", encoding="utf-8") as file:
+        json.dump(dict(results={}, total={},
+                       attempts=[list(attempt) + [answers]
+                                 for attempt, answers in attempts]),
+                  file, ensure_ascii=False)
+
+    store = SQLiteResultsStore(logs_path / "results.sqlite3", scorer=list)
+    connection = store._connection()
+    connection.execute("BEGIN")
+    for attempt, answers in attempts:
+        store._write_attempt(connection, attempt, answers)
+    connection.execute("COMMIT")
+    store.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--attempts", type=int, nargs="+",
+                        default=[20000, 80000])
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    for count in args.attempts:
+        logs_path = Path(tempfile.mkdtemp(prefix="quiz_export_"))
+        write_files(logs_path, random_attempts(count, rng))
+        for backend in ("journal", "sqlite", "json"):
+            config = Config(bot_token=os.environ["BOT_TOKEN"],
+                            logs_path=logs_path, results_backend=backend)
+            output = logs_path / f"{backend}.csv"
+            tracemalloc.start()
+            start = time.perf_counter()
+            writer = CsvWriter(output)
+            exported, rows = export(read_history(config), banks, writer,
+                                    DifficultyReport(banks))
+            writer.close()
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{backend}: {exported} attempts, {rows} rows "
+                  f"in {elapsed:.2f}s, peak {peak / 2 ** 20:.2f} MiB, "
+                  f"csv {output.stat().st_size / 2 ** 20:.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+"""Local stub of Telegram Bot API for offline benchmarks
+
+Point the bot to it with API_SERVER=http://127.0.0.1:<port>
+"""
+import asyncio
+import itertools
+import json
+import math
+import time
+from collections import Counter
+from typing import Dict, Iterator, Optional
+
+from aiohttp import web
+
+from src.bot.scheduler import TokenBucket, is_limited
+
+USER = dict(id=1, is_bot=True, first_name="quiz_bot", username="quiz_bot")
+
+
+class FakeBotAPI:
+    """Answers Bot API methods used by the quiz with plausible objects
+    and counts calls per method.
+
+    It can also play virtual users for bots using getUpdates: each
+    user sends the next update of their script only after the bot
+    replied to the previous one (sent or edited message in their chat).
+    """
+    # methods that finish bot reaction to user action
+    REPLY_METHODS = ("sendmessage", "editmessagetext")
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 flood_limits: Optional["FloodLimits"] = None):
+        self.host = host
+        self.port = port
+        self.flood_limits = flood_limits
+        self.calls = Counter()
+        self.uploads = Counter()  # uploaded files per method
+        self.uploaded_bytes = 0
+        self.file_ids = set()  # ids issued by this server
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+
+        self.updates: Optional[asyncio.Queue] = None
+        self.users_done: Optional[asyncio.Event] = None
+        self._scripts: Dict[int, Iterator[dict]] = {}
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port, backlog=4096)
+        await site.start()
+        # resolve port if it was chosen by OS
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if self.flood_limits is not None:
+            retry_after = self.flood_limits.check(method,
+                                                  params.get("chat_id"))
+            if retry_after:
+                self.calls["429"] += 1
+                return self.error(429, f"Too Many Requests: retry after "
+                                       f"{retry_after}",
+                                  dict(retry_after=retry_after))
+        response = self.respond(method, params)
+        if asyncio.iscoroutine(response):
+            response = await response
+        if method in self.REPLY_METHODS and self._scripts:
+            self._release(int(params.get("chat_id", 0)))
+        return response
+
+    def add_users(self, scripts: Dict[int, list]) -> None:
+        """Start virtual users, {user_id: [update, ...]}
+        """
+        if self.updates is None:
+            self.updates = asyncio.Queue()
+            self.users_done = asyncio.Event()
+        self.users_done.clear()
+        for user_id, updates in scripts.items():
+            self._scripts[user_id] = iter(updates)
+            self._release(user_id)
+
+    def _release(self, user_id: int) -> None:
+        script = self._scripts.get(user_id)
+        if script is None:
+            return
+        update = next(script, None)
+        if update is not None:
+            self.updates.put_nowait(update)
+            return
+        del self._scripts[user_id]
+        if not self._scripts:
+            self.users_done.set()
+
+    def respond(self, method: str, params: dict) -> web.Response:
+        handler = getattr(self, f"on_{method}", None)
+        if handler is None:
+            return self.ok(True)
+        return handler(params)
+
+    @staticmethod
+    def ok(result) -> web.Response:
+        return web.json_response(dict(ok=True, result=result))
+
+    @staticmethod
+    def error(status: int, description: str,
+              parameters: Optional[dict] = None) -> web.Response:
+        body = dict(ok=False, error_code=status, description=description)
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=status)
+
+    def message(self, params: dict, **extra) -> dict:
+        chat_id = int(params.get("chat_id", 0))
+        message = dict(message_id=next(self._message_ids),
+                       date=int(time.time()),
+                       chat=dict(id=chat_id, type="private"),
+                       **extra)
+        if "text" in params:
+            message["text"] = str(params["text"])
+        if "reply_markup" in params:
+            message["reply_markup"] = json.loads(params["reply_markup"])
+        return message
+
+    def on_getme(self, params: dict) -> web.Response:
+        return self.ok(USER)
+
+    def on_getwebhookinfo(self, params: dict) -> web.Response:
+        return self.ok(dict(url="", has_custom_certificate=False,
+                            pending_update_count=0))
+
+    def on_sendmessage(self, params: dict) -> web.Response:
+        return self.ok(self.message(params))
+
+    def on_editmessagetext(self, params: dict) -> web.Response:
+        return self.ok(self.message(params))
+
+    def on_editmessagereplymarkup(self, params: dict) -> web.Response:
+        return self.ok(self.message(params))
+
+    def _file_id(self, method: str, value) -> Optional[str]:
+        """Issue id for uploaded file or check the one sent by client
+        """
+        if isinstance(value, web.FileField):
+            self.uploads[method] += 1
+            self.uploaded_bytes += len(value.file.read())
+            file_id = f"{method}-{next(self._message_ids)}"
+            self.file_ids.add(file_id)
+            return file_id
+        return value if value in self.file_ids else None
+
+    def on_sendphoto(self, params: dict) -> web.Response:
+        file_id = self._file_id("sendphoto", params.get("photo"))
+        if file_id is None:
+            return self.error(400, "Bad Request: wrong file identifier/"
+                                   "HTTP URL specified")
+        photo = [dict(file_id=file_id, file_unique_id=file_id,
+                      width=800, height=600)]
+        return self.ok(self.message(params, photo=photo))
+
+    def on_senddocument(self, params: dict) -> web.Response:
+        file_id = self._file_id("senddocument", params.get("document"))
+        if file_id is None:
+            return self.error(400, "Bad Request: wrong file identifier/"
+                                   "HTTP URL specified")
+        document = dict(file_id=file_id, file_unique_id=file_id)
+        return self.ok(self.message(params, document=document))
+
+    async def on_getupdates(self, params: dict) -> web.Response:
+        timeout = float(params.get("timeout", 0))
+        if self.updates is None:
+            await asyncio.sleep(min(timeout, 0.1))
+            return self.ok([])
+        try:
+            updates = [await asyncio.wait_for(self.updates.get(), timeout)]
+        except asyncio.TimeoutError:
+            return self.ok([])
+        limit = int(params.get("limit", 100))
+        while len(updates) < limit and not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return self.ok(updates)
+
+
+class FloodLimits:
+    """Telegram-like flood control: token buckets for the whole bot and
+    for every chat. Requests over limit get 429 with retry_after
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1,
+                 chat_burst: float = 5):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, capacity=global_rate)
+        self._chats: Dict[str, TokenBucket] = {}
+
+    def check(self, method: str, chat_id) -> int:
+        """0 if request is allowed, otherwise seconds to wait
+        """
+        if not is_limited(method):
+            return 0
+        now = time.monotonic()
+        chat = self._chats.get(str(chat_id))
+        if chat is None:
+            chat = self._chats[str(chat_id)] = TokenBucket(
+                self.chat_rate, capacity=self.chat_burst)
+        if not chat.try_take(now):
+            return math.ceil((1 - chat.tokens) / chat.rate)
+        if not self._global.try_take(now):
+            chat.refund()
+            return math.ceil((1 - self._global.tokens) / self._global.rate)
+        return 0
+
+
+def callback_update(update_id: int, user_id: int, data: str,
+                    message_id: int = 1) -> dict:
+    """Raw update with callback query pressed by user in private chat
+    on keyboard of message `message_id`
+    """
+    user = dict(id=user_id, is_bot=False, first_name=f"user{user_id}")
+    message = dict(message_id=message_id, date=int(time.time()),
+                   chat=dict(id=user_id, type="private"), text="quiz")
+    return dict(update_id=update_id,
+                callback_query=dict(id=str(update_id), chat_instance="0",
+                                    data=data, message=message,
+                                    **{"from": user}))
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    """Raw update with text message sent by user in private chat
+    """
+    user = dict(id=user_id, is_bot=False, first_name=f"user{user_id}")
+    entities = [dict(type="bot_command", offset=0, length=len(text))] \
+        if text.startswith("/") else []
+    message = dict(message_id=update_id, date=int(time.time()),
+                   chat=dict(id=user_id, type="private"), text=text,
+                   entities=entities, **{"from": user})
+    return dict(update_id=update_id, message=message)
+
+
+def quiz_session(user_id: int, update_ids, answers_per_question: int = 1,
+                 questions_count: int = 10, quiz: str = "main") -> list:
+    """Raw updates of a user passing the whole quiz:
+    /quiz, choice of `quiz` in menu, then `a|<i>` taps and `n|`
+    for every question. Taps are on the message of their question,
+    its id is that of the update that asked it
+    """
+    menu = next(update_ids)
+    message = next(update_ids)
+    updates = [message_update(menu, user_id, "/quiz"),
+               callback_update(message, user_id, f"quiz|{quiz}", menu)]
+    for _ in range(questions_count):
+        for answer_index in range(answers_per_question):
+            updates.append(callback_update(next(update_ids), user_id,
+                                           f"a|{answer_index}", message))
+        next_id = next(update_ids)
+        updates.append(callback_update(next_id, user_id, "n|", message))
+        message = next_id
+    return updates
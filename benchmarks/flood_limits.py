@@ -0,0 +1,102 @@
+"""Outbound scheduler against fake Bot API that enforces flood limits
+
+Every quiz chat gets a new message followed by several edits (like
+a quiz step), while a broadcast goes to other chats at low priority.
+Requests are made all at once, first by a plain bot, then through
+SendScheduler.
+
+    python -m benchmarks.flood_limits --chats 60 --edits 3 --broadcast 60
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from typing import Dict, List
+
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.utils import exceptions
+
+from benchmarks.fake_api import FakeBotAPI, FloodLimits
+from src.bot.scheduler import ScheduledBot, SendScheduler
+
+BROADCAST_CHATS = 10 ** 6
+
+
+async def timed(latencies: List[float], failures: Dict[str, int],
+                kind: str, call) -> None:
+    start = time.perf_counter()
+    try:
+        await call
+    except exceptions.RetryAfter:
+        failures[kind] += 1
+        return
+    latencies.append(time.perf_counter() - start)
+
+
+async def quiz_step(bot: ScheduledBot, chat_id: int, edits: int,
+                    latencies: List[float], failures: Dict[str, int]) -> None:
+    start = time.perf_counter()
+    try:
+        message = await bot.send_message(chat_id, "Вопрос")
+    except exceptions.RetryAfter:
+        failures["interactive"] += 1
+        return
+    latencies.append(time.perf_counter() - start)
+    for index in range(edits):
+        await timed(latencies, failures, "interactive",
+                    bot.edit_message_text(f"Вопрос {index}", chat_id,
+                                          message.message_id))
+
+
+async def run(scheduled: bool, chats: int, edits: int,
+              broadcast: int) -> None:
+    limits = FloodLimits(global_rate=30, chat_rate=1, chat_burst=5)
+    api = FakeBotAPI(flood_limits=limits)
+    await api.start()
+    broadcast_chats = range(BROADCAST_CHATS, BROADCAST_CHATS + broadcast)
+    scheduler = SendScheduler(global_rate=30, chat_rate=1, chat_burst=5,
+                              bulk_chats=tuple(broadcast_chats)) \
+        if scheduled else None
+    bot = ScheduledBot(token="123456:flood", scheduler=scheduler,
+                       server=TelegramAPIServer.from_base(api.base_url))
+
+    interactive: List[float] = []
+    bulk: List[float] = []
+    failures = dict(interactive=0, bulk=0)
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(quiz_step(bot, chat_id, edits, interactive, failures)
+          for chat_id in range(1, chats + 1)),
+        *(timed(bulk, failures, "bulk",
+                bot.send_message(chat_id, "Новая викторина"))
+          for chat_id in broadcast_chats)
+    )
+    elapsed = time.perf_counter() - start
+
+    def p50(values: List[float]) -> str:
+        return f"{statistics.median(values):.2f}s" if values else "-"
+
+    print(f"{'scheduled' if scheduled else 'plain':>9}: "
+          f"elapsed={elapsed:.2f}s sent={len(interactive) + len(bulk)} "
+          f"failed={sum(failures.values())} 429s={api.calls['429']} "
+          f"p50 interactive={p50(interactive)} bulk={p50(bulk)}")
+    if scheduler is not None:
+        print(f"           {scheduler.metrics.as_dict()}")
+
+    await (await bot.get_session()).close()
+    await api.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chats", type=int, default=60)
+    parser.add_argument("--edits", type=int, default=3)
+    parser.add_argument("--broadcast", type=int, default=60)
+    args = parser.parse_args()
+    for scheduled in (False, True):
+        asyncio.get_event_loop().run_until_complete(
+            run(scheduled, args.chats, args.edits, args.broadcast))
+
+
+if __name__ == "__main__":
+    main()
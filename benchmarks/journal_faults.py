@@ -0,0 +1,84 @@
+"""Check of journal results store when compaction can not truncate
+the journal
+
+Commits results while truncating the journal fails, then checks that
+no commit fails, a fresh store reads every result, and the next
+compaction truncates the journal once it can.
+
+    python -m benchmarks.journal_faults --users 35 --compact-every 10
+"""
+import argparse
+import builtins
+import logging
+import tempfile
+from pathlib import Path
+from typing import List
+
+from src.bot import results
+from src.bot.results import JournalResultsStore
+
+
+def scorer(answers: dict) -> List[str]:
+    return [index for index, answer in answers.items() if answer == "0"]
+
+
+def failing_truncation(journal_path: Path):
+    def open_file(file, mode="r", *args, **kwargs):
+        if isinstance(file, (str, Path)) and Path(file) == journal_path \
+                and "w" in mode:
+            raise OSError("injected failure of journal truncation")
+        return builtins.open(file, mode, *args, **kwargs)
+    return open_file
+
+
+def journal_lines(store: JournalResultsStore) -> int:
+    with open(store.journal_path, encoding="utf-8") as file:
+        return sum(1 for _ in file)
+
+
+def reopened(directory: Path) -> dict:
+    store = JournalResultsStore(directory, scorer=scorer)
+    try:
+        return store.as_dict()
+    finally:
+        store.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=35)
+    parser.add_argument("--compact-every", type=int, default=10)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    directory = Path(tempfile.mkdtemp(prefix="quiz_journal_"))
+    store = JournalResultsStore(directory, scorer=scorer,
+                                compact_every=args.compact_every)
+    failing = args.users - args.compact_every
+    results.open = failing_truncation(store.journal_path)
+    try:
+        for user in range(failing):
+            store.add(str(user), {"q_1": str(user % 2)})
+    finally:
+        del results.open
+    kept = journal_lines(store)
+    during_failure = reopened(directory) == store.as_dict()
+
+    for user in range(failing, args.users):
+        store.add(str(user), {"q_1": str(user % 2)})
+    truncated = journal_lines(store)
+    expected = store.as_dict()
+    store.close()
+    after_restart = reopened(directory) == expected
+
+    print(f"journal kept {kept} records while truncation failed, "
+          f"{truncated} after truncation; results read by a fresh store: "
+          f"during failure {during_failure}, after {after_restart}")
+    ok = kept == failing and truncated < args.compact_every \
+        and during_failure and after_restart \
+        and len(expected["results"]) == args.users
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Leaderboard queries with hundreds of thousands of attempts
+
+Fills the in-memory leaderboard (journal backend) and the SQLite
+backend with random attempts of many users in several quizzes, then
+times top 10 and rank of a user against sorting all latest totals
+on every request.
+
+    python -m benchmarks.leaderboard --attempts 300000 --users 100000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from src.bot.results import Attempt, Leaderboard, SQLiteResultsStore
+
+QUIZZES = {"main": 10, "random": 5, "theory_5": 4}
+
+
+def random_attempts(count: int, users: int,
+                    rng: random.Random) -> List[Attempt]:
+    attempts = []
+    started = time.time() - count
+    for number in range(count):
+        quiz = rng.choice(list(QUIZZES))
+        attempts.append(Attempt(
+            user_id=str(rng.randrange(users)), quiz=quiz,
+            score=rng.randint(0, QUIZZES[quiz]), questions=QUIZZES[quiz],
+            finished_at=started + number, name=f"user {number}"))
+    return attempts
+
+
+def per_call(function: Callable, arguments: list) -> float:
+    """Microseconds per call
+    """
+    start = time.perf_counter()
+    for argument in arguments:
+        function(*argument)
+    return (time.perf_counter() - start) / len(arguments) * 1e6
+
+
+def sorted_totals(totals: Dict[str, int], user_id: str) -> tuple:
+    """What a leaderboard costs without index: sort on every request
+    """
+    ordered = sorted(totals.items(), key=lambda item: -item[1])
+    scores = [score for _user, score in ordered]
+    return ordered[:10], scores.index(totals[user_id]) + 1
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--attempts", type=int, default=300000)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    attempts = random_attempts(args.attempts, args.users, rng)
+    queries = [(attempt.user_id, attempt.quiz)
+               for attempt in rng.sample(attempts, args.queries)]
+    top_queries = [(quiz, 10) for _user_id, quiz in queries]
+
+    totals = {}
+    for attempt in attempts:
+        if attempt.quiz == "main":
+            totals[attempt.user_id] = attempt.score
+    main_users = [(totals, user_id) for user_id, quiz in queries
+                  if quiz == "main"]
+    print(f"sort latest totals ({len(totals)} users): "
+          f"{per_call(sorted_totals, main_users):.0f} us per request")
+
+    leaderboard = Leaderboard()
+    start = time.perf_counter()
+    for attempt in attempts:
+        leaderboard.add(attempt)
+    added = (time.perf_counter() - start) / len(attempts) * 1e6
+    print(f"memory: add {added:.2f} us, "
+          f"top 10 {per_call(leaderboard.top, top_queries):.1f} us, "
+          f"rank {per_call(leaderboard.standing, queries):.1f} us")
+
+    path = Path(tempfile.mkdtemp(prefix="quiz_leaderboard_"))
+    store = SQLiteResultsStore(path / "results.sqlite3", scorer=list)
+    connection = store._connection()
+    start = time.perf_counter()
+    connection.execute("BEGIN")
+    for attempt in attempts:
+        store._write_attempt(connection, attempt)
+    connection.execute("COMMIT")
+    added = (time.perf_counter() - start) / len(attempts) * 1e6
+    size = os.path.getsize(path / "results.sqlite3") / 2 ** 20
+    print(f"sqlite: add {added:.2f} us, "
+          f"top 10 {per_call(store.leaderboard, top_queries):.1f} us, "
+          f"rank {per_call(store.standing, queries):.1f} us, "
+          f"file {size:.1f} MiB")
+
+    # both indexes must agree
+    for user_id, quiz in queries[:100]:
+        memory, sqlite = leaderboard.standing(user_id, quiz), \
+            store.standing(user_id, quiz)
+        assert (memory.rank, memory.participants, memory.best.score) == \
+            (sqlite.rank, sqlite.participants, sqlite.best.score)
+        assert [attempt.user_id for attempt in leaderboard.top(quiz, 10)] \
+            == [attempt.user_id for attempt in store.leaderboard(quiz, 10)]
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
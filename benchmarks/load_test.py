@@ -0,0 +1,188 @@
+"""Load test: virtual users pass the quiz through the real dispatcher
+
+Every user sends /quiz, chooses the whole quiz, taps random answers
+(sometimes the same one twice, like a stale keyboard) and `n|` through
+all questions. Updates go to `dp` in process, the bot talks to the local
+fake Bot API, so no network is needed. Reports throughput, handler
+latency percentiles, peak memory and checks that persisted results
+match what users sent.
+
+    python -m benchmarks.load_test --users 2000 --concurrency 100
+    python -m benchmarks.load_test --users 200 --output baseline.json
+
+Exit code is 1 if any result is lost or differs. The fake API runs in
+the same process and shares its CPU, so throughput is a relative
+baseline for comparing changes, not a capacity estimate.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import statistics
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Tuple
+
+from benchmarks.commit_stress import reopen_results
+from benchmarks.fake_api import FakeBotAPI, callback_update, message_update
+
+
+def random_session(user_id: int, update_ids, rng: random.Random,
+                   answer_counts: Dict[str, int]) \
+        -> Tuple[List[dict], Dict[str, List[int]]]:
+    """Updates of a user passing the quiz with random answers and
+    answer indexes the bot should record for every question
+    """
+    menu = next(update_ids)
+    message = next(update_ids)  # of the question, see quiz_session
+    updates = [message_update(menu, user_id, "/quiz"),
+               callback_update(message, user_id, "quiz|main", menu)]
+    expected = {}
+    for question_index, answers_count in answer_counts.items():
+        selected = rng.sample(range(answers_count),
+                              rng.randint(1, answers_count))
+        taps = list(selected)
+        if rng.random() < 0.1:  # repeated tap on outdated keyboard
+            taps.insert(rng.randint(1, len(taps)), selected[0])
+        for answer_index in taps:
+            updates.append(callback_update(next(update_ids), user_id,
+                                           f"a|{answer_index}", message))
+        next_id = next(update_ids)
+        updates.append(callback_update(next_id, user_id, "n|", message))
+        message = next_id
+        expected[question_index] = selected
+    return updates, expected
+
+
+def percentile(ordered: List[float], share: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+async def run(args: argparse.Namespace) -> bool:
+    api = FakeBotAPI()
+    await api.start()
+    logs_path = tempfile.mkdtemp(prefix="quiz_load_")
+    if args.backend == "json":  # legacy store expects existing file
+        with open(os.path.join(logs_path, "results.json"), "w") as file:
+            file.write('{"results": {}, "total": {}}')
+    os.environ.update(API_SERVER=api.base_url, LOGS_PATH=logs_path,
+                      RESULTS_BACKEND=args.backend,
+                      FSM_STORAGE=args.fsm_storage,
+                      # fake API has no flood limits
+                      SEND_RATE_LIMIT="false")
+    os.environ.setdefault("BOT_TOKEN", "123456:load")
+
+    from aiogram import Bot, Dispatcher, types
+    from src.bot import handlers, utils  # noqa: F401 registers handlers
+    from src.bot.bot import on_shutdown
+    from src.bot.dependencies import banks, config, dp
+    from src.bot.quiz import encode_indexes
+
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    bank = banks.current
+    quiz = {index: bank.questions[index]
+            for index in bank.quizzes["main"].pool}
+    rng = random.Random(args.seed)
+    update_ids = itertools.count(1)
+    answer_counts = {index: len(question.answers)
+                     for index, question in quiz.items()}
+    sessions = {user_id: random_session(user_id, update_ids, rng,
+                                        answer_counts)
+                for user_id in range(1, args.users + 1)}
+    total_updates = sum(len(updates) for updates, _ in sessions.values())
+
+    latencies: List[float] = []
+    failures = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def play(updates: List[dict]) -> None:
+        nonlocal failures
+        async with semaphore:
+            for raw_update in updates:
+                update = types.Update(**raw_update)
+                started = time.perf_counter()
+                try:
+                    await dp.updates_handler.notify(update)
+                except Exception:
+                    failures += 1
+                latencies.append(time.perf_counter() - started)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(play(updates)
+                           for updates, _ in sessions.values()))
+    elapsed = time.perf_counter() - start
+    traced_peak = tracemalloc.get_traced_memory()[1] \
+        if args.tracemalloc else None
+    tracemalloc.stop()
+
+    await on_shutdown(dp)
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    await (await dp.bot.get_session()).close()
+    await api.stop()
+
+    # results must match answers users gave
+    stored = reopen_results(config, args.backend)["results"]
+    mismatched = 0
+    for user_id, (_updates, expected) in sessions.items():
+        answers = {"bank": bank.version,
+                   **{index: encode_indexes(selected)
+                      for index, selected in expected.items()}}
+        if stored.get(str(user_id)) != answers:
+            mismatched += 1
+
+    ordered = sorted(latencies)
+    report = dict(
+        users=args.users,
+        updates=total_updates,
+        elapsed=round(elapsed, 3),
+        updates_per_second=round(total_updates / elapsed, 1),
+        latency_p50_ms=round(statistics.median(ordered) * 1000, 3),
+        latency_p99_ms=round(percentile(ordered, 0.99) * 1000, 3),
+        latency_max_ms=round(ordered[-1] * 1000, 3),
+        peak_rss_mib=round(resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        traced_peak_mib=None if traced_peak is None
+        else round(traced_peak / 2 ** 20, 1),
+        handler_errors=failures,
+        results_stored=len(stored),
+        results_mismatched=mismatched,
+        api_calls=dict(api.calls),
+    )
+    for key, value in report.items():
+        print(f"{key}={value}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=4)
+    return failures == 0 and mismatched == 0 \
+        and len(stored) == args.users
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50,
+                        help="users passing the quiz at the same time")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", default="journal",
+                        choices=["journal", "sqlite", "json"])
+    parser.add_argument("--fsm-storage", default="sqlite",
+                        choices=["sqlite", "memory"])
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="also trace python allocations (slower)")
+    parser.add_argument("--output", default="",
+                        help="write report to json file")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    ok = asyncio.get_event_loop().run_until_complete(run(parse_args()))
+    raise SystemExit(0 if ok else 1)
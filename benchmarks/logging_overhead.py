@@ -0,0 +1,126 @@
+"""Time the event loop spends on logging
+
+Logs records from a coroutine through a plain FileHandler (as with
+`logging.basicConfig` before) and through the queue pipeline of
+src.bot.logs, then the same with a slow disk that takes `--slow-ms`
+per write. Reports time per record spent in the logging call and the
+longest stall of a ticker task running alongside.
+
+    python -m benchmarks.logging_overhead --records 20000 --slow-ms 1
+"""
+import argparse
+import asyncio
+import logging
+import logging.handlers
+import os
+import queue
+import tempfile
+import time
+from pathlib import Path
+
+os.environ.setdefault("BOT_TOKEN", "123456:logging")
+
+from src.bot import logs, metrics  # noqa: E402
+from src.config import Config  # noqa: E402
+
+
+class SlowFile:
+    """File that takes `delay` seconds per write, like a busy disk
+    """
+
+    def __init__(self, file, delay: float):
+        self.file = file
+        self.delay = delay
+
+    def write(self, text: str) -> int:
+        time.sleep(self.delay)
+        return self.file.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+async def log_records(logger: logging.Logger, records: int) -> tuple:
+    """Seconds per logging call and longest stall of the loop
+    """
+    longest = 0.0
+    running = True
+
+    async def ticker() -> None:
+        nonlocal longest
+        last = time.perf_counter()
+        while running:
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            longest = max(longest, now - last - 0.001)
+            last = now
+
+    task = asyncio.ensure_future(ticker())
+    await asyncio.sleep(0.01)
+    spent = 0.0
+    for number in range(records):
+        start = time.perf_counter()
+        logger.info(f"User {number} chose quiz main")
+        spent += time.perf_counter() - start
+        if number % 100 == 0:
+            await asyncio.sleep(0)  # let other tasks run, like handlers
+    running = False
+    await task
+    return spent / records, longest
+
+
+def run(name: str, handler: logging.Handler, records: int) -> None:
+    logger = logging.getLogger(f"bench.{name}")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    per_record, longest = asyncio.get_event_loop().run_until_complete(
+        log_records(logger, records))
+    logger.removeHandler(handler)
+    print(f"{name}: {per_record * 1e6:.1f} us per record, "
+          f"longest loop stall {longest * 1000:.1f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--slow-ms", type=float, default=1)
+    args = parser.parse_args()
+
+    logs_path = Path(tempfile.mkdtemp(prefix="quiz_logging_"))
+    config = Config(bot_token=os.environ["BOT_TOKEN"], logs_path=logs_path,
+                    log_format="text", log_max_bytes=2 ** 30)
+    # slow disk stalls direct logging for too long with all records
+    slow_records = min(args.records, int(2 / (args.slow_ms / 1000)))
+    for slow in (False, True):
+        records = slow_records if slow else args.records
+        suffix = f" (slow disk, {records} records)" if slow else ""
+
+        direct = logging.FileHandler(logs_path / "direct.txt")
+        direct.setFormatter(logging.Formatter(logs.TEXT_FORMAT))
+        if slow:
+            direct.stream = SlowFile(direct.stream, args.slow_ms / 1000)
+        run("direct" + suffix, direct, records)
+        direct.close()
+
+        file_handler = logs.create_file_handler(config)
+        if slow:
+            file_handler.stream = SlowFile(file_handler.stream,
+                                           args.slow_ms / 1000)
+        records_queue = queue.Queue(maxsize=config.log_queue_size)
+        listener = logging.handlers.QueueListener(records_queue,
+                                                  file_handler)
+        listener.start()
+        queued = logs.QueueHandler(records_queue)
+        queued.addFilter(logs.ContextFilter())
+        run("queued" + suffix, queued, records)
+        start = time.perf_counter()
+        listener.stop()
+        dropped = metrics.LOG_RECORDS_DROPPED.value("queue_full")
+        print(f"  writer finished {time.perf_counter() - start:.2f}s later, "
+              f"{dropped:.0f} records dropped so far")
+        file_handler.close()
+
+
+if __name__ == '__main__':
+    main()
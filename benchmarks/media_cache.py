@@ -0,0 +1,87 @@
+"""Check of media file id cache against local fake Bot API
+
+Sends every theory pdf and the question image several times, then
+restarts the bot only (a fresh cache loaded from disk against the same
+API, saved ids must be reused without uploads), then restarts fake API
+too (all issued ids become unknown), and reports how many uploads
+happened.
+
+    python -m benchmarks.media_cache --repeat 20
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from benchmarks.fake_api import FakeBotAPI
+
+
+async def send_all(media, message, files, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        await asyncio.gather(*(
+            media.answer_photo(message, path) if str(path).endswith(".jpg")
+            else media.answer_document(message, path)
+            for path in files
+        ))
+    return time.perf_counter() - start
+
+
+async def run(repeat: int) -> bool:
+    api = FakeBotAPI()
+    await api.start()
+    logs_path = tempfile.mkdtemp(prefix="quiz_media_")
+    os.environ.update(API_SERVER=api.base_url, LOGS_PATH=logs_path,
+                      # fake API has no flood limits
+                      SEND_RATE_LIMIT="false")
+    os.environ.setdefault("BOT_TOKEN", "123456:media")
+
+    from aiogram import Bot, types
+    from src.bot.dependencies import banks, bot, media
+    from src.bot.media import MediaCache
+
+    Bot.set_current(bot)
+    message = types.Message(message_id=1, chat=dict(id=1, type="private"))
+    files = [theory.file_path for theory in banks.current.theory.values()]
+    files += [question.image_path
+              for question in banks.current.questions.values()
+              if question.image_path is not None]
+
+    elapsed = await send_all(media, message, files, repeat)
+    first_uploads = sum(api.uploads.values())
+    print(f"sends={len(files) * repeat} uploads={first_uploads} "
+          f"uploaded={api.uploaded_bytes / 1024:.0f}KiB "
+          f"elapsed={elapsed:.2f}s")
+
+    # bot restarts, ids saved in file_ids.json are still valid
+    api.uploads.clear()
+    restarted = MediaCache(media.path)
+    elapsed = await send_all(restarted, message, files, repeat)
+    bot_restart_uploads = sum(api.uploads.values())
+    print(f"after bot restart: sends={len(files) * repeat} "
+          f"uploads={bot_restart_uploads} elapsed={elapsed:.2f}s")
+
+    # ids issued by previous server are unknown for the new one
+    await api.stop()  # restarts on the same port
+    api.file_ids.clear()
+    api.uploads.clear()
+    await api.start()
+    reloaded = MediaCache(media.path)
+    elapsed = await send_all(reloaded, message, files, repeat)
+    reuploads = sum(api.uploads.values())
+    print(f"after API restart: sends={len(files) * repeat} "
+          f"uploads={reuploads} elapsed={elapsed:.2f}s")
+
+    await (await bot.get_session()).close()
+    await api.stop()
+    return (first_uploads == len(files) and bot_restart_uploads == 0
+            and reuploads == len(files))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=20)
+    ok = asyncio.get_event_loop().run_until_complete(
+        run(parser.parse_args().repeat))
+    raise SystemExit(0 if ok else 1)
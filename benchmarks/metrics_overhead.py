@@ -0,0 +1,114 @@
+"""Overhead of metrics middleware per update
+
+Replays quiz sessions through the dispatcher (fake Bot API behind it)
+in alternating rounds with and without MetricsMiddleware, and times
+the middleware hooks alone.
+
+    python -m benchmarks.metrics_overhead --users 100 --rounds 3
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import tempfile
+import time
+
+from benchmarks.fake_api import FakeBotAPI, callback_update, quiz_session
+
+
+def toggle(dp, middleware, enabled: bool) -> None:
+    if middleware in dp.middleware.applications:
+        dp.middleware.applications.remove(middleware)
+    if enabled:
+        dp.middleware.applications.append(middleware)
+
+
+async def replay(dp, sessions: list) -> float:
+    from aiogram import types
+
+    async def play(updates: list) -> None:
+        for update in updates:
+            await dp.updates_handler.notify(types.Update(**update))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(play(updates) for updates in sessions))
+    return time.perf_counter() - start
+
+
+async def hooks_cost(dp, repeat: int) -> float:
+    """Seconds per update spent in middleware triggers of a callback
+    """
+    from aiogram import types
+    from aiogram.dispatcher.handler import current_handler
+    from src.bot.handlers import next_question
+
+    current_handler.set(next_question)
+    callback = types.Update(**callback_update(1, 1, "n|")).callback_query
+    start = time.perf_counter()
+    for _ in range(repeat):
+        data = {}
+        await dp.middleware.trigger("pre_process_callback_query",
+                                    (callback, data))
+        await dp.middleware.trigger("process_callback_query",
+                                    (callback, data))
+        await dp.middleware.trigger("post_process_callback_query",
+                                    (callback, [], data))
+    return (time.perf_counter() - start) / repeat
+
+
+async def run(users: int, rounds: int) -> None:
+    api = FakeBotAPI()
+    await api.start()
+    logs_path = tempfile.mkdtemp(prefix="quiz_metrics_")
+    os.environ.update(API_SERVER=api.base_url, LOGS_PATH=logs_path,
+                      # fake API has no flood limits
+                      SEND_RATE_LIMIT="false")
+    os.environ.setdefault("BOT_TOKEN", "123456:metrics")
+
+    from src.bot import handlers, metrics  # noqa: F401 registers handlers
+    from src.bot.bot import on_shutdown
+    from src.bot.dependencies import dp
+    from aiogram import Bot, Dispatcher
+
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    middleware = next(app for app in dp.middleware.applications
+                      if isinstance(app, metrics.MetricsMiddleware))
+    update_ids = itertools.count(1)
+    user_ids = itertools.count(1)
+    per_update = {True: [], False: []}
+    for round_index in range(rounds):
+        # alternate order, so growing stores do not favour one mode
+        for enabled in ((False, True) if round_index % 2 else (True, False)):
+            toggle(dp, middleware, enabled)
+            sessions = [quiz_session(next(user_ids), update_ids)
+                        for _ in range(users)]
+            updates = sum(map(len, sessions))
+            per_update[enabled].append(await replay(dp, sessions) / updates)
+
+    handled = sum(metrics.HANDLER_LATENCY.count(handler) for handler
+                  in ("start_quiz", "add_answer", "next_question"))
+    for enabled in (False, True):
+        toggle(dp, middleware, enabled)
+        cost = await hooks_cost(dp, 100000)
+        best = min(per_update[enabled]) * 1e6
+        print(f"metrics={'on ' if enabled else 'off'} "
+              f"best round={best:.0f}us/update "
+              f"middleware hooks={cost * 1e6:.2f}us/update")
+
+    text = await metrics.registry.render()
+    print(f"handler observations={handled} "
+          f"exposition={len(text.splitlines())} lines")
+    await on_shutdown(dp)
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    await (await dp.bot.get_session()).close()
+    await api.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args.users, args.rounds))
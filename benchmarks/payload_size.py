@@ -0,0 +1,152 @@
+"""Size of session payload and results files: answer texts vs indexes
+
+Builds sessions of users that passed the whole quiz with random
+answers, measures FSM data of a session in both forms, then writes
+results of the same users with answer texts (format of older
+versions) into every results backend, converts them in place with
+the startup migration and compares file sizes. Fails if migration
+changed scores or stats.
+
+    python -m benchmarks.payload_size --users 10000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, List
+
+os.environ.setdefault("BOT_TOKEN", "123456:payload")
+
+from src.bot import utils  # noqa: E402
+from src.bot.dependencies import banks  # noqa: E402
+from src.bot.quiz import encode_indexes  # noqa: E402
+from src.bot.results import open_results_store  # noqa: E402
+from src.config import Config  # noqa: E402
+
+
+def random_selections(rng: random.Random) -> List[List[int]]:
+    """Indexes of selected answers for every question of the whole quiz
+    """
+    bank = banks.current
+    return [rng.sample(range(len(bank.questions[index].answers)),
+                       rng.randint(1, len(bank.questions[index].answers)))
+            for index in bank.default_quiz.pool]
+
+
+def text_session(selections: List[List[int]]) -> dict:
+    """FSM data of the last question when answers were kept as texts
+    """
+    bank = banks.current
+    return {index: [bank.questions[index].answers[answer]
+                    for answer in selected]
+            for index, selected in zip(bank.default_quiz.pool, selections)}
+
+
+def compact_session(selections: List[List[int]]) -> dict:
+    bank = banks.current
+    data = bank.new_session(bank.default_quiz.name, random.Random(0))
+    for position, selected in enumerate(selections, start=1):
+        data[f"q_{position}"] = encode_indexes(selected)
+    return data
+
+
+def session_cost(build: Callable[[List[List[int]]], dict],
+                 sessions: List[List[List[int]]]) -> tuple:
+    """Bytes of json and of python objects per session loaded from it
+    (as FSM storage holds it)
+    """
+    dumped = [json.dumps(build(selections), ensure_ascii=False)
+              for selections in sessions]
+    tracemalloc.start()
+    loaded = [json.loads(data) for data in dumped]
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    json_bytes = sum(len(data.encode()) for data in dumped)
+    return traced / len(loaded), json_bytes / len(loaded)
+
+
+def files_size(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(file.stat().st_size for file in path.iterdir())
+
+
+def results_file(config: Config) -> Path:
+    return {"json": config.logs_path / "results.json",
+            "journal": config.logs_path / "results",
+            "sqlite": config.logs_path / "results.sqlite3"
+            }[config.results_backend]
+
+
+def vacuum(config: Config) -> None:
+    if config.results_backend == "sqlite":
+        connection = sqlite3.connect(str(results_file(config)))
+        connection.execute("VACUUM")
+        # in WAL mode vacuumed pages reach the file on checkpoint
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.close()
+
+
+def main() -> bool:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    sessions = [random_selections(rng) for _ in range(args.users)]
+    for name, build in (("texts", text_session),
+                        ("indexes", compact_session)):
+        memory, json_bytes = session_cost(build, sessions)
+        print(f"session {name}: {memory:.0f} bytes in memory, "
+              f"{json_bytes:.0f} bytes of json")
+
+    legacy = {"results": {}, "total": {}}
+    for user_id, selections in enumerate(sessions, start=1):
+        answers = text_session(selections)
+        legacy["results"][str(user_id)] = answers
+        legacy["total"][str(user_id)] = len(utils.correct_questions(answers))
+
+    ok = True
+    for backend in ("json", "journal", "sqlite"):
+        config = Config(bot_token=os.environ["BOT_TOKEN"],
+                        logs_path=Path(tempfile.mkdtemp(
+                            prefix="quiz_payload_")),
+                        results_backend=backend)
+        if backend == "json":
+            results_file(config).write_text('{"results": {}, "total": {}}')
+        store = open_results_store(config, scorer=utils.correct_questions)
+        store.replace(legacy)
+        vacuum(config)
+        before = files_size(results_file(config))
+        stats_before = store.stats().as_dict()
+
+        start = time.perf_counter()
+        converted = store.migrate(utils.encode_answers)
+        elapsed = time.perf_counter() - start
+        vacuum(config)
+        after = files_size(results_file(config))
+
+        migrated = store.as_dict()
+        consistent = migrated["total"] == legacy["total"] \
+            and store.stats().as_dict() == stats_before \
+            and all(utils.correct_questions(answers)
+                    == utils.correct_questions(legacy["results"][user_id])
+                    for user_id, answers in migrated["results"].items())
+        ok = ok and consistent and converted == args.users
+        scale = 10000 / args.users
+        print(f"{backend}: {before * scale / 2 ** 20:.2f} MiB -> "
+              f"{after * scale / 2 ** 20:.2f} MiB per 10k users "
+              f"(x{before / after:.1f}), converted {converted} "
+              f"in {elapsed:.2f}s, consistent={consistent}")
+        store.close()
+    return ok
+
+
+if __name__ == '__main__':
+    raise SystemExit(0 if main() else 1)
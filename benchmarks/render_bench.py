@@ -0,0 +1,156 @@
+"""Microbenchmark of per-callback CPU cost of rendering and scoring
+
+Compares implementation that recomputes everything on each call
+(kept here as a reference) with the compiled quiz model. The answer
+callback renders what the handler edits the message with: the question
+text with selected answers and the keyboard of answers left.
+
+    python -m benchmarks.render_bench --number 20000
+"""
+import argparse
+import os
+import timeit
+from typing import List, Optional
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+
+from src.bot import utils  # noqa: E402
+from src.bot.dependencies import banks  # noqa: E402
+from src.bot.quiz import decode_indexes, encode_indexes, \
+    question_text  # noqa: E402
+from src.bot.states import Question  # noqa: E402
+
+bank = banks.current
+quiz = bank.questions
+questions = {index: compiled.question for index, compiled in quiz.items()}
+
+
+def legacy_number_from_index(index: str) -> int:
+    return int(index.split("_")[1])
+
+
+def legacy_is_correct(answer: list, question: Question) -> bool:
+    if question.options.check_answer_order:
+        return answer == question.correct_answer
+    return set(answer) == set(question.correct_answer)
+
+
+def legacy_count_score(user_answers: dict) -> int:
+    count = 0
+    for question_number, answer in user_answers.items():
+        if legacy_is_correct(answer, questions.get(question_number)):
+            count += 1
+    return count
+
+
+def legacy_create_answers_keyboard(
+        question: Question, exclude_answers: Optional[List[str]] = None) \
+        -> InlineKeyboardMarkup:
+    inline_keyboard = InlineKeyboardMarkup()
+    if not exclude_answers:
+        exclude_answers = []
+    for index, answer in enumerate(question.answers):
+        if answer in exclude_answers:
+            continue
+        inline_keyboard.add(
+            InlineKeyboardButton(text=answer, callback_data=f'a|{index}'))
+    inline_keyboard.add(InlineKeyboardButton(text="Следующий вопрос ➡️",
+                                             callback_data="n|"))
+    return inline_keyboard
+
+
+def legacy_format_question_text(question: Question,
+                                question_index: str) -> str:
+    header = f"👉 <b>Вопрос №{legacy_number_from_index(question_index)}" \
+             f"</b>: "
+    if question.options.repeat_answers:
+        extra = "\n\n<i>Варианты ответа</i>:\n"
+        for answer in question.answers:
+            extra += f"{answer}\n"
+    else:
+        extra = "\n"
+    return header + question.text + extra
+
+
+def legacy_format_results_text(user_answers: dict) -> str:
+    text = "👍 Вы ответили на все вопросы викторины!\n"
+    text += f"Правильных ответов: <b>{legacy_count_score(user_answers)}" \
+            f"</b> из <b>{len(questions)}</b>\n"
+    text += "<i>Подробности</i>:\n"
+    for _index, question in questions.items():
+        q_number = legacy_number_from_index(_index)
+        emoji = "✅" if legacy_is_correct(user_answers.get(_index, []),
+                                          question) else "❌"
+        text += f"Вопрос {q_number} - {emoji}\n"
+    return text
+
+
+# answer texts as the reference stored them, and codes of answer
+# indexes with the bank version that the handler commits now
+USER_ANSWERS = {index: list(question.correct_answer)
+                for index, question in questions.items()}
+CODED_ANSWERS = bank.encode_answers(USER_ANSWERS)
+QUESTION_INDEX = "q_3"  # question with repeated answers
+POSITION = 3
+# the answer tapped and ones selected before it
+ANSWER_INDEX = 1
+SELECTED = [0]
+
+
+def before_answer_callback():
+    question = questions[QUESTION_INDEX]
+    selected = [question.answers[index] for index in SELECTED]
+    selected.append(question.answers[ANSWER_INDEX])
+    keyboard = legacy_create_answers_keyboard(question,
+                                              exclude_answers=selected)
+    text = legacy_format_question_text(question, QUESTION_INDEX)
+    text += '\n<i>Ваши ответы</i>:\n'
+    for answer in selected:
+        text += f'{answer}\n'
+    return text, keyboard.to_python()
+
+
+def after_answer_callback():
+    question = quiz[QUESTION_INDEX]
+    selection = utils.add_selection(encode_indexes(SELECTED),
+                                    ANSWER_INDEX)
+    keyboard = utils.create_answers_keyboard(
+        bank, QUESTION_INDEX,
+        selected_mask=utils.answers_mask(decode_indexes(selection)))
+    text = question_text(question, POSITION) + \
+        '\n<i>Ваши ответы</i>:\n'
+    for answer in question.texts(selection):
+        text += f'{answer}\n'
+    return text, keyboard.to_python()
+
+
+def before_finish_callback():
+    return legacy_count_score(USER_ANSWERS), \
+        legacy_format_results_text(USER_ANSWERS)
+
+
+def after_finish_callback():
+    return len(bank.correct_questions(CODED_ANSWERS)), \
+        utils.format_results_text(bank, CODED_ANSWERS)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=20000)
+    number = parser.parse_args().number
+
+    assert before_answer_callback() == after_answer_callback()
+    assert before_finish_callback() == after_finish_callback()
+
+    for name in ("answer_callback", "finish_callback"):
+        before = timeit.timeit(globals()[f"before_{name}"], number=number)
+        after = timeit.timeit(globals()[f"after_{name}"], number=number)
+        print(f"{name}: before {before / number * 1e6:.2f} us, "
+              f"after {after / number * 1e6:.2f} us, "
+              f"speedup x{before / after:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Theory search: index build, load and query latency
+
+Builds the index from theory PDFs of the question bank (requires
+pypdf), then loads it from file as the bot does after restart and
+times queries. With `--copies` passages are repeated to see how
+latency grows with a larger theory.
+
+    python -m benchmarks.search --copies 1 100 --queries 2000
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+os.environ.setdefault("BOT_TOKEN", "123456:search")
+
+from src.bot.dependencies import banks  # noqa: E402
+from src.bot.search import IndexData, SearchIndex, terms  # noqa: E402
+
+QUERIES = ["лейшмания", "эритроцит", "цисты лямблий", "малярийный комар",
+           "профилактика амебиаза", "трипаносома", "муха цеце", "лейш",
+           "пути инвазии", "Entamoeba histolytica"]
+
+
+def time_queries(index: SearchIndex, count: int) -> list:
+    rng = random.Random(0)
+    latencies = []
+    for _ in range(count):
+        query = rng.choice(QUERIES)
+        start = time.perf_counter()
+        index.search(query)
+        latencies.append(time.perf_counter() - start)
+    return sorted(latencies)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--copies", type=int, nargs="+", default=[1, 100])
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    theory = banks.current.theory
+    path = Path(tempfile.mkdtemp(prefix="quiz_search_")) / "index.json"
+    index = SearchIndex(path)
+    start = time.perf_counter()
+    index.refresh(theory)
+    print(f"built from {len(theory)} PDFs in "
+          f"{time.perf_counter() - start:.3f}s, "
+          f"index file {path.stat().st_size / 1024:.0f} KiB")
+    loaded = SearchIndex(path)
+    start = time.perf_counter()
+    rebuilt = loaded.refresh(theory)
+    print(f"loaded in {time.perf_counter() - start:.3f}s, "
+          f"PDFs read again: {rebuilt}")
+
+    base = index.data
+    for copies in args.copies:
+        passages = base.passages * copies
+        start = time.perf_counter()
+        index.data = IndexData.build(base.sources, passages)
+        built = time.perf_counter() - start
+        latencies = time_queries(index, args.queries)
+        words = sum(1 for passage in passages for _ in terms(passage.text))
+        print(f"{len(passages)} passages ({words} words, indexed in "
+              f"{built:.2f}s): query median "
+              f"{statistics.median(latencies) * 1000:.2f} ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
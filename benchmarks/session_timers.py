@@ -0,0 +1,109 @@
+"""Session timers: cost of scheduling, ticking and firing
+reminders and expiry of abandoned quizzes
+
+Schedules a timer per user in the timer wheel of src.bot.sessions,
+moves them forward as activity does, then runs the wheel through
+simulated time. Compares memory with a `loop.call_later` handle per
+user, the obvious alternative.
+
+    python -m benchmarks.session_timers --users 100000
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+import tracemalloc
+
+os.environ.setdefault("BOT_TOKEN", "123456:sessions")
+
+from src.bot.sessions import TimerWheel  # noqa: E402
+
+REMIND_AFTER = 60 * 60
+
+
+def allocated(create) -> float:
+    """MiB allocated by objects `create` returns
+    """
+    tracemalloc.start()
+    objects = create()  # noqa: F841, kept alive while measured
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / 2 ** 20
+
+
+def call_later_handles(users: int) -> list:
+    loop = asyncio.new_event_loop()
+    handles = [loop.call_later(REMIND_AFTER, print, user)
+               for user in range(users)]
+    loop.close()
+    return handles
+
+
+def wheel_timers(users: int, now: float) -> TimerWheel:
+    wheel = TimerWheel(now=now)
+    for user in range(users):
+        wheel.schedule(("remind", user, user), now + REMIND_AFTER)
+    return wheel
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--idle-ticks", type=int, default=10000)
+    args = parser.parse_args()
+    rng = random.Random(0)
+    now = 1e9
+    keys = [("remind", user, user) for user in range(args.users)]
+    # last activity spread over the hour before
+    deadlines = [now + REMIND_AFTER - rng.uniform(0, REMIND_AFTER)
+                 for _ in keys]
+
+    wheel = TimerWheel(now=now)
+    start = time.perf_counter()
+    for key, deadline in zip(keys, deadlines):
+        wheel.schedule(key, deadline)
+    spent = time.perf_counter() - start
+    print(f"schedule {len(wheel)} timers: "
+          f"{spent / args.users * 1e9:.0f} ns per timer")
+
+    start = time.perf_counter()
+    for key, deadline in zip(keys, deadlines):
+        wheel.schedule(key, deadline + rng.uniform(1, 60))
+    spent = time.perf_counter() - start
+    print(f"move forward (an update of the user): "
+          f"{spent / args.users * 1e9:.0f} ns per timer")
+
+    # nothing is due in the next ticks: cost of the ticker alone
+    idle = TimerWheel(now=now)
+    for key, deadline in zip(keys, deadlines):
+        idle.schedule(key, deadline + 24 * REMIND_AFTER)
+    start = time.perf_counter()
+    for tick in range(1, args.idle_ticks + 1):
+        idle.advance(now + tick)
+    spent = time.perf_counter() - start
+    print(f"idle tick with {len(idle)} timers: "
+          f"{spent / args.idle_ticks * 1e6:.2f} us per tick")
+
+    fired = 0
+    longest = 0.0
+    start = time.perf_counter()
+    tick = 0
+    while wheel:
+        tick += 1
+        tick_start = time.perf_counter()
+        fired += len(wheel.advance(now + tick))
+        longest = max(longest, time.perf_counter() - tick_start)
+    spent = time.perf_counter() - start
+    print(f"fire {fired} timers over {tick} ticks: "
+          f"{spent / fired * 1e9:.0f} ns per timer, "
+          f"longest tick {longest * 1000:.2f} ms")
+
+    print(f"memory of {args.users} timers: wheel "
+          f"{allocated(lambda: wheel_timers(args.users, now)):.1f} MiB, "
+          f"call_later handles "
+          f"{allocated(lambda: call_later_handles(args.users)):.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
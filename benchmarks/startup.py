@@ -0,0 +1,80 @@
+"""Cold start: time from process start till the first reply
+
+Starts `python -m src.bot.bot` against fake Bot API several times,
+sends /start right away and measures when the reply arrives, then
+asks for results, which need the results store. Prints the startup
+breakdown the bot logged in the last run. With `--attempts` the
+results journal is filled with that many attempts first.
+
+    python -m benchmarks.startup --runs 5 --attempts 100000
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import signal
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.fake_api import FakeBotAPI, message_update
+
+
+async def start_once(logs_path: str) -> tuple:
+    api = FakeBotAPI()
+    await api.start()
+    env = dict(os.environ, API_SERVER=api.base_url, LOGS_PATH=logs_path,
+               RESULTS_BACKEND="journal", SEND_RATE_LIMIT="false",
+               BOT_TOKEN=os.environ.get("BOT_TOKEN", "123456:startup"))
+    update_ids = itertools.count(1)
+    api.add_users({1: [message_update(next(update_ids), 1, "/start")]})
+
+    start = time.perf_counter()
+    bot_process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "src.bot.bot", env=env)
+    await api.users_done.wait()
+    first_reply = time.perf_counter() - start
+    api.add_users({1: [message_update(next(update_ids), 1, "Результаты")]})
+    await api.users_done.wait()
+    results_reply = time.perf_counter() - start
+
+    bot_process.send_signal(signal.SIGTERM)
+    await bot_process.wait()
+    await api.stop()
+    return first_reply, results_reply
+
+
+def fill_journal(logs_path: str, attempts: int) -> None:
+    os.environ.setdefault("BOT_TOKEN", "123456:startup")
+    from benchmarks.export_memory import random_attempts, write_files
+    write_files(Path(logs_path), random_attempts(attempts, random.Random(0)))
+    os.remove(Path(logs_path) / "results.json")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--attempts", type=int, default=0,
+                        help="attempts in results journal")
+    args = parser.parse_args()
+
+    logs_path = tempfile.mkdtemp(prefix="quiz_startup_")
+    if args.attempts:
+        fill_journal(logs_path, args.attempts)
+    loop = asyncio.get_event_loop()
+    times = [loop.run_until_complete(start_once(logs_path))
+             for _ in range(args.runs)]
+    for name, replies in zip(("first reply", "results"), zip(*times)):
+        print(f"{name}: median {statistics.median(replies):.3f}s, "
+              f"max {max(replies):.3f}s over {args.runs} starts")
+    with open(Path(logs_path) / "logs.txt", "r", encoding="utf-8") as file:
+        lines = [line.strip() for line in file
+                 if "Started in" in line or "Results store" in line]
+    print("\n".join(lines[-2:]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Replay updates through the webhook server
+
+POSTs recorded updates (json lines, one update per line) or synthetic
+quiz sessions to the local webhook app backed by fake Bot API, then
+shuts the app down (draining in-flight handlers) and checks results.
+
+    python -m benchmarks.webhook_replay --users 200
+    python -m benchmarks.webhook_replay --updates recorded.jsonl
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import tempfile
+import time
+from collections import defaultdict
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks.fake_api import FakeBotAPI, quiz_session
+
+SECRET = "replay-secret"
+
+
+def load_updates(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def sender_id(update: dict) -> int:
+    event = update.get("message") or update.get("callback_query") or {}
+    return event.get("from", {}).get("id", 0)
+
+
+async def post_in_order(session: aiohttp.ClientSession, url: str,
+                        updates: list) -> None:
+    for update in updates:
+        async with session.post(url, json=update,
+                                headers={"X-Telegram-Bot-Api-Secret-Token":
+                                         SECRET}) as response:
+            assert response.status == 200, response.status
+
+
+async def run(users: int, updates_path: str) -> bool:
+    api = FakeBotAPI()
+    await api.start()
+    logs_path = tempfile.mkdtemp(prefix="quiz_webhook_")
+    os.environ.update(API_SERVER=api.base_url, LOGS_PATH=logs_path,
+                      WEBHOOK_SECRET=SECRET, WEBHOOK_PATH="/webhook",
+                      # fake API has no flood limits
+                      SEND_RATE_LIMIT="false")
+    os.environ.setdefault("BOT_TOKEN", "123456:webhook")
+
+    from src.bot import handlers, utils  # noqa: F401 registers handlers
+    from src.bot.bot import on_shutdown
+    from src.bot.dependencies import config, dp
+    from src.bot.webhook import make_webhook_app
+
+    if updates_path:
+        updates = load_updates(updates_path)
+    else:
+        update_ids = itertools.count(1)
+        updates = [update for user_id in range(1, users + 1)
+                   for update in quiz_session(user_id, update_ids)]
+    # updates of one user are sent in order, users in parallel
+    by_user = defaultdict(list)
+    for update in updates:
+        by_user[sender_id(update)].append(update)
+
+    runner = web.AppRunner(make_webhook_app(dp, config,
+                                            on_shutdown=on_shutdown))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0, backlog=4096)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}{config.webhook_path}"
+
+    start = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(post_in_order(session, url, user_updates)
+                               for user_updates in by_user.values()))
+    await runner.cleanup()  # drains in-flight handlers
+    elapsed = time.perf_counter() - start
+
+    stats = utils.results_store(config).stats()
+    print(f"updates={len(updates)} users={len(by_user)} "
+          f"elapsed={elapsed:.2f}s rate={len(updates) / elapsed:.0f} "
+          f"updates/s")
+    print(f"completed={stats.participants} api_calls={dict(api.calls)}")
+    await api.stop()
+    return updates_path or stats.participants == users
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--updates", default="",
+                        help="json lines file with recorded updates")
+    args = parser.parse_args()
+    ok = asyncio.get_event_loop().run_until_complete(
+        run(args.users, args.updates))
+    raise SystemExit(0 if ok else 1)
@@ -0,0 +1,76 @@
+"""Throughput of the bot run as a separate process with N workers
+
+Starts fake Bot API with virtual users passing the quiz, runs
+`python -m src.bot.bot` against it with WORKERS=N and measures time
+until every user got the results.
+
+    python -m benchmarks.workers --users 300 --workers 1 2 4
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import signal
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_api import FakeBotAPI, message_update, quiz_session
+
+WARM_UP_USER = 10 ** 6
+
+
+async def run_once(users: int, workers: int) -> float:
+    api = FakeBotAPI()
+    await api.start()
+    logs_path = tempfile.mkdtemp(prefix="quiz_workers_")
+    env = dict(os.environ, API_SERVER=api.base_url, LOGS_PATH=logs_path,
+               WORKERS=str(workers), RESULTS_BACKEND="sqlite",
+               SEND_RATE_LIMIT="false",  # fake API has no flood limits
+               BOT_TOKEN=os.environ.get("BOT_TOKEN", "123456:workers"))
+    bot_process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "src.bot.bot", env=env)
+
+    update_ids = itertools.count(1)
+    exited = asyncio.ensure_future(bot_process.wait())
+
+    async def play(scripts: dict) -> None:
+        api.add_users(scripts)
+        await asyncio.wait([exited,
+                            asyncio.ensure_future(api.users_done.wait())],
+                           return_when=asyncio.FIRST_COMPLETED)
+        if exited.done():
+            raise RuntimeError(f"Bot exited with code {exited.result()}, "
+                               f"see {logs_path}/logs.txt")
+
+    # warm up: wait until every worker has started and answered /start
+    await play({WARM_UP_USER + index: [message_update(next(update_ids),
+                                                      WARM_UP_USER + index,
+                                                      "/start")]
+                for index in range(workers)})
+
+    start = time.perf_counter()
+    await play({user_id: quiz_session(user_id, update_ids)
+                for user_id in range(1, users + 1)})
+    elapsed = time.perf_counter() - start
+
+    bot_process.send_signal(signal.SIGTERM)
+    await bot_process.wait()
+    await api.stop()
+    return elapsed
+
+
+async def main(users: int, workers_options: list) -> None:
+    for workers in workers_options:
+        elapsed = await run_once(users, workers)
+        print(f"workers={workers} users={users} elapsed={elapsed:.2f}s "
+              f"rate={users / elapsed:.1f} quizzes/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(
+        main(args.users, args.workers))
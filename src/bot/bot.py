@@ -1,15 +1,80 @@
 """Bot entry point
 """
+# first import, times the ones below
+from src.bot.startup import timer
+
+import asyncio
 import logging
-from aiogram.utils import executor
+import time
+
+from src.bot.dependencies import dp, config, banks, edits, errors, \
+    search, sessions
+from src.bot import metrics, utils
+
+logger = logging.getLogger(__name__)
+
+
+async def open_results() -> None:
+    """Open results store (journal loads whole history into memory)
+    """
+    start = time.perf_counter()
+    try:
+        await utils.async_results(config).open()
+    except Exception as err:
+        logger.error(f"Error opening results store: {err}", exc_info=err)
+        return
+    logger.info(f"Results store opened in "
+                f"{time.perf_counter() - start:.3f}s")
+
+
+async def on_startup(dispatcher):
+    """Watch question bank and theory for changes, run session timers,
+    serve metrics if port is configured and open results store in
+    background"""
+    timer.mark("event loop")
+    banks.start_watching(config.quiz_reload_interval)
+    search.start_watching(lambda: banks.current.theory,
+                          config.search_refresh_interval)
+    await sessions.start(dispatcher)
+    if config.metrics_port is not None:
+        await metrics.start_metrics_server(config.metrics_host,
+                                           config.metrics_port)
+    # store is loaded in a thread, updates are served meanwhile and
+    # the ones that need results wait for the load without blocking
+    asyncio.get_event_loop().create_task(open_results())
+    timer.mark("startup hooks")
+    logger.info(timer.report())
+
 
-from src.bot.dependencies import dp
-# Do not delete (used to register handlers via decorators)
-from src.bot import handlers
+async def on_shutdown(dispatcher):
+    """Flush results that are still queued for writing, send
+    waiting message edits and collected errors"""
+    banks.stop_watching()
+    search.stop_watching()
+    await sessions.close()
+    await edits.close()
+    await utils.async_results(config).close()
+    await errors.close()
+    await metrics.stop_metrics_servers()
 
 
 if __name__ == '__main__':
     """Bot entry point"""
-    logger = logging.getLogger(__name__)
     logger.info("Start quiz-bot!")
-    executor.start_polling(dp, skip_updates=False)
+    if config.workers > 1:
+        # handlers run in worker processes only
+        from src.bot.workers import start_workers
+        start_workers(dp, config)
+    else:
+        # Do not delete (used to register handlers via decorators)
+        from src.bot import handlers  # noqa: F401
+        timer.mark("handlers")
+        if config.run_mode == "webhook":
+            from src.bot.webhook import start_webhook
+            start_webhook(dp, config, on_startup=on_startup,
+                          on_shutdown=on_shutdown)
+        else:
+            from aiogram.utils import executor
+            executor.start_polling(dp, skip_updates=False,
+                                   on_startup=on_startup,
+                                   on_shutdown=on_shutdown)
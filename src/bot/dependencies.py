@@ -1,23 +1,52 @@
 """Dependencies that used all across the app
 """
 
-import logging
 from pathlib import Path
 
-from aiogram import Bot, Dispatcher
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram import Dispatcher
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 
+from src.bot.edits import EditCoalescer
+from src.bot.error_reports import ErrorReporter
+from src.bot.fsm_storage import create_storage
+from src.bot.logs import setup_logging
+from src.bot.media import MediaCache
+from src.bot.metrics import setup_metrics
+from src.bot.quiz import QuizBanks
+from src.bot.scheduler import ScheduledBot, create_scheduler
+from src.bot.search import SearchIndex
+from src.bot.sessions import SessionTimers, setup_sessions
+from src.bot.startup import timer
 from src.config import Config
 
+timer.mark("imports")
 config = Config()
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-    filename=config.logs_path/Path("logs.txt")
-)
+setup_logging(config)
 
 
 # Bot init
-bot = Bot(token=config.bot_token)
-dp = Dispatcher(bot, storage=MemoryStorage())
+api_server = TelegramAPIServer.from_base(config.api_server) \
+    if config.api_server else TELEGRAM_PRODUCTION
+bot = ScheduledBot(token=config.bot_token, server=api_server,
+                   scheduler=create_scheduler(config))
+dp = Dispatcher(bot, storage=create_storage(config))
+setup_metrics(dp)
+sessions = SessionTimers(remind_after=config.session_remind_after,
+                         expire_after=config.session_expire_after)
+setup_sessions(dp, sessions)
+timer.mark("bot and storage")
+errors = ErrorReporter(bot, config.control_chat_id,
+                       window=config.error_report_window,
+                       max_per_minute=config.error_reports_per_minute)
+banks = QuizBanks(config.quiz_bank_path
+                  or config.assets_path / Path("quiz.json"),
+                  archive=config.logs_path / Path("quiz_banks"))
+media = MediaCache(config.media_cache_path
+                   or config.logs_path / Path("file_ids.json"))
+# edits are sent in background, their errors go to the control chat
+edits = EditCoalescer(delay=config.edit_delay,
+                      on_error=lambda error: errors.report(None, error))
+search = SearchIndex(config.search_index_path
+                     or config.logs_path / Path("search_index.json"))
+timer.mark("question bank and assets")
@@ -0,0 +1,160 @@
+"""Coalescing of rapid edits of the same message
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+from aiogram import types
+from aiogram.utils import exceptions
+
+from src.bot import metrics
+
+logger = logging.getLogger(__name__)
+
+MessageKey = Tuple[int, int]  # chat id, message id
+
+
+class PendingEdit:
+    def __init__(self, message: types.Message, method: str, kwargs: dict,
+                 urgent: bool):
+        self.message = message
+        self.method = method  # edit_text or edit_reply_markup
+        self.kwargs = kwargs
+        self.urgent = urgent
+        # True when sent, False when replaced by a newer edit or failed
+        self.done = asyncio.get_event_loop().create_future()
+
+    def resolve(self, sent: bool) -> None:
+        if not self.done.done():  # waiter may be cancelled
+            self.done.set_result(sent)
+
+
+class EditCoalescer:
+    """Sends only the latest of rapid edits of a message.
+
+    An edit waits `delay` seconds before it is sent, a newer edit of
+    the same message submitted meanwhile replaces it. Edits of one
+    message are sent one at a time in the order they were submitted,
+    so an older rendering never overwrites a newer one, and edits
+    submitted while a request is in flight are coalesced as well.
+
+    Removing the keyboard closes the message: waiting and later edits
+    that would put a keyboard back are dropped. The last `max_closed`
+    closed messages are remembered.
+
+    Handlers do not wait for the edit. "Message is not modified"
+    errors are ignored, other errors are logged and passed to
+    `on_error`.
+    """
+
+    def __init__(self, delay: float = 0.3,
+                 on_error: Optional[Callable[[Exception], None]] = None,
+                 max_closed: int = 10000):
+        self.delay = delay
+        self.on_error = on_error
+        self.max_closed = max_closed
+        self._closed: "OrderedDict[MessageKey, None]" = OrderedDict()
+        self._pending: Dict[MessageKey, PendingEdit] = {}
+        self._senders: Dict[MessageKey, asyncio.Task] = {}
+        self._wakeups: Dict[MessageKey, asyncio.Event] = {}
+        self._closing = False
+
+    @staticmethod
+    def _key(message: types.Message) -> MessageKey:
+        return message.chat.id, message.message_id
+
+    def edit_text(self, message: types.Message, text: str,
+                  reply_markup: Optional[types.InlineKeyboardMarkup] = None,
+                  parse_mode: Optional[str] = None) -> asyncio.Future:
+        """Schedule edit of message text, the returned future is done
+        when the edit is sent (True) or replaced by a newer one or
+        failed (False)
+        """
+        return self._submit(message, "edit_text",
+                            dict(text=text, reply_markup=reply_markup,
+                                 parse_mode=parse_mode), urgent=False)
+
+    def closed(self, message: types.Message) -> bool:
+        """Whether keyboard of the message was removed
+        """
+        return self._key(message) in self._closed
+
+    def remove_keyboard(self, message: types.Message) -> asyncio.Future:
+        """Remove inline keyboard without delay and close the message.
+        Text of an edit still waiting is sent with it
+        """
+        key = self._key(message)
+        self._closed[key] = None
+        self._closed.move_to_end(key)
+        if len(self._closed) > self.max_closed:
+            self._closed.popitem(last=False)
+        pending = self._pending.get(key)
+        if pending is not None and pending.method == "edit_text":
+            return self._submit(message, "edit_text",
+                                dict(pending.kwargs, reply_markup=None),
+                                urgent=True)
+        return self._submit(message, "edit_reply_markup",
+                            dict(reply_markup=None), urgent=True)
+
+    def _submit(self, message: types.Message, method: str, kwargs: dict,
+                urgent: bool) -> asyncio.Future:
+        key = self._key(message)
+        edit = PendingEdit(message, method, kwargs, urgent)
+        if key in self._closed and kwargs.get("reply_markup") is not None:
+            metrics.MESSAGE_EDITS.inc("dropped")
+            edit.resolve(False)
+            return edit.done
+        replaced = self._pending.get(key)
+        if replaced is not None:
+            replaced.resolve(False)
+            metrics.MESSAGE_EDITS.inc("coalesced")
+        self._pending[key] = edit
+        if key not in self._senders:
+            self._wakeups[key] = asyncio.Event()
+            self._senders[key] = asyncio.get_event_loop().create_task(
+                self._send_latest(key))
+        elif urgent:
+            self._wakeups[key].set()
+        return edit.done
+
+    async def _send_latest(self, key: MessageKey) -> None:
+        wakeup = self._wakeups[key]
+        try:
+            while key in self._pending:
+                if not (self._pending[key].urgent or self._closing) \
+                        and self.delay > 0:
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), self.delay)
+                    except asyncio.TimeoutError:
+                        pass
+                wakeup.clear()
+                edit = self._pending.pop(key)
+                try:
+                    await getattr(edit.message, edit.method)(**edit.kwargs)
+                except exceptions.MessageNotModified:
+                    metrics.MESSAGE_EDITS.inc("not_modified")
+                except Exception as err:
+                    metrics.MESSAGE_EDITS.inc("failed")
+                    logger.error(f"Error editing message {key}: {err}",
+                                 exc_info=err)
+                    if self.on_error is not None:
+                        self.on_error(err)
+                    edit.resolve(False)
+                    continue
+                else:
+                    metrics.MESSAGE_EDITS.inc("sent")
+                edit.resolve(True)
+        finally:
+            del self._senders[key]
+            del self._wakeups[key]
+
+    async def close(self) -> None:
+        """Send waiting edits right away
+        """
+        self._closing = True
+        for wakeup in self._wakeups.values():
+            wakeup.set()
+        senders = list(self._senders.values())
+        if senders:
+            await asyncio.wait(senders)
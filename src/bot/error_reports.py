@@ -0,0 +1,138 @@
+"""Error reports to the control chat, grouped and rate limited
+"""
+import asyncio
+import html
+import logging
+import os
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Tuple
+
+from aiogram import Bot, types
+
+from src.bot.updates import update_user_id
+
+logger = logging.getLogger(__name__)
+
+Fingerprint = Tuple[str, str]
+
+MESSAGE_LIMIT = 4096  # max length of telegram message
+SAMPLE_USERS = 5
+
+
+def fingerprint(error: BaseException) -> Fingerprint:
+    """Exception type and place where it was raised, preferring
+    the deepest frame of the bot code over library frames
+    """
+    frames = traceback.extract_tb(error.__traceback__)
+    own_frames = [frame for frame in frames
+                  if "site-packages" not in frame.filename]
+    frame = (own_frames or frames or [None])[-1]
+    location = "unknown" if frame is None \
+        else f"{os.path.relpath(frame.filename)}:{frame.lineno} " \
+             f"in {frame.name}"
+    return type(error).__name__, location
+
+
+@dataclass
+class ErrorGroup:
+    """Errors with the same fingerprint seen during the window"""
+    sample: str
+    count: int = 0
+    user_ids: List[int] = field(default_factory=list)
+
+    def add(self, user_id: int) -> None:
+        self.count += 1
+        if user_id and user_id not in self.user_ids \
+                and len(self.user_ids) < SAMPLE_USERS:
+            self.user_ids.append(user_id)
+
+
+class ErrorReporter:
+    """Collects errors for `window` seconds and sends one digest with
+    counts per fingerprint. Not more than `max_per_minute` digests are
+    sent, errors keep accumulating until the next one is allowed
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, window: float = 60,
+                 max_per_minute: int = 2):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.window = window
+        self.max_per_minute = max_per_minute
+
+        self._groups: Dict[Fingerprint, ErrorGroup] = {}
+        self._sent_at: Deque[float] = deque()
+        self._flusher: Optional[asyncio.Task] = None
+
+    def report(self, update: Optional[types.Update],
+               error: BaseException) -> None:
+        """Add error to the next digest
+        """
+        user_id = update_user_id(update.to_python()) \
+            if update is not None else 0
+        key = fingerprint(error)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = ErrorGroup(sample=str(error))
+        group.add(user_id)
+
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_event_loop().create_task(
+                self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while self._groups:
+            await asyncio.sleep(self.window)
+            delay = self._rate_limit_delay(time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.flush()
+
+    def _rate_limit_delay(self, now: float) -> float:
+        while self._sent_at and now - self._sent_at[0] >= 60:
+            self._sent_at.popleft()
+        if len(self._sent_at) < self.max_per_minute:
+            return 0.0
+        return 60 - (now - self._sent_at[0])
+
+    def digest(self, groups: Dict[Fingerprint, ErrorGroup]) -> str:
+        """Html text of a report, most frequent errors first
+        """
+        total = sum(group.count for group in groups.values())
+        lines = [f"<b>Errors: {total}</b>, kinds: {len(groups)}"]
+        ordered = sorted(groups.items(), key=lambda item: -item[1].count)
+        for (error_type, location), group in ordered:
+            users = ", ".join(map(str, group.user_ids)) or "-"
+            line = f"\n{group.count}× <b>{html.escape(error_type)}</b> " \
+                   f"at <code>{html.escape(location)}</code>\n" \
+                   f"{html.escape(group.sample[:200])}\nusers: {users}"
+            if len("\n".join(lines)) + len(line) > MESSAGE_LIMIT - 50:
+                lines.append("\n…")
+                break
+            lines.append(line)
+        return "\n".join(lines)
+
+    async def flush(self) -> None:
+        """Send collected errors now
+        """
+        if not self._groups:
+            return
+        groups, self._groups = self._groups, {}
+        self._sent_at.append(time.monotonic())
+        try:
+            await self.bot.send_message(chat_id=self.chat_id,
+                                        text=self.digest(groups),
+                                        parse_mode="HTML")
+        except Exception as err:
+            logger.error(f"Error sending error report: {err}")
+
+    async def close(self) -> None:
+        """Send what is left and stop
+        """
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
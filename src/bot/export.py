@@ -0,0 +1,308 @@
+"""Export of quiz attempts for analysis
+
+Streams attempts from the configured results store into CSV or
+Parquet (requires pyarrow), one row per question of an attempt, and
+builds report of question difficulty in the same pass. Attempts are
+read one by one, so memory does not depend on their number. Only
+files are read, so it runs next to the bot; BOT_TOKEN is not needed.
+
+    python -m src.bot.export --answers answers.csv --since 2026-09-01
+    python -m src.bot.export --answers answers.parquet --quiz main
+    python -m src.bot.export --difficulty difficulty.csv
+"""
+import argparse
+import csv
+import math
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+from src.bot.quiz import QuizBanks
+from src.bot.results import Attempt, read_history
+from src.config import Config
+
+
+class ExportError(Exception):
+    """Export can not be done with given arguments"""
+
+
+class AnswerRow(NamedTuple):
+    user_id: str
+    name: str
+    quiz: str
+    finished_at: datetime  # UTC
+    bank: str  # version of question bank the quiz was passed with
+    position: int  # order of the question in the attempt
+    question: str  # question id
+    answer: str  # texts of selected answers separated by "; "
+    correct: bool
+    score: int
+    questions: int
+
+
+def open_banks(config: Config) -> QuizBanks:
+    """Question banks of the bot, archive of their versions is only
+    read, so the bot stays the only one writing it
+    """
+    return QuizBanks(config.quiz_bank_path
+                     or config.assets_path / Path("quiz.json"),
+                     archive=config.logs_path / Path("quiz_banks"),
+                     update_archive=False)
+
+
+def attempt_rows(banks: QuizBanks, attempt: Attempt,
+                 answers: dict) -> Iterator[AnswerRow]:
+    """Rows of every question of the attempt, correctness is checked
+    the same way as for results shown by the bot
+    """
+    bank = banks.get(answers.get("bank"), fallback=True)
+    correct = set(bank.correct_questions(answers))
+    finished_at = datetime.fromtimestamp(attempt.finished_at, timezone.utc)
+    questions = ((index, answer) for index, answer in answers.items()
+                 if index != "bank")
+    for position, (index, answer) in enumerate(questions, start=1):
+        if index in bank.questions:
+            texts = bank.questions[index].texts(answer)
+        else:
+            texts = [answer] if isinstance(answer, str) else answer
+        yield AnswerRow(
+            user_id=attempt.user_id, name=attempt.name, quiz=attempt.quiz,
+            finished_at=finished_at, bank=answers.get("bank", ""),
+            position=position, question=index, answer="; ".join(texts),
+            correct=index in correct, score=attempt.score,
+            questions=attempt.questions)
+
+
+class QuestionStats:
+    """Running sums of one question over attempts that included it.
+    Share of correct answers in the attempt is used as its result,
+    so quizzes of different length can be compared
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.answered = 0
+        self.correct = 0
+        self.result_sum = 0.0
+        self.result_squares = 0.0
+        self.correct_result_sum = 0.0
+
+    def include(self, correct: bool, result: float) -> None:
+        self.answered += 1
+        self.result_sum += result
+        self.result_squares += result * result
+        if correct:
+            self.correct += 1
+            self.correct_result_sum += result
+
+    @property
+    def correct_rate(self) -> float:
+        return self.correct / self.answered
+
+    @property
+    def discrimination(self) -> Optional[float]:
+        """Point-biserial correlation of answering the question
+        correctly with result of the attempt, None when everyone
+        answered the same way or got the same result
+        """
+        wrong = self.answered - self.correct
+        if not self.correct or not wrong:
+            return None
+        mean = self.result_sum / self.answered
+        variance = self.result_squares / self.answered - mean * mean
+        if variance <= 1e-12:
+            return None
+        correct_mean = self.correct_result_sum / self.correct
+        wrong_mean = (self.result_sum - self.correct_result_sum) / wrong
+        rate = self.correct_rate
+        return (correct_mean - wrong_mean) / math.sqrt(variance) \
+            * math.sqrt(rate * (1 - rate))
+
+
+class DifficultyReport:
+    """Per-question difficulty collected in one pass over rows
+    """
+    FIELDS = ("question", "text", "answered", "correct", "correct_rate",
+              "discrimination")
+
+    def __init__(self, banks: QuizBanks):
+        self.banks = banks
+        self.questions: Dict[str, QuestionStats] = {}
+
+    def include(self, row: AnswerRow) -> None:
+        stats = self.questions.get(row.question)
+        if stats is None:
+            # text of the version the question was answered in
+            bank = self.banks.get(row.bank or None, fallback=True)
+            question = bank.questions.get(row.question)
+            stats = self.questions[row.question] = QuestionStats(
+                question.question.text if question else "")
+        stats.include(row.correct, row.score / max(row.questions, 1))
+
+    def rows(self) -> List[tuple]:
+        """Hardest questions first
+        """
+        ordered = sorted(self.questions.items(),
+                         key=lambda item: item[1].correct_rate)
+        rows = []
+        for index, stats in ordered:
+            discrimination = stats.discrimination
+            rows.append((index, stats.text, stats.answered, stats.correct,
+                         round(stats.correct_rate, 4),
+                         "" if discrimination is None
+                         else round(discrimination, 4)))
+        return rows
+
+    def write(self, path: Path) -> None:
+        # BOM lets spreadsheet apps detect utf-8 of russian texts
+        with open(path, "w", encoding="utf-8-sig", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(self.FIELDS)
+            writer.writerows(self.rows())
+
+
+class CsvWriter:
+    def __init__(self, path: Path):
+        self.file = open(path, "w", encoding="utf-8-sig", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(AnswerRow._fields)
+
+    def write(self, row: AnswerRow) -> None:
+        self.writer.writerow(row._replace(
+            finished_at=row.finished_at.isoformat(timespec="seconds"),
+            correct=int(row.correct)))
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ParquetWriter:
+    """Rows are buffered by columns and written as row groups
+    of `batch_size` rows
+    """
+
+    def __init__(self, path: Path, batch_size: int = 50000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ExportError("pyarrow is required for parquet export")
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            ("user_id", pyarrow.string()),
+            ("name", pyarrow.string()),
+            ("quiz", pyarrow.string()),
+            ("finished_at", pyarrow.timestamp("s", tz="UTC")),
+            ("bank", pyarrow.string()),
+            ("position", pyarrow.int32()),
+            ("question", pyarrow.string()),
+            ("answer", pyarrow.string()),
+            ("correct", pyarrow.bool_()),
+            ("score", pyarrow.int32()),
+            ("questions", pyarrow.int32()),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(str(path), self.schema)
+        self.batch_size = batch_size
+        self.columns: List[list] = [[] for _ in AnswerRow._fields]
+
+    def write(self, row: AnswerRow) -> None:
+        for column, value in zip(self.columns, row):
+            column.append(value)
+        if len(self.columns[0]) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.columns[0]:
+            self.writer.write_table(self.pyarrow.Table.from_arrays(
+                [self.pyarrow.array(column, type=column_type)
+                 for column, column_type in zip(self.columns,
+                                                self.schema.types)],
+                schema=self.schema))
+            self.columns = [[] for _ in AnswerRow._fields]
+
+    def close(self) -> None:
+        self.flush()
+        self.writer.close()
+
+
+def open_writer(path: Path):
+    if path.suffix == ".csv":
+        return CsvWriter(path)
+    if path.suffix == ".parquet":
+        return ParquetWriter(path)
+    raise ExportError(f"Unknown export format: {path.suffix}, "
+                      f"use .csv or .parquet")
+
+
+def export(history: Iterable[tuple], banks: QuizBanks, writer=None,
+           report: Optional[DifficultyReport] = None,
+           quiz: Optional[str] = None) -> tuple:
+    """Write rows of attempts from `history` and include them into
+    report, returns number of attempts and rows
+    """
+    attempts = rows = 0
+    for attempt, answers in history:
+        if quiz is not None and attempt.quiz != quiz:
+            continue
+        attempts += 1
+        for row in attempt_rows(banks, attempt, answers):
+            rows += 1
+            if writer is not None:
+                writer.write(row)
+            if report is not None:
+                report.include(row)
+    return attempts, rows
+
+
+def parse_time(value: str, end: bool = False) -> float:
+    """Unix time of ISO date or date and time in local time zone,
+    the end of range given by date includes that day
+    """
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise ExportError(f"Wrong date: {value}, use YYYY-MM-DD "
+                          f"or YYYY-MM-DDTHH:MM")
+    if end and len(value) == len("YYYY-MM-DD"):
+        moment += timedelta(days=1)
+    return moment.timestamp()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--answers", type=Path,
+                        help="rows of answers, .csv or .parquet")
+    parser.add_argument("--difficulty", type=Path,
+                        help="csv report of question difficulty")
+    parser.add_argument("--since", help="first day (or moment) to export")
+    parser.add_argument("--until", help="last day to export, or moment "
+                                        "to export before")
+    parser.add_argument("--quiz", help="export only attempts of the quiz")
+    args = parser.parse_args()
+    if args.answers is None and args.difficulty is None:
+        parser.error("nothing to export: set --answers or --difficulty")
+
+    try:
+        since = parse_time(args.since) if args.since else 0
+        until = parse_time(args.until, end=True) if args.until \
+            else float("inf")
+        writer = open_writer(args.answers) if args.answers else None
+    except ExportError as err:
+        parser.error(str(err))
+    config = Config(bot_token="")  # token is not used by export
+    banks = open_banks(config)
+    report = DifficultyReport(banks) if args.difficulty else None
+    try:
+        attempts, rows = export(read_history(config, since, until), banks,
+                                writer, report, args.quiz)
+    finally:
+        if writer is not None:
+            writer.close()
+    if report is not None:
+        report.write(args.difficulty)
+    print(f"Exported {attempts} attempts, {rows} answers")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+"""Persistent FSM storage
+"""
+import asyncio
+import copy
+import json
+import logging
+import sqlite3
+import time
+import typing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
+
+from src.config import Config
+
+logger = logging.getLogger(__name__)
+
+Address = typing.Tuple[str, str]
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS fsm (
+    chat TEXT NOT NULL,
+    user TEXT NOT NULL,
+    state TEXT,
+    data TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (chat, user)
+)
+"""
+CREATE_INDEX = "CREATE INDEX IF NOT EXISTS fsm_updated_at ON fsm (updated_at)"
+SELECT_RECORD = "SELECT state, data, bucket, updated_at FROM fsm " \
+                "WHERE chat = ? AND user = ?"
+UPSERT_RECORD = "INSERT OR REPLACE INTO fsm " \
+                "(chat, user, state, data, bucket, updated_at) " \
+                "VALUES (?, ?, ?, ?, ?, ?)"
+DELETE_RECORD = "DELETE FROM fsm WHERE chat = ? AND user = ?"
+DELETE_STALE = "DELETE FROM fsm WHERE updated_at < ?"
+COUNT_ACTIVE = "SELECT COUNT(*) FROM fsm WHERE state IS NOT NULL"
+SELECT_ACTIVE = "SELECT chat, user, updated_at FROM fsm " \
+                "WHERE state IS NOT NULL"
+
+
+def _empty_record() -> dict:
+    return dict(state=None, data={}, bucket={}, updated_at=time.time())
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage in SQLite database (WAL mode).
+
+    Writes are collected in memory and flushed in one transaction every
+    `flush_interval` seconds by a background task, so a burst of
+    callbacks costs a single commit. Recently used records are cached
+    (LRU bounded by `cache_size`). Records not touched for `ttl` seconds
+    are evicted, so abandoned sessions do not pile up.
+    All database calls run in a dedicated thread.
+    """
+
+    def __init__(self, path: Path, ttl: float = 24 * 60 * 60,
+                 flush_interval: float = 0.2, cache_size: int = 10000):
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="fsm-sqlite")
+        self._connection: typing.Optional[sqlite3.Connection] = None
+        self._cache: "OrderedDict[Address, dict]" = OrderedDict()
+        self._dirty: typing.Dict[Address, dict] = {}
+        self._flusher: typing.Optional[asyncio.Task] = None
+        self._closing = False
+        self._last_eviction = 0.0
+
+    # -- database thread --
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(str(self.path))
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(CREATE_TABLE)
+            self._connection.execute(CREATE_INDEX)
+            self._connection.commit()
+        return self._connection
+
+    def _select(self, address: Address) -> typing.Optional[dict]:
+        row = self._connect().execute(SELECT_RECORD, address).fetchone()
+        if row is None:
+            return None
+        state, data, bucket, updated_at = row
+        return dict(state=state, data=json.loads(data),
+                    bucket=json.loads(bucket), updated_at=updated_at)
+
+    def _write(self, upserts: typing.List[tuple],
+               deletes: typing.List[Address]) -> None:
+        connection = self._connect()
+        with connection:  # single transaction for the whole batch
+            connection.executemany(UPSERT_RECORD, upserts)
+            connection.executemany(DELETE_RECORD, deletes)
+
+    def _delete_stale(self, deadline: float) -> int:
+        connection = self._connect()
+        with connection:
+            return connection.execute(DELETE_STALE, (deadline,)).rowcount
+
+    def _count_active(self) -> int:
+        return self._connect().execute(COUNT_ACTIVE).fetchone()[0]
+
+    def _select_active(self) -> typing.List[typing.Tuple[str, str, float]]:
+        return self._connect().execute(SELECT_ACTIVE).fetchall()
+
+    def _close_connection(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    # -- event loop --
+
+    async def _get_record(self, chat, user) -> typing.Tuple[Address, dict]:
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        address = (chat, user)
+        record = self._lookup(address)
+        if record is None:
+            record = await self._run(self._select, address) \
+                or _empty_record()
+            # record could be loaded by concurrent call meanwhile
+            record = self._lookup(address) or record
+        self._remember(address, record)
+        return address, record
+
+    def _lookup(self, address: Address) -> typing.Optional[dict]:
+        record = self._dirty.get(address)
+        if record is None:
+            record = self._cache.get(address)
+        return record
+
+    def _remember(self, address: Address, record: dict) -> None:
+        self._cache[address] = record
+        self._cache.move_to_end(address)
+        while len(self._cache) > self.cache_size:
+            # dirty records stay in `_dirty` until flushed
+            self._cache.popitem(last=False)
+
+    def _mark_dirty(self, address: Address, record: dict) -> None:
+        record["updated_at"] = time.time()
+        self._dirty[address] = record
+        self._remember(address, record)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_event_loop().create_task(
+                self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while self._dirty and not self._closing:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Write pending changes in one transaction and evict stale records
+        """
+        if self._dirty:
+            pending, self._dirty = self._dirty, {}
+            # records are serialized here, they may change while written
+            upserts, deletes = [], []
+            for (chat, user), record in pending.items():
+                if record["state"] is None and not record["data"] \
+                        and not record["bucket"]:
+                    deletes.append((chat, user))
+                    continue
+                upserts.append((
+                    chat, user, record["state"],
+                    json.dumps(record["data"], ensure_ascii=False),
+                    json.dumps(record["bucket"], ensure_ascii=False),
+                    record["updated_at"]
+                ))
+            try:
+                await self._run(self._write, upserts, deletes)
+            except sqlite3.Error as err:
+                logger.error(f"Error saving FSM records: {err}")
+                # keep changes that were not overwritten meanwhile
+                for address, record in pending.items():
+                    self._dirty.setdefault(address, record)
+
+        now = time.time()
+        if now - self._last_eviction >= min(self.ttl, 60):
+            self._last_eviction = now
+            await self.evict_stale(now - self.ttl)
+
+    async def evict_stale(self, deadline: float) -> int:
+        """Delete sessions not touched since `deadline`
+        """
+        for address in [address for address, record in self._cache.items()
+                        if record["updated_at"] < deadline
+                        and address not in self._dirty]:
+            del self._cache[address]
+        evicted = await self._run(self._delete_stale, deadline)
+        if evicted:
+            logger.info(f"Evicted {evicted} stale FSM records")
+        return evicted
+
+    async def active_sessions(self) -> int:
+        """Number of users with a state
+        """
+        await self.flush()
+        return await self._run(self._count_active)
+
+    async def active_records(self) \
+            -> typing.List[typing.Tuple[str, str, float]]:
+        """Chat, user and time of the last change of records with a state
+        """
+        await self.flush()
+        return await self._run(self._select_active)
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) \
+            -> typing.Optional[str]:
+        _address, record = await self._get_record(chat, user)
+        return record["state"] or self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        _address, record = await self._get_record(chat, user)
+        return copy.deepcopy(record["data"] or default or {})
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        address, record = await self._get_record(chat, user)
+        record["state"] = self.resolve_state(state)
+        self._mark_dirty(address, record)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        address, record = await self._get_record(chat, user)
+        record["data"] = copy.deepcopy(data or {})
+        self._mark_dirty(address, record)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        address, record = await self._get_record(chat, user)
+        record["data"].update(copy.deepcopy(data or {}), **kwargs)
+        self._mark_dirty(address, record)
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        await self.set_state(chat=chat, user=user, state=None)
+        if with_data:
+            await self.set_data(chat=chat, user=user, data={})
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) \
+            -> typing.Dict:
+        _address, record = await self._get_record(chat, user)
+        return copy.deepcopy(record["bucket"] or default or {})
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        address, record = await self._get_record(chat, user)
+        record["bucket"] = copy.deepcopy(bucket or {})
+        self._mark_dirty(address, record)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        address, record = await self._get_record(chat, user)
+        record["bucket"].update(copy.deepcopy(bucket or {}), **kwargs)
+        self._mark_dirty(address, record)
+
+    async def close(self):
+        # not cancelled: a batch cancelled while written would be lost
+        self._closing = True
+        if self._flusher is not None:
+            try:
+                await self._flusher
+            except Exception as err:  # what is left is flushed below
+                logger.error(f"Error in FSM records flusher: {err}")
+        await self.flush()
+        await self._run(self._close_connection)
+
+    async def wait_closed(self):
+        self._executor.shutdown(wait=True)
+
+
+def create_storage(config: Config) -> BaseStorage:
+    """FSM storage selected by `config.fsm_storage`
+    """
+    if config.fsm_storage == "memory":
+        return MemoryStorage()
+    if config.fsm_storage == "sqlite":
+        db_path = config.fsm_db_path or config.logs_path / "fsm.sqlite3"
+        return SQLiteStorage(db_path,
+                             ttl=config.fsm_session_ttl,
+                             flush_interval=config.fsm_flush_interval)
+    raise ValueError(f"Unknown FSM storage: {config.fsm_storage}")
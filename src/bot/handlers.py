@@ -1,28 +1,39 @@
 """Bot handlers
 """
 import logging
+import random
+import re
+from html import unescape
+from typing import Optional
 
 from aiogram import types
 from aiogram.dispatcher import filters, FSMContext
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, \
-    InputFile, InlineKeyboardMarkup, InlineKeyboardButton
+    InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.utils import exceptions
 
 
 from src.bot import utils
-from src.bot.dependencies import dp, config, bot
-from src.bot.states import QuizFlow, questions, theory_materials
+from src.bot.dependencies import dp, config, banks, edits, errors, media, \
+    search, sessions
+from src.bot.quiz import QuizBank, QuizBankUnavailable, decode_indexes, \
+    question_text
 
 logger = logging.getLogger(__name__)
 
+rng = random.Random()  # draws questions and answer order of sessions
+
 QUIZ_BUTTON = KeyboardButton(text="Квиз")
 RESULTS_BUTTON = KeyboardButton(text="Результаты")
 THEORY_BUTTON = KeyboardButton(text="Справочник")
 HELP_BUTTON = KeyboardButton(text="Помощь")
+LEADERBOARD_BUTTON = KeyboardButton(text="Рейтинг")
 
 MAIN_MENU = ReplyKeyboardMarkup(resize_keyboard=True,
                                 one_time_keyboard=False,
                                 row_width=2)
-MAIN_MENU.add(QUIZ_BUTTON, RESULTS_BUTTON, THEORY_BUTTON, HELP_BUTTON)
+MAIN_MENU.add(QUIZ_BUTTON, RESULTS_BUTTON, THEORY_BUTTON, LEADERBOARD_BUTTON,
+              HELP_BUTTON)
 
 
 @dp.message_handler(commands='start')
@@ -38,7 +49,11 @@ async def show_help(message: types.Message):
     """
     text = "<b>Помощь по командам бота</b>:\n" \
            "/start - вызвать главное меню\n" \
-           "/quiz или кнопка 'Квиз' в меню - начать прохождение викторины\n" \
+           "/quiz или кнопка 'Квиз' в меню - выбрать и начать " \
+           "викторину: весь квиз, случайные вопросы или вопросы по теме\n" \
+           "'Рейтинг' - лучшие результаты участников в каждом квизе\n" \
+           "/search <i>слово</i> - найти термин в справочнике, " \
+           "также можно набрать @имя_бота <i>слово</i> в любом чате\n" \
            "<b>Примечание</b>: когда вы выполняете квиз, " \
            "команды 'Квиз' и 'Справочник' становятся недоступны " \
            "до завершения прохождения. " \
@@ -51,16 +66,81 @@ async def show_help(message: types.Message):
 async def show_results(message: types.Message):
     """Show results
     """
-    all_results = utils.read_results(config=config)
-    user_answers = all_results["results"].get(str(message.from_user.id))
+    results = utils.async_results(config)
+    user_id = str(message.from_user.id)
+    user_answers = await results.get(user_id)
     if not user_answers:
         text = "Вы пока не принимали участия в квизе!\n"
     else:
-        text = utils.format_results_text(user_answers, include_header=False)
+        text = utils.format_results_text(utils.result_bank(user_answers),
+                                         user_answers, include_header=False)
+
+    history = await results.attempts(user_id)
+    # user is compared with others only in the quiz of the shown result,
+    # results without history are of the whole quiz of older versions
+    if history:
+        quiz_name, user_score = history[0].quiz, history[0].score
+    else:
+        quiz_name = banks.current.default_quiz.name
+        user_score = await results.get_total(user_id)
+    stats = utils.format_all_users_stats(
+        stats=await results.quiz_stats(quiz_name),
+        title=utils.quiz_title(quiz_name),
+        user_score=user_score
+    )
+    attempts = utils.format_attempts(history)
+
+    await message.answer(text=text + stats + attempts, parse_mode="HTML")
+
 
-    stats = utils.format_all_users_stats(results=all_results)
+async def leaderboard_text(user_id: str, quiz_name: str) -> str:
+    results = utils.async_results(config)
+    return utils.format_leaderboard(
+        title=utils.quiz_title(quiz_name),
+        leaders=await results.leaderboard(quiz_name),
+        standing=await results.standing(user_id, quiz_name)
+    )
 
-    await message.answer(text=text + stats, parse_mode="HTML")
+
+def leaderboard_keyboard(quiz_name: str) -> Optional[InlineKeyboardMarkup]:
+    """Buttons switching leaderboard to other quizzes
+    """
+    quizzes = banks.current.quizzes
+    if len(quizzes) == 1:
+        return None
+    inline_keyboard = InlineKeyboardMarkup()
+    for name, quiz in quizzes.items():
+        if name != quiz_name:
+            inline_keyboard.add(InlineKeyboardButton(
+                text=quiz.title, callback_data=f"top|{name}"
+            ))
+    return inline_keyboard
+
+
+@dp.message_handler(filters.Text(equals=LEADERBOARD_BUTTON.text), state="*")
+async def show_leaderboard(message: types.Message):
+    """Top users of the default quiz
+    """
+    quiz_name = banks.current.default_quiz.name
+    await message.answer(
+        text=await leaderboard_text(str(message.from_user.id), quiz_name),
+        reply_markup=leaderboard_keyboard(quiz_name),
+        parse_mode="HTML"
+    )
+
+
+@dp.callback_query_handler(filters.Text(startswith="top|"), state="*")
+async def switch_leaderboard(callback: types.CallbackQuery):
+    """Show leaderboard of another quiz in the same message
+    """
+    await callback.answer()
+    quiz_name = callback.data.split('|')[1]
+    edits.edit_text(
+        callback.message,
+        text=await leaderboard_text(str(callback.from_user.id), quiz_name),
+        reply_markup=leaderboard_keyboard(quiz_name),
+        parse_mode="HTML"
+    )
 
 
 @dp.message_handler(filters.Text(equals=THEORY_BUTTON.text))
@@ -68,8 +148,9 @@ async def show_theory_menu(message: types.Message):
     """Menu for choosing theory topic
     """
     inline_keyboard = InlineKeyboardMarkup()
-    text = "По какой теме хотите освежить свои знания? 🤓"
-    for _index, theory_material in theory_materials.items():
+    text = "По какой теме хотите освежить свои знания? 🤓\n" \
+           "Или найдите термин: /search лейшмания"
+    for _index, theory_material in banks.current.theory.items():
         inline_keyboard.add(InlineKeyboardButton(
             text=theory_material.button_text,
             callback_data=f"show_theory|{_index}"
@@ -77,19 +158,108 @@ async def show_theory_menu(message: types.Message):
     await message.answer(text=text, reply_markup=inline_keyboard)
 
 
+@dp.message_handler(commands='search')
+async def search_theory(message: types.Message):
+    """Passages of theory matching words after the command
+    """
+    query = message.get_args()
+    if not query:
+        await message.answer("Напишите, что найти в справочнике, "
+                             "например: /search лейшмания")
+        return
+    if not search.ready:
+        await message.answer("Справочник еще готовится к поиску, "
+                             "попробуйте через минуту")
+        return
+    hits = search.search(query)
+    if not hits:
+        await message.answer("В справочнике ничего не найдено 🤷")
+        return
+    theory = banks.current.theory
+    await message.answer(text=utils.format_search_hits(hits, theory),
+                         reply_markup=utils.search_keyboard(hits, theory),
+                         parse_mode="HTML")
+
+
+@dp.inline_handler()
+async def inline_search(inline_query: types.InlineQuery):
+    """Found theory passages as inline results
+    """
+    hits = search.search(inline_query.query, limit=10)
+    theory = banks.current.theory
+    results = []
+    for number, hit in enumerate(hits):
+        title = theory[hit.topic].button_text if hit.topic in theory \
+            else "Справочник"
+        results.append(types.InlineQueryResultArticle(
+            id=str(number), title=title,
+            description=unescape(re.sub(r"</?b>", "", hit.snippet)),
+            input_message_content=types.InputTextMessageContent(
+                utils.format_search_hits([hit], theory), parse_mode="HTML")
+        ))
+    await inline_query.answer(results, cache_time=300)
+
+
 @dp.message_handler(filters.Text(equals=QUIZ_BUTTON.text))
 @dp.message_handler(commands='quiz')
-async def start_quiz(message: types.Message):
-    """Entry point into quiz
+async def start_quiz(message: types.Message, state: FSMContext):
+    """Entry point into quiz: menu of quizzes if there are several
     """
-    # Init quiz flow from question 1
-    await QuizFlow.q_1.set()
-    question = questions.get('q_1')
+    bank = banks.current
+    if len(bank.quizzes) == 1:
+        await begin_quiz(message, state, bank, bank.default_quiz.name)
+        return
+
+    inline_keyboard = InlineKeyboardMarkup()
+    for name, quiz in bank.quizzes.items():
+        inline_keyboard.add(InlineKeyboardButton(
+            text=quiz.title, callback_data=f"quiz|{name}"
+        ))
+    await message.answer(text="Выберите квиз 📝", reply_markup=inline_keyboard)
+
+
+@dp.callback_query_handler(filters.Text(startswith="quiz|"))
+async def choose_quiz(callback: types.CallbackQuery, state: FSMContext):
+    """Start quiz chosen in menu
+    """
+    await callback.answer()
+    name = callback.data.split('|')[1]
+    bank = banks.current
+    if name not in bank.quizzes:
+        return  # quiz removed from reloaded bank
+    await edits.remove_keyboard(callback.message)
+    await begin_quiz(callback.message, state, bank, name)
 
-    inline_keyboard = utils.create_answers_keyboard(question)
 
-    await message.answer(text=utils.format_question_text(question,
-                                                         question_index="q_1"),
+async def begin_quiz(message: types.Message, state: FSMContext,
+                     bank: QuizBank, quiz_name: str):
+    """Draw questions of the quiz and send the first one
+    """
+    # the session stays on this bank version until it is finished
+    async with state.proxy() as data:
+        data.update(bank.new_session(quiz_name, rng))
+        data.state = bank.state_of(1)
+    await send_question(message, bank, data, position=1)
+
+
+async def send_question(message: types.Message, bank: QuizBank,
+                        user_data: dict, position: int):
+    """Send `position`-th question of the session
+    """
+    question_index = bank.session_questions(user_data)[position - 1]
+    question = bank.questions[question_index]
+    order = bank.session_order(user_data, position)
+    inline_keyboard = utils.create_answers_keyboard(bank, question_index,
+                                                    order=order)
+
+    if question.image_path is not None:
+        try:
+            await media.answer_photo(message, question.image_path)
+        except OSError as err:
+            # image of older bank version may be gone since
+            logger.error(f"Image of question {question_index} of bank "
+                         f"{bank.version} not sent: {err}")
+    await message.answer(text=question_text(question, position, order),
                          reply_markup=inline_keyboard,
                          parse_mode="HTML")
 
@@ -118,73 +288,82 @@ async def add_answer(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
     _, answer_index = callback.data.split('|')
+    answer_index = int(answer_index)
 
-    async with state.proxy() as data:
-        current_question_index = data.state.split(':')[1]
-        question = questions.get(current_question_index)
-        # get text of user answer using answer_index
-        user_answer = question.answers[int(answer_index)]
-
-        if data.get(current_question_index):
-            data[current_question_index].append(user_answer)
-        else:
-            data[current_question_index] = [user_answer]
-        already_answered = data[current_question_index]
-
-    inline_keyboard = utils.create_answers_keyboard(
-        question,
-        exclude_answers=already_answered
-    )
-
-    text = utils.format_question_text(question,
-                                      question_index=current_question_index)
-    text += '\n<i>Ваши ответы</i>:\n'
-    for user_answer in data.get(current_question_index):
-        text += f'{user_answer}\n'
-    await callback.message.edit_text(text=text,
-                                     reply_markup=inline_keyboard,
-                                     parse_mode="HTML")
+    user_id = str(callback.from_user.id)
+    async with utils.user_lock(user_id), state.proxy() as data:
+        if data.state is None:
+            return  # tap on a keyboard of already finished quiz
+        if edits.closed(callback.message):
+            return  # tap on a keyboard of a previous question
+        bank = utils.session_bank(data)
+        position_index = data.state.split(':')[1]
+        position = utils.number_from_index(position_index)
+        question_index = bank.session_questions(data)[position - 1]
+        question = bank.questions[question_index]
+        if answer_index >= len(question.answers):
+            return  # keyboard of another question
+
+        # selected answers are kept as code of indexes
+        # in order of selection: "20"
+        selection = utils.add_selection(
+            bank.session_selection(data, position), answer_index)
+        if selection is None:
+            return  # tap on outdated keyboard
+        data[position_index] = selection
+        order = bank.session_order(data, position)
+
+        inline_keyboard = utils.create_answers_keyboard(
+            bank, question_index,
+            selected_mask=utils.answers_mask(decode_indexes(selection)),
+            order=order
+        )
+        text = question_text(question, position, order) + \
+            '\n<i>Ваши ответы</i>:\n'
+        for answer in question.texts(selection):
+            text += f'{answer}\n'
+        # submitted under the lock, so edits follow selections in order;
+        # only the latest of quick taps is sent
+        edits.edit_text(callback.message, text=text,
+                        reply_markup=inline_keyboard, parse_mode="HTML")
 
 
 @dp.callback_query_handler(filters.Text(startswith="n|"), state="*")
 async def next_question(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
-    # remove keyboard on previous message
-    await callback.message.edit_reply_markup(reply_markup=None)
 
     user_id = str(callback.from_user.id)
-    await QuizFlow.next()  # move to next question
+    # repeated taps of the same user are handled one by one
+    async with utils.user_lock(user_id), state.proxy() as data:
+        if edits.closed(callback.message):
+            return  # repeated tap, quiz has moved on already
+        # remove keyboard on previous message after answers still
+        # waiting, answers tapped later are not applied or shown
+        await edits.remove_keyboard(callback.message)
+        if data.state is None:
+            return  # tap on a keyboard of already finished quiz
+        bank = utils.session_bank(data)
+        position = utils.number_from_index(data.state.split(':')[1]) + 1
 
-    async with state.proxy() as data:
         # finish quiz
-        if data.state is None:
+        if position > len(bank.session_questions(data)):
             # Memorize result and finish quiz
-            results = utils.read_results(config)
-            user_answers = data.as_dict()
-
-            results['results'][user_id] = user_answers
-            results['total'][user_id] = utils.count_score(user_answers)
-            utils.save_results(config, results)
-
-            result_text = utils.format_results_text(user_answers)
+            user_answers = utils.answers_from_indexes(bank, data.as_dict())
+            results = utils.async_results(config)
+            await results.commit(user_id, user_answers,
+                                 correct=bank.correct_questions(user_answers),
+                                 quiz=data.get("quiz",
+                                               bank.default_quiz.name),
+                                 name=callback.from_user.full_name)
+
+            result_text = utils.format_results_text(bank, user_answers)
             await callback.message.answer(result_text, parse_mode="HTML")
             await state.finish()
             return
+        data.state = bank.state_of(position)  # move to next question
 
     # continue quiz
-    question_index = data.state.split(':')[1]
-    question = questions.get(question_index)
-    inline_keyboard = utils.create_answers_keyboard(question)
-
-    if question.options.image_path is not None:
-        await callback.message.answer_photo(
-            InputFile(path_or_bytesio=question.options.image_path)
-        )
-    text = utils.format_question_text(question,
-                                      question_index=question_index)
-    await callback.message.answer(text=text,
-                                  reply_markup=inline_keyboard,
-                                  parse_mode="HTML")
+    await send_question(callback.message, bank, data, position)
 
 
 @dp.callback_query_handler(filters.Text(startswith="show_theory"))
@@ -193,16 +372,86 @@ async def show_theory(callback: types.CallbackQuery):
     """
     await callback.answer()
     _index = callback.data.split('|')[1]
-    theory_material = theory_materials.get(_index)
-    await callback.message.answer_document(
-        InputFile(theory_material.file_path),
+    theory_material = banks.current.theory.get(_index)
+    if theory_material is None:
+        return  # topic removed from reloaded bank
+    await media.answer_document(
+        callback.message, theory_material.file_path,
         caption=f"{theory_material.button_text}"
     )
 
 
+@sessions.reminder
+async def remind_unfinished_quiz(chat: int, user: int):
+    """Remind user idle in the middle of a quiz, once
+    """
+    state = dp.current_state(chat=chat, user=user)
+    current_state = await state.get_state()
+    if current_state is None:
+        return
+    data = await state.get_data()
+    try:
+        bank = utils.session_bank(data)
+    except QuizBankUnavailable:
+        await end_unavailable_session(chat, user)
+        return
+    position = utils.number_from_index(current_state.split(':')[1])
+    try:
+        await dp.bot.send_message(
+            chat,
+            f"Вы остановились на вопросе {position} из "
+            f"{len(bank.session_questions(data))} 🙂\n"
+            f"Ответьте на него, чтобы продолжить квиз, или выйдите "
+            f"из квиза командой /cancel"
+        )
+    except (exceptions.Unauthorized, exceptions.ChatNotFound):
+        pass  # bot blocked by user
+
+
+@sessions.expiry
+async def expire_unfinished_quiz(chat: int, user: int):
+    """End session abandoned in the middle of a quiz and free its data
+    """
+    async with utils.user_lock(str(user)):
+        if sessions.expiry_pending(chat, user):
+            return  # user came back meanwhile
+        await dp.current_state(chat=chat, user=user).finish()
+
+
+async def end_unavailable_session(chat: int, user: int):
+    """End session whose question bank version can not be loaded,
+    answers could not be checked against other questions
+    """
+    async with utils.user_lock(str(user)):
+        await dp.current_state(chat=chat, user=user).finish()
+    sessions.cancel(chat, user)
+    try:
+        await dp.bot.send_message(
+            chat,
+            "Вопросы квиза изменились, и продолжить начатый квиз нельзя 😔\n"
+            "Начните квиз заново, чтобы ответить на новые вопросы!",
+            reply_markup=MAIN_MENU
+        )
+    except (exceptions.Unauthorized, exceptions.ChatNotFound):
+        pass  # bot blocked by user
+
+
+@dp.errors_handler(exception=QuizBankUnavailable)
+async def unavailable_bank(update: types.Update, error):
+    """Session was started with question bank that can not be loaded
+    """
+    event = update.callback_query or update.message
+    if event is None:
+        return
+    chat = event.message.chat if update.callback_query else event.chat
+    await end_unavailable_session(chat.id, event.from_user.id)
+    return True  # handled, error is still logged and reported
+
+
 @dp.errors_handler()
 async def log_errors(update: types.Update, error):
-    """send errors to tg control chat
+    """send errors to tg control chat (grouped into periodic digests)
     """
-    msg = f"Error happened: {error}"
-    await bot.send_message(chat_id=config.control_chat_id, text=msg)
+    logger.error(f"Error processing update {update.update_id}: {error}",
+                 exc_info=error)
+    errors.report(update, error)
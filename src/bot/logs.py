@@ -0,0 +1,196 @@
+"""Logging off the event loop
+
+Handlers only put records into a queue, a background thread formats
+and writes them into logs_path/logs.txt, rotated by size or time and
+gzipped. Worker processes forward their records to the front process,
+so the file is written and rotated by one process only.
+"""
+import atexit
+import copy
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import shutil
+from pathlib import Path
+from typing import Dict, Optional
+
+from aiogram import types
+from aiogram.dispatcher.handler import current_handler
+
+from src.bot import metrics
+from src.config import Config
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+
+# set in worker processes before the app is imported
+_forward_queue: Optional[queue.Queue] = None
+_file_handler: Optional[logging.Handler] = None
+
+
+class ContextFilter(logging.Filter):
+    """Adds id of the user and name of the handler of the update being
+    processed, runs in the task that logs
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        user = types.User.get_current()
+        record.user_id = user.id if user is not None else None
+        handler = current_handler.get(None)
+        record.handler = getattr(handler, "__name__", None)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a share of INFO and lower records of chosen loggers
+    (and their children), e.g. {"aiohttp.access": 0.1}
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._cache: Dict[str, float] = {}
+
+    def _rate(self, name: str) -> float:
+        rate = self._cache.get(name)
+        if rate is None:
+            parent = name
+            while parent not in self.rates and "." in parent:
+                parent = parent.rsplit(".", 1)[0]
+            rate = self._cache[name] = self.rates.get(parent, 1)
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO:
+            return True
+        rate = self._rate(record.name)
+        if rate >= 1 or random.random() < rate:
+            return True
+        metrics.LOG_RECORDS_DROPPED.inc("sampled")
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = dict(time=self.formatTime(record), level=record.levelname,
+                     logger=record.name, message=record.getMessage())
+        for field in ("user_id", "handler"):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Puts records into a bounded queue without waiting, INFO and lower
+    records are dropped when the queue is full
+    """
+    traceback_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # message and traceback become text, so the record can be
+        # pickled and does not hold references to mutable arguments;
+        # traceback is kept apart from the message for json lines
+        exc_text = None
+        if record.exc_info:
+            exc_text = record.exc_text or \
+                self.traceback_formatter.formatException(record.exc_info)
+            record = copy.copy(record)
+            record.exc_info = None
+        record = super().prepare(record)
+        record.exc_text = exc_text
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno > logging.INFO:
+                self.queue.put(record)  # rare, worth the wait
+            else:
+                metrics.LOG_RECORDS_DROPPED.inc("queue_full")
+
+
+def _gzip_rotator(source: str, destination: str) -> None:
+    with open(source, "rb") as file, gzip.open(destination, "wb") as target:
+        shutil.copyfileobj(file, target)
+    os.remove(source)
+
+
+def create_file_handler(config: Config) -> logging.Handler:
+    """File handler with rotation and formatter set by config
+    """
+    path = config.logs_path / Path("logs.txt")
+    if config.log_rotation == "size":
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=config.log_max_bytes,
+            backupCount=config.log_backup_count, encoding="utf-8")
+    elif config.log_rotation == "time":
+        handler = logging.handlers.TimedRotatingFileHandler(
+            path, when=config.log_rotate_when,
+            backupCount=config.log_backup_count, encoding="utf-8")
+    elif config.log_rotation == "none":
+        handler = logging.FileHandler(path, encoding="utf-8")
+    else:
+        raise ValueError(f"Unknown log rotation: {config.log_rotation}")
+    if config.log_rotation != "none":
+        handler.namer = lambda name: name + ".gz"
+        handler.rotator = _gzip_rotator
+    if config.log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    elif config.log_format == "text":
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    else:
+        raise ValueError(f"Unknown log format: {config.log_format}")
+    return handler
+
+
+def listen(records: queue.Queue) -> logging.handlers.QueueListener:
+    """Write records from the queue (of worker processes) into the log
+    file of this process
+    """
+    listener = logging.handlers.QueueListener(records, _file_handler)
+    listener.start()
+    return listener
+
+
+def forward_to(records: queue.Queue) -> None:
+    """Send records of this process into the queue instead of the file,
+    must be called before `setup_logging`
+    """
+    global _forward_queue
+    _forward_queue = records
+
+
+def setup_logging(config: Config) -> None:
+    """Route records of the root logger through the queue
+    """
+    global _file_handler
+    if _forward_queue is not None:
+        records = _forward_queue
+    else:
+        records = queue.Queue(maxsize=config.log_queue_size)
+        _file_handler = create_file_handler(config)
+        listener = listen(records)
+        atexit.register(listener.stop)  # writes out what is queued
+        metrics.LOG_QUEUE.set_function(lambda: {(): records.qsize()})
+
+    handler = QueueHandler(records)
+    if config.log_sampling:
+        handler.addFilter(SamplingFilter(config.log_sampling))
+    handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(config.log_level)
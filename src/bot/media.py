@@ -0,0 +1,119 @@
+"""Cache of Telegram file ids for local media
+"""
+import asyncio
+import json
+import logging
+import os
+from json import JSONDecodeError
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional
+
+from aiogram import types
+from aiogram.types import InputFile
+from aiogram.utils import exceptions
+
+from src.bot.results import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+# errors meaning that cached file id can not be used anymore
+STALE_FILE_ID_ERRORS = (
+    exceptions.WrongFileIdentifier,
+    exceptions.WrongRemoteFileIdSpecified,
+    exceptions.TypeOfFileMismatch,
+)
+
+
+class MediaCache:
+    """Remembers file_id returned by Telegram on the first upload of
+    a local file and sends file_id afterwards instead of file bytes.
+
+    Ids are persisted in json file and bound to size and mtime of the
+    local file, so a replaced asset is uploaded again.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file_ids: Dict[str, dict] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                self._file_ids = json.load(file)
+        except FileNotFoundError:
+            pass
+        except JSONDecodeError as err:
+            logger.error(f"Error reading media cache, starting empty: {err}")
+
+    @staticmethod
+    def _key(file_path) -> str:
+        return str(file_path)
+
+    @staticmethod
+    def _signature(file_path) -> list:
+        stat = os.stat(file_path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def get(self, file_path) -> Optional[str]:
+        """Cached file id or None if file was not uploaded or changed
+        """
+        entry = self._file_ids.get(self._key(file_path))
+        if entry is None or entry["signature"] != self._signature(file_path):
+            return None
+        return entry["file_id"]
+
+    def set(self, file_path, file_id: str) -> None:
+        self._file_ids[self._key(file_path)] = dict(
+            file_id=file_id, signature=self._signature(file_path))
+        self._save()
+
+    def forget(self, file_path) -> None:
+        if self._file_ids.pop(self._key(file_path), None) is not None:
+            self._save()
+
+    def _save(self) -> None:
+        try:
+            write_json_atomic(self.path, self._file_ids, indent=4)
+        except OSError as err:
+            logger.error(f"Error saving media cache: {err}")
+
+    async def _send(self, send: Callable[..., Awaitable[types.Message]],
+                    file_path, extract_file_id: Callable, **kwargs) \
+            -> types.Message:
+        file_id = self.get(file_path)
+        if file_id is not None:
+            try:
+                return await send(file_id, **kwargs)
+            except STALE_FILE_ID_ERRORS as err:
+                logger.info(f"Cached file id of {file_path} rejected: {err}")
+                self.forget(file_path)
+
+        # concurrent first requests for the same file wait for one upload
+        key = self._key(file_path)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            file_id = self.get(file_path)
+            if file_id is not None:
+                return await send(file_id, **kwargs)
+            message = await send(InputFile(file_path), **kwargs)
+            self.set(file_path, extract_file_id(message))
+        return message
+
+    async def answer_photo(self, message: types.Message, file_path,
+                           **kwargs) -> types.Message:
+        """Reply with photo, uploading it only once
+        """
+        return await self._send(
+            message.answer_photo, file_path,
+            extract_file_id=lambda sent: sent.photo[-1].file_id,
+            **kwargs
+        )
+
+    async def answer_document(self, message: types.Message, file_path,
+                              **kwargs) -> types.Message:
+        """Reply with document, uploading it only once
+        """
+        return await self._send(
+            message.answer_document, file_path,
+            extract_file_id=lambda sent: sent.document.file_id,
+            **kwargs
+        )
@@ -0,0 +1,299 @@
+"""Latency and error metrics exposed in Prometheus text format
+"""
+import contextvars
+import inspect
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from aiogram import Dispatcher, types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[str, ...]
+
+
+def _format_labels(names: Tuple[str, ...], values: Labels,
+                   extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """Base of metrics; children are identified by label values"""
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}",
+                f"# TYPE {self.name} {self.kind}"]
+
+    async def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    async def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} "
+                f"{value}" for labels, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """Value is read at scrape time from a function (sync or async)
+    returning {label values: value}
+    """
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._function: Optional[Callable] = None
+
+    def set_function(self, function: Callable) -> None:
+        self._function = function
+
+    async def samples(self) -> List[str]:
+        if self._function is None:
+            return []
+        values = self._function()
+        if inspect.isawaitable(values):
+            values = await values
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} "
+                f"{value}" for labels, value in values.items()]
+
+
+class CounterFunction(Gauge):
+    """Counter maintained elsewhere, read at scrape time"""
+    kind = "counter"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        # per labels: counts per bucket (last one is +Inf) and sum
+        self._counts: Dict[Labels, List[int]] = {}
+        self._sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        counts = self._counts.get(labels)
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            self._sums[labels] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[labels] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def count(self, *labels: str) -> int:
+        return sum(self._counts.get(labels, ()))
+
+    async def samples(self) -> List[str]:
+        lines = []
+        for labels, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = _format_labels(self.labelnames, labels,
+                                               extra=f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} "
+                             f"{cumulative}")
+            suffix = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{suffix} {self._sums[labels]}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    async def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = await metric.samples()
+            except Exception as err:
+                logger.error(f"Error collecting {metric.name}: {err}")
+                continue
+            lines += metric.header() + samples
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HANDLER_LATENCY = registry.register(Histogram(
+    "quiz_handler_seconds", "Time spent in update handlers", ("handler",)))
+HANDLER_ERRORS = registry.register(Counter(
+    "quiz_handler_errors_total", "Exceptions raised by update handlers",
+    ("handler", "error")))
+API_LATENCY = registry.register(Histogram(
+    "quiz_telegram_request_seconds", "Telegram Bot API request latency",
+    ("method",)))
+API_ERRORS = registry.register(Counter(
+    "quiz_telegram_errors_total", "Failed Telegram Bot API requests",
+    ("method", "error")))
+RESULTS_LATENCY = registry.register(Histogram(
+    "quiz_results_seconds", "Results store reads and writes",
+    ("operation",)))
+FSM_SESSIONS = registry.register(Gauge(
+    "quiz_fsm_sessions", "Users with active quiz session"))
+SEND_QUEUE = registry.register(Gauge(
+    "quiz_send_queue_depth", "Outbound requests waiting for rate limiter",
+    ("priority",)))
+SEND_EVENTS = registry.register(CounterFunction(
+    "quiz_send_requests_total", "Outbound requests passed rate limiter",
+    ("outcome",)))
+MESSAGE_EDITS = registry.register(Counter(
+    "quiz_message_edits_total", "Message edits by outcome: sent, "
+    "coalesced (replaced by a newer edit), dropped (keyboard of closed "
+    "message), not_modified or failed",
+    ("outcome",)))
+LOG_QUEUE = registry.register(Gauge(
+    "quiz_log_queue_depth", "Log records waiting to be written"))
+LOG_RECORDS_DROPPED = registry.register(Counter(
+    "quiz_log_records_dropped_total", "Log records dropped by sampling "
+    "or because log queue was full", ("reason",)))
+SESSION_TIMERS = registry.register(Gauge(
+    "quiz_session_timers", "Pending reminders and expiries of sessions"))
+SESSION_EVENTS = registry.register(Counter(
+    "quiz_session_events_total", "Fired session timers: remind or expire",
+    ("event",)))
+
+# handler of the update processed by current task, used in error hook
+_current_handler: contextvars.ContextVar = contextvars.ContextVar(
+    "metrics_handler", default="unknown")
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Measures handler latency and counts handler errors
+    """
+
+    @staticmethod
+    def _start(data: dict) -> None:
+        handler = current_handler.get(None)
+        name = getattr(handler, "__name__", "unknown")
+        _current_handler.set(name)
+        data["metrics_handler"] = name
+        data["metrics_started"] = time.perf_counter()
+
+    @staticmethod
+    def _finish(data: dict) -> None:
+        started = data.get("metrics_started")
+        if started is not None:
+            HANDLER_LATENCY.observe(time.perf_counter() - started,
+                                    data["metrics_handler"])
+
+    async def on_process_message(self, message: types.Message,
+                                 data: dict) -> None:
+        self._start(data)
+
+    async def on_post_process_message(self, message: types.Message,
+                                      results: list, data: dict) -> None:
+        self._finish(data)
+
+    async def on_process_callback_query(self, callback: types.CallbackQuery,
+                                        data: dict) -> None:
+        self._start(data)
+
+    async def on_post_process_callback_query(
+            self, callback: types.CallbackQuery, results: list,
+            data: dict) -> None:
+        self._finish(data)
+
+    async def on_pre_process_error(self, update: types.Update,
+                                   error: BaseException, data: dict) -> None:
+        HANDLER_ERRORS.inc(_current_handler.get(), type(error).__name__)
+
+
+async def active_sessions(storage) -> Dict[Labels, int]:
+    if hasattr(storage, "active_sessions"):
+        return {(): await storage.active_sessions()}
+    if isinstance(storage, MemoryStorage):
+        return {(): sum(1 for users in storage.data.values()
+                        for record in users.values()
+                        if record.get("state") is not None)}
+    return {}
+
+
+def setup_metrics(dispatcher: Dispatcher) -> None:
+    """Register middleware and gauges reading state of the dispatcher
+    """
+    dispatcher.middleware.setup(MetricsMiddleware())
+    FSM_SESSIONS.set_function(lambda: active_sessions(dispatcher.storage))
+
+    scheduler = getattr(dispatcher.bot, "scheduler", None)
+    if scheduler is not None:
+        SEND_QUEUE.set_function(lambda: {
+            (str(priority),): depth
+            for priority, depth in scheduler.queue_depths().items()})
+        SEND_EVENTS.set_function(lambda: {
+            ("sent",): scheduler.metrics.sent,
+            ("flood_error",): scheduler.metrics.flood_errors,
+            ("throttled",): scheduler.metrics.throttled})
+
+
+_servers: List[web.AppRunner] = []
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Serve metrics on http://host:port/metrics
+    """
+    async def handle(_request: web.Request) -> web.Response:
+        return web.Response(text=await registry.render(),
+                            content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    _servers.append(runner)
+    logger.info(f"Metrics are served on http://{host}:{port}/metrics")
+    return runner
+
+
+async def stop_metrics_servers() -> None:
+    while _servers:
+        await _servers.pop().cleanup()
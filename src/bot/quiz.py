@@ -0,0 +1,547 @@
+"""Quiz model compiled from question bank file
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple, \
+    Type, Union
+
+from aiogram.dispatcher.filters.state import StatesGroup
+
+from src.bot.results import write_atomic
+from src.bot.states import Options, Question, Quiz, Theory, make_quiz_flow
+
+logger = logging.getLogger(__name__)
+
+
+class QuizBankError(ValueError):
+    """Question bank file can not be read or is not valid"""
+
+
+class QuizBankUnavailable(QuizBankError):
+    """Version of the bank a session was started with can not be loaded"""
+
+
+# Answer indexes are kept in sessions and results as strings with
+# one character per index: selected answers "20" (in order of
+# selection) or permutation of shown answers "3021"
+INDEX_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+MAX_ANSWERS = len(INDEX_DIGITS)
+_DIGIT_VALUES = {digit: value for value, digit in enumerate(INDEX_DIGITS)}
+
+# answers of one question: code of indexes, or texts in older results
+Answer = Union[str, List[str]]
+
+
+def encode_indexes(indexes: List[int]) -> str:
+    return "".join(INDEX_DIGITS[index] for index in indexes)
+
+
+def decode_indexes(code: str) -> List[int]:
+    return [_DIGIT_VALUES[digit] for digit in code]
+
+
+@dataclass(frozen=True, eq=False)  # hashed by identity, used in caches
+class CompiledQuestion:
+    """Question with everything that handlers need precomputed
+    """
+    index: str  # question id, q_1, q_2, ... if not set in bank
+    number: int  # position in bank file
+    question: Question
+    text: str  # rendered html: header, question and answers if repeated
+    answers: Tuple[str, ...]
+    correct_answer: Tuple[str, ...]
+    correct_set: FrozenSet[str]
+    correct_indexes: Tuple[int, ...]
+    correct_code: str  # correct indexes encoded
+    correct_digits: FrozenSet[str]
+    ordered: bool  # whether answers order matter
+    image_path: Optional[Path]
+
+    def is_correct(self, answer: Answer) -> bool:
+        """Whether code of answer indexes or answer texts is correct,
+        in order if the question checks it, without decoding or building
+        set of correct answers on every call
+        """
+        if isinstance(answer, str):
+            if self.ordered:
+                return answer == self.correct_code
+            return frozenset(answer) == self.correct_digits
+        if self.ordered:
+            return tuple(answer) == self.correct_answer
+        return frozenset(answer) == self.correct_set
+
+    def encode(self, answer: List[str]) -> Optional[str]:
+        """Code of answer given as texts, None if some text is not
+        among answers of the question
+        """
+        try:
+            return encode_indexes([self.answers.index(text)
+                                   for text in answer])
+        except ValueError:
+            return None
+
+    def texts(self, answer: Answer) -> List[str]:
+        if isinstance(answer, str):
+            return [self.answers[index] for index in decode_indexes(answer)]
+        return list(answer)
+
+    def shown_answers(self, order: str = "") -> List[Tuple[int, str]]:
+        """(answer index, text) in the order answers are shown
+        """
+        if not order:
+            return list(enumerate(self.answers))
+        return [(index, self.answers[index])
+                for index in decode_indexes(order)]
+
+
+def render_question(question: Question, number: int,
+                    answers: Optional[List[str]] = None) -> str:
+    """Render question in html, check for additional options
+    """
+    header = f"👉 <b>Вопрос №{number}</b>: "
+
+    if question.options.repeat_answers:
+        extra = "\n\n<i>Варианты ответа</i>:\n"
+        extra += "".join(f"{answer}\n" for answer
+                         in (answers or question.answers))
+    else:
+        extra = "\n"
+
+    return header + question.text + extra
+
+
+@lru_cache(maxsize=4096)
+def question_text(question: CompiledQuestion, position: int,
+                  order: str = "") -> str:
+    """Text of question shown `position`-th in a session
+    """
+    if position == question.number and not order:
+        return question.text
+    return render_question(question.question, position,
+                           [answer for _, answer
+                            in question.shown_answers(order)])
+
+
+@lru_cache(maxsize=1024)
+def result_line(position: int, correct: bool) -> str:
+    return f"Вопрос {position} - {'✅' if correct else '❌'}\n"
+
+
+def compile_question(index: str, question: Question,
+                     number: int) -> CompiledQuestion:
+    correct_indexes = tuple(question.answers.index(answer)
+                            for answer in question.correct_answer)
+    correct_code = encode_indexes(list(correct_indexes))
+    return CompiledQuestion(
+        index=index,
+        number=number,
+        question=question,
+        text=render_question(question, number),
+        answers=tuple(question.answers),
+        correct_answer=tuple(question.correct_answer),
+        correct_set=frozenset(question.correct_answer),
+        correct_indexes=correct_indexes,
+        correct_code=correct_code,
+        correct_digits=frozenset(correct_code),
+        ordered=bool(question.options.check_answer_order),
+        image_path=question.options.image_path,
+    )
+
+
+def compile_quiz(definitions: Dict[str, Question]) \
+        -> Dict[str, CompiledQuestion]:
+    """Compile questions keeping their order
+    """
+    return {index: compile_question(index, question, number)
+            for number, (index, question)
+            in enumerate(definitions.items(), start=1)}
+
+
+@dataclass(frozen=True, eq=False)
+class QuizDefinition:
+    """Quiz user can choose: questions are drawn from `pool`
+    """
+    name: str
+    title: str
+    pool: Tuple[str, ...]  # question ids
+    size: Optional[int]  # random subset of pool, whole pool in order if None
+    shuffle_answers: bool
+
+    @property
+    def length(self) -> int:
+        return len(self.pool) if self.size is None \
+            else min(self.size, len(self.pool))
+
+    def draw(self, rng: random.Random) -> List[str]:
+        """Question ids for a new session, O(size) for any pool
+        """
+        if self.size is None:
+            return list(self.pool)
+        return rng.sample(self.pool, self.length)
+
+
+@dataclass(frozen=True, eq=False)  # hashed by identity, used in caches
+class QuizBank:
+    """One version of the quiz: pool of questions, quizzes drawn
+    from it, theory and states of the flow.
+
+    Session keeps ids of its questions, state QuizFlow:q_<position>
+    and answers of k-th question under "q_<k>"
+    """
+    version: str
+    questions: Dict[str, CompiledQuestion]
+    theory: Dict[str, Theory]
+    quizzes: Dict[str, QuizDefinition]
+    flow: Type[StatesGroup]
+
+    @property
+    def default_quiz(self) -> QuizDefinition:
+        return next(iter(self.quizzes.values()))
+
+    def state_of(self, position: int) -> str:
+        return getattr(self.flow, f"q_{position}").state
+
+    def new_session(self, quiz_name: str, rng: random.Random) -> dict:
+        """FSM data of a session of the quiz
+        """
+        quiz = self.quizzes[quiz_name]
+        question_ids = quiz.draw(rng)
+        data = {"bank": self.version, "quiz": quiz.name}
+        if quiz.size is not None:  # otherwise questions are the pool
+            data["questions"] = question_ids
+        if quiz.shuffle_answers:
+            orders = []
+            for question_id in question_ids:
+                order = list(range(len(self.questions[question_id].answers)))
+                rng.shuffle(order)
+                orders.append(encode_indexes(order))
+            data["orders"] = orders
+        return data
+
+    def session_questions(self, user_data: dict) -> Sequence[str]:
+        """Question ids of the session: drawn subset or the pool of quiz,
+        sessions started before quizzes were introduced pass the default
+        """
+        questions = user_data.get("questions")
+        if questions:
+            return questions
+        quiz = self.quizzes.get(user_data.get("quiz")) or self.default_quiz
+        return quiz.pool
+
+    @staticmethod
+    def session_order(user_data: dict, position: int) -> str:
+        orders = user_data.get("orders")
+        return orders[position - 1] if orders else ""
+
+    @staticmethod
+    def session_selection(user_data: dict, position: int) -> str:
+        """Code of answers selected for `position`-th question
+        """
+        return user_data.get(f"q_{position}", "")
+
+    def session_answers(self, user_data: dict) -> Dict[str, str]:
+        """Answers to every question of the session to be stored in
+        results: {"bank": version, question id: code of indexes},
+        skipped questions get ""
+        """
+        answers = {"bank": self.version}
+        for position, question_id in enumerate(
+                self.session_questions(user_data), start=1):
+            answers[question_id] = self.session_selection(user_data, position)
+        return answers
+
+    def encode_answers(self, user_answers: dict) -> dict:
+        """Compact form of results stored by older versions with answer
+        texts. Those were results of the whole bank keeping answered
+        questions only, skipped ones get "". Texts that are not in this
+        bank are kept as they are. Returns `user_answers` itself if they
+        are already compact
+        """
+        if "bank" in user_answers:
+            return user_answers
+        encoded = {"bank": self.version}
+        encoded.update((question_index, "")
+                       for question_index in self.questions)
+        for question_index, answer in user_answers.items():
+            if question_index in self.questions:
+                answer = self.questions[question_index].encode(answer) \
+                    or answer
+            encoded[question_index] = answer
+        return encoded
+
+    def correct_questions(self, user_answers: dict) -> List[str]:
+        """Ids of questions answered correctly
+        """
+        return [question_index
+                for question_index, answer in user_answers.items()
+                if question_index in self.questions
+                and self.questions[question_index].is_correct(answer)]
+
+
+def _validate_question(number: int, question: Question) -> None:
+    def fail(reason: str):
+        raise QuizBankError(f"Question {number}: {reason}")
+
+    if not question.text.strip():
+        fail("empty text")
+    if not question.answers:
+        fail("no answers")
+    if len(question.answers) > MAX_ANSWERS:
+        fail(f"more than {MAX_ANSWERS} answers")
+    if len(set(question.answers)) != len(question.answers):
+        fail("answers repeat")
+    if not question.correct_answer:
+        fail("no correct answer")
+    unknown = [answer for answer in question.correct_answer
+               if answer not in question.answers]
+    if unknown:
+        fail(f"correct answers not among answers: {unknown}")
+    if len(set(question.correct_answer)) != len(question.correct_answer):
+        fail("correct answers repeat")
+
+
+def _asset_problem(path: Path) -> Optional[str]:
+    try:
+        status = path.stat()
+    except OSError:
+        return "not found"
+    if not stat.S_ISREG(status.st_mode):
+        return "is not a file"
+    if not status.st_size:
+        return "is empty"
+    if not os.access(path, os.R_OK):
+        return "is not readable"
+    return None
+
+
+def check_assets(assets: Dict[Path, str]) -> None:
+    """Check that files the bank refers to ({path: what refers to it})
+    can be sent. Files are checked concurrently, as stat may block on
+    a mounted volume, and all problems are reported at once
+    """
+    if not assets:
+        return
+    with ThreadPoolExecutor(min(len(assets), 8)) as pool:
+        problems = [f"{owner}: {path} {problem}" for (path, owner), problem
+                    in zip(assets.items(), pool.map(_asset_problem, assets))
+                    if problem is not None]
+    if problems:
+        raise QuizBankError("; ".join(problems))
+
+
+def parse_bank(content: bytes, suffix: str, base_path: Path,
+               check_files: bool = True) -> QuizBank:
+    """Build and validate quiz from bank file content.
+    Files are referenced relative to `base_path`, `check_files` off
+    skips checking they exist
+    """
+    try:
+        if suffix in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise QuizBankError("PyYAML is required for yaml banks")
+            data = yaml.safe_load(content)
+        else:
+            data = json.loads(content)
+    except QuizBankError:
+        raise
+    except Exception as err:
+        raise QuizBankError(f"Can not parse bank: {err}")
+
+    try:
+        questions = {}
+        assets: Dict[Path, str] = {}
+        for number, item in enumerate(data["questions"], start=1):
+            options = dict(item.get("options") or {})
+            if options.get("image_path"):
+                options["image_path"] = base_path / options["image_path"]
+            question = Question(text=item["text"],
+                                answers=list(item["answers"]),
+                                correct_answer=list(item["correct_answer"]),
+                                options=Options(**options),
+                                topics=list(item.get("topics") or []))
+            _validate_question(number, question)
+            if question.options.image_path is not None:
+                assets.setdefault(question.options.image_path,
+                                  f"Question {number}: image")
+            question_id = str(item.get("id") or f"q_{number}")
+            if question_id == "bank":  # key of version in results
+                raise QuizBankError(f"Question {number}: id bank "
+                                    f"is reserved")
+            if question_id in questions:
+                raise QuizBankError(f"Question {number}: "
+                                    f"id {question_id} repeats")
+            questions[question_id] = question
+
+        theory = {}
+        for index, item in (data.get("theory") or {}).items():
+            file_path = base_path / item["file_path"]
+            assets.setdefault(file_path, f"Theory {index}")
+            theory[index] = Theory(button_text=item["button_text"],
+                                   file_path=file_path)
+
+        # without quizzes section the bank is one quiz of all questions
+        quizzes = {name: Quiz(**item) for name, item
+                   in (data.get("quizzes") or {"main": {"title": "Квиз"}})
+                   .items()}
+    except (KeyError, TypeError) as err:
+        raise QuizBankError(f"Wrong bank structure: {err!r}")
+    if not questions:
+        raise QuizBankError("Bank has no questions")
+    if check_files:
+        check_assets(assets)
+    unknown = [topic for question in questions.values()
+               for topic in question.topics if topic not in theory]
+    if unknown:
+        raise QuizBankError(f"Unknown topics of questions: {unknown}")
+
+    definitions = {name: _define_quiz(name, quiz, questions, theory)
+                   for name, quiz in quizzes.items()}
+    return QuizBank(version=hashlib.sha256(content).hexdigest()[:12],
+                    questions=compile_quiz(questions),
+                    theory=theory,
+                    quizzes=definitions,
+                    flow=make_quiz_flow(max(definition.length for definition
+                                            in definitions.values())))
+
+
+def _define_quiz(name: str, quiz: Quiz, questions: Dict[str, Question],
+                 theory: Dict[str, Theory]) -> QuizDefinition:
+    if quiz.topic is None:
+        pool = tuple(questions)
+    elif quiz.topic not in theory:
+        raise QuizBankError(f"Quiz {name}: unknown topic {quiz.topic}")
+    else:
+        pool = tuple(question_id for question_id, question
+                     in questions.items() if quiz.topic in question.topics)
+    if not pool:
+        raise QuizBankError(f"Quiz {name} has no questions")
+    if quiz.size is not None and quiz.size < 1:
+        raise QuizBankError(f"Quiz {name}: size must be positive")
+    return QuizDefinition(name=name, title=quiz.title, pool=pool,
+                          size=quiz.size,
+                          shuffle_answers=quiz.shuffle_answers)
+
+
+class QuizBanks:
+    """Current question bank and previous versions that unfinished
+    sessions still use.
+
+    `reload` swaps in a new bank if the file changed and is valid,
+    an invalid file is reported and the current bank stays. Every
+    loaded version is copied to `archive`, so sessions started before
+    a restart are finished with the questions they were started with.
+    With `update_archive` off the archive is only read, for tools that
+    run next to the bot.
+    """
+
+    def __init__(self, path: Path, archive: Optional[Path] = None,
+                 update_archive: bool = True):
+        self.path = path
+        self.archive = archive
+        self.update_archive = update_archive
+        self._versions: Dict[str, QuizBank] = {}
+        self._signature: Optional[tuple] = None
+        self._watcher: Optional[asyncio.Task] = None
+        self.current = self._load()
+
+    def _file_signature(self) -> tuple:
+        stat = os.stat(self.path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _load(self) -> QuizBank:
+        # remembered before parsing, so invalid file is reported once
+        self._signature = self._file_signature()
+        content = self.path.read_bytes()
+        version = hashlib.sha256(content).hexdigest()[:12]
+        if version in self._versions:  # touched, but not changed
+            return self._versions[version]
+        bank = parse_bank(content, self.path.suffix, self.path.parent)
+        self._versions[bank.version] = bank
+        self._archive(bank.version, content)
+        return bank
+
+    def _archive(self, version: str, content: bytes) -> None:
+        if self.archive is None or not self.update_archive:
+            return
+        target = self.archive / f"{version}{self.path.suffix}"
+        if target.exists():
+            return
+        try:
+            self.archive.mkdir(parents=True, exist_ok=True)
+            # write_atomic opens text file, the bank is kept byte for byte
+            write_atomic(target, lambda file: file.buffer.write(content))
+        except OSError as err:
+            logger.error(f"Error archiving question bank {version}: {err}")
+
+    def get(self, version: Optional[str],
+            fallback: bool = False) -> QuizBank:
+        """Bank of given version, current one for data of older versions
+        without it. Raises QuizBankUnavailable if the version can not be
+        loaded, with `fallback` returns current bank instead, for
+        showing stored results only
+        """
+        if version is None:
+            return self.current
+        bank = self._versions.get(version)
+        if bank is not None:
+            return bank
+        try:
+            if self.archive is None:
+                raise QuizBankError("archive of versions is off")
+            path = self.archive / f"{version}{self.path.suffix}"
+            # validated when first loaded, files it refers to may have
+            # been renamed or removed since
+            bank = parse_bank(path.read_bytes(), self.path.suffix,
+                              self.path.parent, check_files=False)
+        except (OSError, QuizBankError) as err:
+            logger.error(f"Question bank {version} unavailable: {err}")
+            if fallback:
+                return self.current
+            raise QuizBankUnavailable(f"Question bank {version} "
+                                      f"unavailable: {err}") from err
+        self._versions[version] = bank
+        return bank
+
+    def reload(self) -> bool:
+        """Load bank file if it changed, returns whether bank was swapped
+        """
+        try:
+            if self._file_signature() == self._signature:
+                return False
+            bank = self._load()
+        except (OSError, QuizBankError) as err:
+            logger.error(f"Question bank not reloaded: {err}")
+            return False
+        if bank is self.current:
+            return False
+        # sessions keep the version they were started with
+        self.current = bank
+        logger.info(f"Question bank {bank.version} loaded, "
+                    f"{len(bank.questions)} questions")
+        return True
+
+    async def _watch(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            self.reload()
+
+    def start_watching(self, interval: float) -> None:
+        if self._watcher is None:
+            self._watcher = asyncio.get_event_loop().create_task(
+                self._watch(interval))
+
+    def stop_watching(self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
@@ -0,0 +1,1193 @@
+"""Results storage backends
+"""
+import asyncio
+import copy
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right, insort
+from dataclasses import dataclass, field
+from functools import partial
+from json import JSONDecodeError
+from pathlib import Path
+from typing import IO, Callable, Dict, Iterator, List, NamedTuple, \
+    Optional, Tuple
+
+from src.bot import metrics
+from src.config import Config
+
+logger = logging.getLogger(__name__)
+
+# Returns indexes of questions (q_1, q_2, ...) answered correctly
+Scorer = Callable[[dict], List[str]]
+# Converts answers stored in older format, returns the same dict
+# if they need no conversion
+Encoder = Callable[[dict], dict]
+
+
+SQLITE_RESULTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    user_id TEXT PRIMARY KEY,
+    answers TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    correct TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS score_histogram (
+    score INTEGER PRIMARY KEY,
+    users INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS question_correct (
+    question TEXT PRIMARY KEY,
+    users INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS attempts (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    quiz TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    questions INTEGER NOT NULL,
+    finished_at REAL NOT NULL,
+    name TEXT NOT NULL,
+    answers TEXT
+);
+CREATE INDEX IF NOT EXISTS attempts_by_user
+    ON attempts (user_id, finished_at);
+CREATE TABLE IF NOT EXISTS best_attempts (
+    quiz TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    questions INTEGER NOT NULL,
+    finished_at REAL NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (quiz, user_id)
+);
+CREATE INDEX IF NOT EXISTS best_attempts_by_score
+    ON best_attempts (quiz, score DESC, finished_at);
+CREATE TABLE IF NOT EXISTS best_histogram (
+    quiz TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    users INTEGER NOT NULL,
+    PRIMARY KEY (quiz, score)
+);
+"""
+
+
+class ResultsUnavailable(Exception):
+    """Raise when can not get results
+    """
+
+
+def write_atomic(path: Path, write: Callable[[IO[str]], None]) -> None:
+    """Write file through `write` into a temporary file of unique name
+    and rename it over the target, so readers never see half-written
+    file, even when several processes write it at once
+    """
+    descriptor, tmp_path = tempfile.mkstemp(dir=path.parent,
+                                            prefix=path.name + ".",
+                                            suffix=".tmp")
+    try:
+        with open(descriptor, "w", encoding="utf-8") as file:
+            write(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_json_atomic(path: Path, data: dict, **dump_kwargs) -> None:
+    """Write json atomically, see `write_atomic`
+    """
+    write_atomic(path, lambda file: json.dump(data, file, ensure_ascii=False,
+                                              **dump_kwargs))
+
+
+@dataclass
+class ResultsStats:
+    """Aggregate over latest results of all participants, maintained
+    incrementally on every completion, or over best scores in one quiz
+    """
+    participants: int = 0
+    score_sum: int = 0
+    histogram: Dict[int, int] = field(default_factory=dict)  # score: users
+    question_correct: Dict[str, int] = field(default_factory=dict)
+
+    def include(self, correct: List[str], sign: int = 1) -> None:
+        """Add (sign=1) or remove (sign=-1) result of one participant
+        """
+        score = len(correct)
+        self.participants += sign
+        self.score_sum += sign * score
+        self.histogram[score] = self.histogram.get(score, 0) + sign
+        for question_index in correct:
+            self.question_correct[question_index] = \
+                self.question_correct.get(question_index, 0) + sign
+
+    def average(self) -> float:
+        if not self.participants:
+            return 0.0
+        return self.score_sum / self.participants
+
+    def correct_rate(self, question_index: str) -> float:
+        """Share of participants that answered question correctly
+        """
+        if not self.participants:
+            return 0.0
+        return self.question_correct.get(question_index, 0) / self.participants
+
+    def percentile_rank(self, score: int) -> float:
+        """Percent of participants with lower score (ties count as half).
+        Costs O(number of distinct scores)
+        """
+        if not self.participants:
+            return 0.0
+        below = sum(count for _score, count in self.histogram.items()
+                    if _score < score)
+        equal = self.histogram.get(score, 0)
+        return 100 * (below + equal / 2) / self.participants
+
+    def as_dict(self) -> dict:
+        return dict(participants=self.participants, score_sum=self.score_sum,
+                    histogram=self.histogram,
+                    question_correct=self.question_correct)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ResultsStats":
+        return cls(participants=data["participants"],
+                   score_sum=data["score_sum"],
+                   histogram={int(score): count for score, count
+                              in data["histogram"].items()},
+                   question_correct=dict(data["question_correct"]))
+
+
+class Attempt(NamedTuple):
+    """Completed quiz attempt (tuple keeps history of many attempts
+    small in memory)
+    """
+    user_id: str
+    quiz: str
+    score: int
+    questions: int
+    finished_at: float  # unix time
+    name: str = ""
+
+    @classmethod
+    def from_record(cls, record: dict) -> "Attempt":
+        return cls(user_id=record["user_id"], quiz=record["quiz"],
+                   score=record["total"], questions=record["questions"],
+                   finished_at=record["finished_at"],
+                   name=record.get("name", ""))
+
+
+class Standing(NamedTuple):
+    best: Attempt
+    rank: int  # users with the same best score share rank
+    participants: int
+
+
+class Leaderboard:
+    """Best attempt of every user in every quiz.
+
+    Users are grouped by best score and distinct scores are kept
+    sorted, so rank of a user costs O(number of distinct scores) and
+    top N costs O(N + distinct scores) regardless of the number of
+    users and attempts. Within a score users are ordered by the time
+    they reached it
+    """
+
+    def __init__(self):
+        self._best: Dict[Tuple[str, str], Attempt] = {}
+        # quiz: sorted distinct best scores and users per score
+        self._scores: Dict[str, List[int]] = {}
+        self._buckets: Dict[str, Dict[int, Dict[str, Attempt]]] = {}
+
+    def add(self, attempt: Attempt) -> None:
+        key = (attempt.quiz, attempt.user_id)
+        previous = self._best.get(key)
+        if previous is not None and previous.score >= attempt.score:
+            return
+        scores = self._scores.setdefault(attempt.quiz, [])
+        buckets = self._buckets.setdefault(attempt.quiz, {})
+        if previous is not None:
+            bucket = buckets[previous.score]
+            del bucket[attempt.user_id]
+            if not bucket:
+                del buckets[previous.score]
+                del scores[bisect_left(scores, previous.score)]
+        if attempt.score not in buckets:
+            insort(scores, attempt.score)
+            buckets[attempt.score] = {}
+        buckets[attempt.score][attempt.user_id] = attempt
+        self._best[key] = attempt
+
+    def top(self, quiz: str, limit: int) -> List[Attempt]:
+        leaders = []
+        buckets = self._buckets.get(quiz, {})
+        for score in reversed(self._scores.get(quiz, [])):
+            for attempt in buckets[score].values():
+                if len(leaders) == limit:
+                    return leaders
+                leaders.append(attempt)
+        return leaders
+
+    def stats(self, quiz: str) -> ResultsStats:
+        """Aggregate over best scores of users in the quiz
+        """
+        stats = ResultsStats()
+        for score, bucket in self._buckets.get(quiz, {}).items():
+            stats.histogram[score] = len(bucket)
+            stats.participants += len(bucket)
+            stats.score_sum += score * len(bucket)
+        return stats
+
+    def standing(self, user_id: str, quiz: str) -> Optional[Standing]:
+        best = self._best.get((quiz, user_id))
+        if best is None:
+            return None
+        scores = self._scores[quiz]
+        buckets = self._buckets[quiz]
+        above = sum(len(buckets[score]) for score
+                    in scores[bisect_right(scores, best.score):])
+        return Standing(best=best, rank=above + 1,
+                        participants=sum(map(len, buckets.values())))
+
+
+class ResultsStore(ABC):
+    """Backend that keeps results of completed quizzes.
+
+    Adding result is split into phases, so that async layer can run
+    disk I/O in a thread and keep in-memory state on the event loop:
+    `prepare` -> `persist` (I/O) -> `apply`
+    """
+    in_memory = True  # reads do not touch disk
+
+    def __init__(self, scorer: Scorer):
+        self.scorer = scorer
+
+    @abstractmethod
+    def get(self, user_id: str) -> Optional[dict]:
+        """Latest answers of user or None"""
+
+    @abstractmethod
+    def get_total(self, user_id: str) -> Optional[int]:
+        """Latest score of user or None"""
+
+    @abstractmethod
+    def stats(self) -> ResultsStats:
+        """Aggregate statistics over all participants"""
+
+    @abstractmethod
+    def quiz_stats(self, quiz: str) -> ResultsStats:
+        """Statistics over best scores of participants of the quiz"""
+
+    @abstractmethod
+    def attempts(self, user_id: str, limit: int) -> List[Attempt]:
+        """Latest attempts of user, newest first"""
+
+    @abstractmethod
+    def leaderboard(self, quiz: str, limit: int) -> List[Attempt]:
+        """Best attempts of top `limit` users in the quiz"""
+
+    @abstractmethod
+    def standing(self, user_id: str, quiz: str) -> Optional[Standing]:
+        """Best attempt of user in the quiz and its rank"""
+
+    @abstractmethod
+    def as_dict(self) -> dict:
+        """All results in a legacy form {"results": {...}, "total": {...}}
+        """
+
+    @abstractmethod
+    def replace(self, results: dict) -> None:
+        """Replace all results with provided legacy form dict"""
+
+    def prepare(self, user_id: str, answers: dict,
+                correct: Optional[List[str]] = None,
+                quiz: Optional[str] = None, name: str = "") -> dict:
+        """Build record of completed attempt, `correct` questions
+        are computed by scorer if not provided. Record without `quiz`
+        (rewritten result) is not added to history of attempts"""
+        if correct is None:
+            correct = self.scorer(answers)
+        record = dict(user_id=user_id, answers=answers, total=len(correct),
+                      correct=correct)
+        if quiz is not None:
+            # answers hold question ids and version of question bank
+            record.update(quiz=quiz, name=name, finished_at=time.time(),
+                          questions=sum(1 for index in answers
+                                        if index != "bank"))
+        return record
+
+    @abstractmethod
+    def persist(self, records: List[dict]) -> None:
+        """Durably write records, raise OSError on failure"""
+
+    def apply(self, records: List[dict]) -> None:
+        """Update in-memory state with persisted records"""
+
+    def compaction_due(self) -> bool:
+        return False
+
+    def take_snapshot(self) -> dict:
+        """Copy of state to be written by `write_snapshot`"""
+        raise NotImplementedError
+
+    def write_snapshot(self, snapshot: dict) -> None:
+        """Replace persisted state with snapshot"""
+        raise NotImplementedError
+
+    def compact(self) -> None:
+        self.write_snapshot(self.take_snapshot())
+
+    def add(self, user_id: str, answers: dict) -> None:
+        """Record completed attempt of user (blocking)"""
+        self.add_many([(user_id, answers)])
+
+    def add_many(self, attempts: List[Tuple[str, dict]]) -> None:
+        records = [self.prepare(user_id, answers)
+                   for user_id, answers in attempts]
+        try:
+            self.persist(records)
+        except (OSError, ResultsUnavailable) as err:
+            logger.error(f"Error saving results: {err}")
+            logger.info(f"Results not saved: {records}")
+            raise ResultsUnavailable
+        self.apply(records)
+        if self.compaction_due():
+            self.compact()
+
+    def migrate(self, encoder: Encoder) -> int:
+        """Convert answers of stored results with `encoder`,
+        returns number of converted results
+        """
+        results = self.as_dict()
+        converted = 0
+        for user_id, answers in results["results"].items():
+            encoded = encoder(answers)
+            if encoded is not answers:
+                results["results"][user_id] = encoded
+                converted += 1
+        if converted:
+            self.replace(results)
+        return converted
+
+    def close(self) -> None:
+        """Release underlying resources"""
+
+
+class JsonResultsStore(ResultsStore):
+    """Legacy backend: single json file that is parsed and
+    rewritten as a whole on every operation
+    """
+    in_memory = False
+
+    def __init__(self, path: Path, scorer: Scorer):
+        super().__init__(scorer)
+        self.path = path
+
+    def as_dict(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                results = json.load(file)
+        except (FileNotFoundError, JSONDecodeError) as err:
+            logger.error(f"Error reading results: {err}")
+            raise ResultsUnavailable
+        return results
+
+    def get(self, user_id: str) -> Optional[dict]:
+        return self.as_dict()["results"].get(user_id)
+
+    def get_total(self, user_id: str) -> Optional[int]:
+        return self.as_dict()["total"].get(user_id)
+
+    def stats(self) -> ResultsStats:
+        stats = ResultsStats()
+        for answers in self.as_dict()["results"].values():
+            stats.include(self.scorer(answers))
+        return stats
+
+    def _attempts(self) -> List[Attempt]:
+        return [Attempt(*attempt[:len(Attempt._fields)])
+                for attempt in self.as_dict().get("attempts", [])]
+
+    def _leaderboard(self) -> Leaderboard:
+        leaderboard = Leaderboard()
+        for attempt in self._attempts():
+            leaderboard.add(attempt)
+        return leaderboard
+
+    def attempts(self, user_id: str, limit: int) -> List[Attempt]:
+        return [attempt for attempt in reversed(self._attempts())
+                if attempt.user_id == user_id][:limit]
+
+    def quiz_stats(self, quiz: str) -> ResultsStats:
+        return self._leaderboard().stats(quiz)
+
+    def leaderboard(self, quiz: str, limit: int) -> List[Attempt]:
+        return self._leaderboard().top(quiz, limit)
+
+    def standing(self, user_id: str, quiz: str) -> Optional[Standing]:
+        return self._leaderboard().standing(user_id, quiz)
+
+    def persist(self, records: List[dict]) -> None:
+        results = self.as_dict()
+        attempts = results.setdefault("attempts", [])
+        for record in records:
+            results["results"][record["user_id"]] = record["answers"]
+            results["total"][record["user_id"]] = record["total"]
+            if "quiz" in record:
+                attempts.append(list(Attempt.from_record(record))
+                                + [record["answers"]])
+        write_json_atomic(self.path, results, indent=4)
+
+    @staticmethod
+    def read_history(path: Path, since: float, until: float) \
+            -> Iterator[Tuple[Attempt, dict]]:
+        if not path.exists():
+            return
+        with open(path, "r", encoding="utf-8") as file:
+            attempts = json.load(file).get("attempts", [])
+        for attempt in attempts:
+            if len(attempt) > len(Attempt._fields) \
+                    and since <= attempt[4] < until:
+                yield Attempt(*attempt[:-1]), attempt[-1]
+
+    def replace(self, results: dict) -> None:
+        try:
+            write_json_atomic(self.path, results, indent=4)
+        except OSError as err:
+            logger.error(f"Error saving results: {err}")
+            logger.info(f"Results not saved: {results}")
+
+
+class JournalResultsStore(ResultsStore):
+    """Append-only journal of completed attempts with in-memory index
+    by user id.
+
+    Every completion appends one line to the journal, the whole state
+    is rewritten into snapshot only on compaction (each `compact_every`
+    records). On startup snapshot is loaded and journal is replayed on top.
+    Aggregate stats are kept in memory and persisted within snapshot.
+
+    History of attempts is never rewritten: on compaction journal
+    records are appended to attempts file before journal is truncated.
+    Leaderboard and attempts by user are indexed in memory.
+    """
+    SNAPSHOT_NAME = "snapshot.json"
+    JOURNAL_NAME = "journal.jsonl"
+    ATTEMPTS_NAME = "attempts.jsonl"
+
+    def __init__(self, directory: Path, scorer: Scorer,
+                 compact_every: int = 1000,
+                 legacy_path: Optional[Path] = None):
+        super().__init__(scorer)
+        self.directory = directory
+        self.compact_every = compact_every
+        self.snapshot_path = directory / self.SNAPSHOT_NAME
+        self.journal_path = directory / self.JOURNAL_NAME
+        self.attempts_path = directory / self.ATTEMPTS_NAME
+
+        self._results: Dict[str, dict] = {}
+        self._total: Dict[str, int] = {}
+        self._correct: Dict[str, List[str]] = {}
+        self._stats = ResultsStats()
+        self._seq = 0  # sequence number of the last applied record
+        self._next_seq = 1
+        self._journal_records = 0
+        self._attempts: Dict[str, List[Attempt]] = {}
+        self._leaderboard = Leaderboard()
+        self._attempts_seq = 0  # last record moved to attempts file
+
+        directory.mkdir(parents=True, exist_ok=True)
+        if not self.snapshot_path.exists() and legacy_path is not None \
+                and legacy_path.exists():
+            migrate_legacy(legacy_path, self.snapshot_path)
+        self._load()
+        self._next_seq = self._seq + 1
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    @staticmethod
+    def _read_records(path: Path, description: str) -> Iterator[dict]:
+        if not path.exists():
+            return
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except JSONDecodeError:
+                    # torn write of the last record after crash
+                    logger.error(f"Skip broken record in {description}")
+
+    def _add_attempt(self, attempt: Attempt) -> None:
+        self._attempts.setdefault(attempt.user_id, []).append(attempt)
+        self._leaderboard.add(attempt)
+
+    def _load(self) -> None:
+        """Load attempts and snapshot and replay journal records
+        that are newer
+        """
+        for record in self._read_records(self.attempts_path,
+                                         "attempts file"):
+            self._add_attempt(Attempt(*(record[field]
+                                        for field in Attempt._fields)))
+            self._attempts_seq = record["seq"]
+
+        if self.snapshot_path.exists():
+            try:
+                with open(self.snapshot_path, "r", encoding="utf-8") as file:
+                    snapshot = json.load(file)
+            except (OSError, JSONDecodeError) as err:
+                logger.error(f"Error reading results snapshot: {err}")
+                raise ResultsUnavailable
+            self._results = snapshot["results"]
+            self._total = snapshot["total"]
+            self._seq = snapshot.get("seq", 0)
+            if "stats" in snapshot:
+                self._correct = snapshot["correct"]
+                self._stats = ResultsStats.from_dict(snapshot["stats"])
+            else:
+                # migrated snapshot, aggregates are built once here
+                for user_id, answers in self._results.items():
+                    self._correct[user_id] = self.scorer(answers)
+                    self._stats.include(self._correct[user_id])
+
+        for record in self._read_records(self.journal_path,
+                                         "results journal"):
+            self._journal_records += 1
+            if record["seq"] > self._seq:
+                if "correct" not in record:
+                    record["correct"] = self.scorer(record["answers"])
+                self._apply_one(record)
+            # snapshot may be ahead of attempts file after crash
+            # in the middle of compaction
+            if record["seq"] > self._attempts_seq and "quiz" in record:
+                self._add_attempt(Attempt.from_record(record))
+
+    def _apply_one(self, record: dict) -> None:
+        user_id = record["user_id"]
+        previous = self._correct.get(user_id)
+        if previous is not None:
+            self._stats.include(previous, sign=-1)
+        self._stats.include(record["correct"])
+
+        self._results[user_id] = record["answers"]
+        self._total[user_id] = record["total"]
+        self._correct[user_id] = record["correct"]
+        self._seq = record["seq"]
+
+    def get(self, user_id: str) -> Optional[dict]:
+        return self._results.get(user_id)
+
+    def get_total(self, user_id: str) -> Optional[int]:
+        return self._total.get(user_id)
+
+    def stats(self) -> ResultsStats:
+        return self._stats
+
+    def attempts(self, user_id: str, limit: int) -> List[Attempt]:
+        return self._attempts.get(user_id, [])[:-limit - 1:-1]
+
+    def quiz_stats(self, quiz: str) -> ResultsStats:
+        return self._leaderboard.stats(quiz)
+
+    def leaderboard(self, quiz: str, limit: int) -> List[Attempt]:
+        return self._leaderboard.top(quiz, limit)
+
+    def standing(self, user_id: str, quiz: str) -> Optional[Standing]:
+        return self._leaderboard.standing(user_id, quiz)
+
+    def as_dict(self) -> dict:
+        return dict(results=dict(self._results), total=dict(self._total))
+
+    def prepare(self, user_id: str, answers: dict,
+                correct: Optional[List[str]] = None,
+                quiz: Optional[str] = None, name: str = "") -> dict:
+        record = super().prepare(user_id, answers, correct, quiz, name)
+        record["seq"] = self._next_seq
+        self._next_seq += 1
+        return record
+
+    def persist(self, records: List[dict]) -> None:
+        """Append whole batch with a single write and fsync
+        """
+        lines = "".join(json.dumps(record, ensure_ascii=False) + "\n"
+                        for record in records)
+        self._journal.write(lines)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def apply(self, records: List[dict]) -> None:
+        for record in records:
+            self._apply_one(record)
+            if "quiz" in record:
+                self._add_attempt(Attempt.from_record(record))
+        self._journal_records += len(records)
+
+    def compaction_due(self) -> bool:
+        return self._journal_records >= self.compact_every
+
+    def replace(self, results: dict) -> None:
+        self._results = dict(results["results"])
+        self._total = dict(results["total"])
+        self._correct = {}
+        self._stats = ResultsStats()
+        for user_id, answers in self._results.items():
+            self._correct[user_id] = self.scorer(answers)
+            self._stats.include(self._correct[user_id])
+        self.compact()
+
+    def take_snapshot(self) -> dict:
+        return dict(seq=self._seq, results=dict(self._results),
+                    total=dict(self._total), correct=dict(self._correct),
+                    stats=copy.deepcopy(self._stats.as_dict()))
+
+    def write_snapshot(self, snapshot: dict) -> None:
+        """Fold journal into snapshot and truncate journal.
+        Crash between two steps is safe: replay skips records
+        already covered by snapshot `seq`. For the same reason journal
+        that can not be truncated is kept and appended to
+        """
+        write_json_atomic(self.snapshot_path, snapshot)
+        self._move_attempts()
+        # compaction is retried after the next `compact_every` records
+        self._journal_records = 0
+        try:
+            journal = open(self.journal_path, "w", encoding="utf-8")
+        except OSError as err:
+            logger.error(f"Error truncating results journal, "
+                         f"it is kept: {err}")
+            return
+        self._journal.close()
+        self._journal = journal
+        logger.info(f"Results journal compacted at seq {snapshot['seq']}")
+
+    def _move_attempts(self) -> None:
+        """Append attempts from journal to attempts file, skipping
+        ones moved before crash in previous run
+        """
+        lines = []
+        last_seq = self._attempts_seq
+        for record in self._read_records(self.journal_path,
+                                         "results journal"):
+            if record["seq"] > last_seq and "quiz" in record:
+                attempt = dict(seq=record["seq"],
+                               **Attempt.from_record(record)._asdict(),
+                               answers=record["answers"])
+                lines.append(json.dumps(attempt, ensure_ascii=False) + "\n")
+                last_seq = record["seq"]
+        with open(self.attempts_path, "a", encoding="utf-8") as file:
+            file.write("".join(lines))
+            file.flush()
+            os.fsync(file.fileno())
+        self._attempts_seq = last_seq
+
+    @classmethod
+    def read_history(cls, directory: Path, since: float, until: float) \
+            -> Iterator[Tuple[Attempt, dict]]:
+        """Reads attempts file and journal line by line
+        """
+        last_seq = 0
+        for record in cls._read_records(directory / cls.ATTEMPTS_NAME,
+                                        "attempts file"):
+            last_seq = record["seq"]
+            if "answers" in record \
+                    and since <= record["finished_at"] < until:
+                yield Attempt(*(record[field]
+                                for field in Attempt._fields)), \
+                    record["answers"]
+        for record in cls._read_records(directory / cls.JOURNAL_NAME,
+                                        "results journal"):
+            if record["seq"] > last_seq and "quiz" in record \
+                    and since <= record["finished_at"] < until:
+                yield Attempt.from_record(record), record["answers"]
+
+    def close(self) -> None:
+        self._journal.close()
+
+
+class SQLiteResultsStore(ResultsStore):
+    """Results in SQLite database, can be shared by several processes.
+
+    Aggregates (score histogram and per-question correct counts) are
+    maintained in separate tables within the same transaction as the
+    result itself, so stats are read in O(number of distinct scores).
+    """
+    in_memory = False
+
+    def __init__(self, path: Path, scorer: Scorer,
+                 legacy_path: Optional[Path] = None):
+        super().__init__(scorer)
+        self.path = path
+        self._local = threading.local()  # connection per thread
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+
+        connection = self._connection()
+        with connection:
+            connection.executescript(SQLITE_RESULTS_SCHEMA)
+        empty = connection.execute(
+            "SELECT NOT EXISTS (SELECT 1 FROM results)").fetchone()[0]
+        if empty and legacy_path is not None and legacy_path.exists():
+            with open(legacy_path, "r", encoding="utf-8") as file:
+                legacy = json.load(file)
+            if legacy.get("results"):
+                self.replace(legacy)
+                logger.info(f"Migrated {len(legacy['results'])} results "
+                            f"from {legacy_path}")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.path), timeout=30,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def get(self, user_id: str) -> Optional[dict]:
+        row = self._connection().execute(
+            "SELECT answers FROM results WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_total(self, user_id: str) -> Optional[int]:
+        row = self._connection().execute(
+            "SELECT total FROM results WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def stats(self) -> ResultsStats:
+        connection = self._connection()
+        stats = ResultsStats()
+        for score, users in connection.execute(
+                "SELECT score, users FROM score_histogram WHERE users > 0"):
+            stats.histogram[score] = users
+            stats.participants += users
+            stats.score_sum += score * users
+        for question_index, users in connection.execute(
+                "SELECT question, users FROM question_correct"):
+            stats.question_correct[question_index] = users
+        return stats
+
+    def quiz_stats(self, quiz: str) -> ResultsStats:
+        stats = ResultsStats()
+        for score, users in self._connection().execute(
+                "SELECT score, users FROM best_histogram "
+                "WHERE quiz = ? AND users > 0", (quiz,)):
+            stats.histogram[score] = users
+            stats.participants += users
+            stats.score_sum += score * users
+        return stats
+
+    def attempts(self, user_id: str, limit: int) -> List[Attempt]:
+        return [Attempt(user_id, *row) for row in self._connection().execute(
+            "SELECT quiz, score, questions, finished_at, name FROM attempts "
+            "WHERE user_id = ? ORDER BY finished_at DESC LIMIT ?",
+            (user_id, limit))]
+
+    def leaderboard(self, quiz: str, limit: int) -> List[Attempt]:
+        """Reads first `limit` entries of index by score
+        """
+        return [Attempt(user_id, quiz, *row)
+                for user_id, *row in self._connection().execute(
+                    "SELECT user_id, score, questions, finished_at, name "
+                    "FROM best_attempts WHERE quiz = ? "
+                    "ORDER BY score DESC, finished_at LIMIT ?",
+                    (quiz, limit))]
+
+    def standing(self, user_id: str, quiz: str) -> Optional[Standing]:
+        """Rank is counted over histogram of best scores,
+        not over users
+        """
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT score, questions, finished_at, name FROM best_attempts "
+            "WHERE quiz = ? AND user_id = ?", (quiz, user_id)).fetchone()
+        if row is None:
+            return None
+        best = Attempt(user_id, quiz, *row)
+        above, participants = connection.execute(
+            "SELECT COALESCE(SUM(CASE WHEN score > ? THEN users END), 0), "
+            "SUM(users) FROM best_histogram WHERE quiz = ?",
+            (best.score, quiz)).fetchone()
+        return Standing(best=best, rank=above + 1, participants=participants)
+
+    @staticmethod
+    def read_history(path: Path, since: float, until: float) \
+            -> Iterator[Tuple[Attempt, dict]]:
+        """Rows are fetched from cursor as they are consumed,
+        database is opened read-only
+        """
+        if not path.exists():
+            return
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True,
+                                     timeout=30)
+        try:
+            for *row, answers in connection.execute(
+                    "SELECT user_id, quiz, score, questions, finished_at, "
+                    "name, answers FROM attempts WHERE answers IS NOT NULL "
+                    "AND finished_at >= ? AND finished_at < ? ORDER BY id",
+                    (since, until)):
+                yield Attempt(*row), json.loads(answers)
+        finally:
+            connection.close()
+
+    def as_dict(self) -> dict:
+        results, total = {}, {}
+        for user_id, answers, user_total in self._connection().execute(
+                "SELECT user_id, answers, total FROM results"):
+            results[user_id] = json.loads(answers)
+            total[user_id] = user_total
+        return dict(results=results, total=total)
+
+    @staticmethod
+    def _count(connection: sqlite3.Connection, correct: List[str],
+               sign: int) -> None:
+        connection.execute(
+            "INSERT INTO score_histogram (score, users) VALUES (?, ?) "
+            "ON CONFLICT (score) DO UPDATE SET users = users + excluded.users",
+            (len(correct), sign))
+        connection.executemany(
+            "INSERT INTO question_correct (question, users) VALUES (?, ?) "
+            "ON CONFLICT (question) "
+            "DO UPDATE SET users = users + excluded.users",
+            [(question_index, sign) for question_index in correct])
+
+    def _write(self, connection: sqlite3.Connection, record: dict) -> None:
+        previous = connection.execute(
+            "SELECT correct FROM results WHERE user_id = ?",
+            (record["user_id"],)
+        ).fetchone()
+        if previous is not None:
+            self._count(connection, json.loads(previous[0]), sign=-1)
+        self._count(connection, record["correct"], sign=1)
+        connection.execute(
+            "INSERT OR REPLACE INTO results "
+            "(user_id, answers, total, correct) VALUES (?, ?, ?, ?)",
+            (record["user_id"],
+             json.dumps(record["answers"], ensure_ascii=False),
+             record["total"], json.dumps(record["correct"])))
+        if "quiz" in record:
+            self._write_attempt(connection, Attempt.from_record(record),
+                                record["answers"])
+
+    @staticmethod
+    def _write_attempt(connection: sqlite3.Connection, attempt: Attempt,
+                       answers: Optional[dict] = None) -> None:
+        connection.execute(
+            "INSERT INTO attempts (user_id, quiz, score, questions, "
+            "finished_at, name, answers) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (*attempt, None if answers is None
+             else json.dumps(answers, ensure_ascii=False)))
+        previous = connection.execute(
+            "SELECT score FROM best_attempts WHERE quiz = ? AND user_id = ?",
+            (attempt.quiz, attempt.user_id)).fetchone()
+        if previous is not None and previous[0] >= attempt.score:
+            return
+        counts = [(attempt.quiz, attempt.score, 1)]
+        if previous is not None:
+            counts.append((attempt.quiz, previous[0], -1))
+        connection.executemany(
+            "INSERT INTO best_histogram (quiz, score, users) "
+            "VALUES (?, ?, ?) ON CONFLICT (quiz, score) "
+            "DO UPDATE SET users = users + excluded.users", counts)
+        connection.execute(
+            "INSERT OR REPLACE INTO best_attempts (quiz, user_id, score, "
+            "questions, finished_at, name) VALUES (?, ?, ?, ?, ?, ?)",
+            (attempt.quiz, attempt.user_id, attempt.score, attempt.questions,
+             attempt.finished_at, attempt.name))
+
+    def persist(self, records: List[dict]) -> None:
+        """Write batch in one transaction, taking write lock upfront,
+        so concurrent processes can not interleave read-modify-write
+        """
+        connection = self._connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for record in records:
+                self._write(connection, record)
+            connection.execute("COMMIT")
+        except sqlite3.Error as err:
+            connection.execute("ROLLBACK")
+            raise OSError(err) from err
+
+    def replace(self, results: dict) -> None:
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        for table in ("results", "score_histogram", "question_correct"):
+            connection.execute(f"DELETE FROM {table}")
+        for user_id, answers in results["results"].items():
+            self._write(connection, self.prepare(user_id, answers))
+        connection.execute("COMMIT")
+
+    def migrate(self, encoder: Encoder) -> int:
+        """Convert in one transaction only results that are not in
+        compact form (answers start with bank version)
+        """
+        connection = self._connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            updates = []
+            for user_id, answers in connection.execute(
+                    "SELECT user_id, answers FROM results "
+                    "WHERE answers NOT LIKE ?", ('{"bank": %',)).fetchall():
+                answers = json.loads(answers)
+                encoded = encoder(answers)
+                if encoded is not answers:
+                    updates.append((json.dumps(encoded, ensure_ascii=False),
+                                    user_id))
+            connection.executemany(
+                "UPDATE results SET answers = ? WHERE user_id = ?", updates)
+            connection.execute("COMMIT")
+        except sqlite3.Error as err:
+            connection.execute("ROLLBACK")
+            raise OSError(err) from err
+        return len(updates)
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+class AsyncResults:
+    """Non-blocking facade over results store.
+
+    The store is opened in a thread on first use (or by `open`), so
+    loading a long history does not block the event loop, and callers
+    that come meanwhile wait for the same load.
+
+    Commits are queued to a single writer task that coalesces bursts
+    into one `persist` call executed in a thread pool. `commit` returns
+    only after the result is durably written, so acknowledged results
+    survive restart.
+    """
+
+    def __init__(self, open_store: Callable[[], ResultsStore],
+                 max_batch: int = 500):
+        self.open_store = open_store
+        self.store: Optional[ResultsStore] = None
+        self.max_batch = max_batch
+        self._opening: Optional[asyncio.Future] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer: Optional[asyncio.Task] = None
+
+    async def _run_blocking(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def open(self) -> ResultsStore:
+        """Store, waits until it is opened
+        """
+        if self.store is None:
+            if self._opening is None:
+                self._opening = asyncio.ensure_future(
+                    self._run_blocking(self.open_store))
+            try:
+                # one cancelled caller must not cancel the load of others
+                self.store = await asyncio.shield(self._opening)
+            except Exception:
+                self._opening = None  # next access tries again
+                raise
+        return self.store
+
+    async def _read(self, name: str, *args):
+        store = await self.open()
+        with metrics.RESULTS_LATENCY.time(name):
+            if store.in_memory:
+                return getattr(store, name)(*args)
+            return await self._run_blocking(getattr(store, name), *args)
+
+    async def get(self, user_id: str) -> Optional[dict]:
+        return await self._read("get", user_id)
+
+    async def get_total(self, user_id: str) -> Optional[int]:
+        return await self._read("get_total", user_id)
+
+    async def stats(self) -> ResultsStats:
+        return await self._read("stats")
+
+    async def quiz_stats(self, quiz: str) -> ResultsStats:
+        return await self._read("quiz_stats", quiz)
+
+    async def attempts(self, user_id: str, limit: int = 5) -> List[Attempt]:
+        return await self._read("attempts", user_id, limit)
+
+    async def leaderboard(self, quiz: str, limit: int = 10) -> List[Attempt]:
+        return await self._read("leaderboard", quiz, limit)
+
+    async def standing(self, user_id: str, quiz: str) -> Optional[Standing]:
+        return await self._read("standing", user_id, quiz)
+
+    async def commit(self, user_id: str, answers: dict,
+                     correct: Optional[List[str]] = None,
+                     quiz: Optional[str] = None, name: str = "") -> None:
+        """Queue attempt of `quiz` and wait until it is persisted
+        """
+        await self.open()
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._writer is None or self._writer.done():
+            if self._writer is not None and not self._writer.cancelled() \
+                    and self._writer.exception() is not None:
+                logger.error(f"Results writer stopped: "
+                             f"{self._writer.exception()}, restarting")
+            self._writer = asyncio.get_event_loop().create_task(
+                self._write_loop())
+        done = asyncio.get_event_loop().create_future()
+        await self._queue.put((user_id, answers, correct, quiz, name, done))
+        await done
+
+    async def _write_loop(self) -> None:
+        closing = False
+        while not closing:
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if None in batch:  # close() sentinel
+                closing = True
+                batch = [item for item in batch if item is not None]
+            if batch:
+                await self._flush(batch)
+
+    async def _flush(self, batch: list) -> None:
+        records = []
+        try:
+            records = [
+                self.store.prepare(user_id, answers, correct, quiz, name)
+                for user_id, answers, correct, quiz, name, _done in batch]
+            with metrics.RESULTS_LATENCY.time("persist"):
+                await self._run_blocking(self.store.persist, records)
+        except Exception as err:  # writer task must survive any failure
+            logger.error(f"Error saving results: {err}")
+            logger.info(f"Results not saved: {records}")
+            for *_, done in batch:
+                done.set_exception(ResultsUnavailable())
+            return
+
+        self.store.apply(records)
+        for *_, done in batch:
+            done.set_result(None)
+
+        if self.store.compaction_due():
+            try:
+                with metrics.RESULTS_LATENCY.time("compact"):
+                    snapshot = self.store.take_snapshot()
+                    await self._run_blocking(self.store.write_snapshot,
+                                             snapshot)
+            except Exception as err:  # results are safe in the journal
+                logger.error(f"Error compacting results, journal is kept: "
+                             f"{err}")
+
+    async def close(self) -> None:
+        """Flush queued results and stop writer
+        """
+        if self._writer is not None:
+            await self._queue.put(None)
+            await self._writer
+            self._writer = None
+        if self._opening is not None:
+            (await self.open()).close()
+
+
+def migrate_legacy(legacy_path: Path, snapshot_path: Path) -> None:
+    """One-shot migration from legacy results.json into journal snapshot
+    """
+    with open(legacy_path, "r", encoding="utf-8") as file:
+        legacy = json.load(file)
+    snapshot = dict(seq=0, results=legacy.get("results", {}),
+                    total=legacy.get("total", {}))
+    write_json_atomic(snapshot_path, snapshot)
+    logger.info(f"Migrated {len(snapshot['total'])} results "
+                f"from {legacy_path}")
+
+
+_stores: Dict[tuple, ResultsStore] = {}
+_stores_lock = threading.Lock()
+_async_stores: Dict[tuple, AsyncResults] = {}
+
+
+def open_results_store(config: Config, scorer: Scorer,
+                       encoder: Optional[Encoder] = None) -> ResultsStore:
+    """Get results store configured by `config.results_backend`.
+    Stores are opened once per process and reused, results of older
+    format are converted by `encoder` on opening. Blocks until a load
+    started by another thread is done, on the event loop use
+    `AsyncResults.open` instead
+    """
+    key = (config.results_backend, config.logs_path)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = _open_store(config, scorer, encoder)
+        return _stores[key]
+
+
+def _open_store(config: Config, scorer: Scorer,
+                encoder: Optional[Encoder]) -> ResultsStore:
+    legacy_path = config.logs_path / Path("results.json")
+    if config.results_backend == "json":
+        store = JsonResultsStore(legacy_path, scorer=scorer)
+    elif config.results_backend == "journal":
+        store = JournalResultsStore(config.logs_path / Path("results"),
+                                    scorer=scorer,
+                                    compact_every=config.results_compact_every,
+                                    legacy_path=legacy_path)
+    elif config.results_backend == "sqlite":
+        store = SQLiteResultsStore(config.logs_path / Path("results.sqlite3"),
+                                   scorer=scorer, legacy_path=legacy_path)
+    else:
+        raise ValueError(f"Unknown results backend: "
+                         f"{config.results_backend}")
+    if encoder is not None:
+        try:
+            converted = store.migrate(encoder)
+        except (OSError, ResultsUnavailable) as err:
+            logger.error(f"Error converting results: {err}")
+        else:
+            if converted:
+                logger.info(f"Converted {converted} results to compact form")
+    return store
+
+
+def read_history(config: Config, since: float = 0,
+                 until: float = float("inf")) \
+        -> Iterator[Tuple[Attempt, dict]]:
+    """Attempts finished in [since, until) with their answers, oldest
+    first, read from files of `config.results_backend` without opening
+    the store, so it can run next to the bot. Attempts saved by older
+    versions without answers are skipped
+    """
+    if config.results_backend == "json":
+        return JsonResultsStore.read_history(
+            config.logs_path / Path("results.json"), since, until)
+    if config.results_backend == "journal":
+        return JournalResultsStore.read_history(
+            config.logs_path / Path("results"), since, until)
+    if config.results_backend == "sqlite":
+        return SQLiteResultsStore.read_history(
+            config.logs_path / Path("results.sqlite3"), since, until)
+    raise ValueError(f"Unknown results backend: {config.results_backend}")
+
+
+def open_async_results(config: Config, scorer: Scorer,
+                       encoder: Optional[Encoder] = None) -> AsyncResults:
+    """Get async facade over configured results store, the store is
+    opened on first access
+    """
+    key = (config.results_backend, config.logs_path)
+    if key not in _async_stores:
+        _async_stores[key] = AsyncResults(
+            partial(open_results_store, config, scorer, encoder))
+    return _async_stores[key]
@@ -0,0 +1,292 @@
+"""Outbound request scheduler that keeps the bot within Telegram flood limits
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from dataclasses import dataclass, asdict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.utils import exceptions
+
+from src.bot import metrics
+from src.config import Config
+
+logger = logging.getLogger(__name__)
+
+# when global limit is reached waiting requests are served by priority,
+# lower value first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SEND = 1
+PRIORITY_BULK = 2
+
+INTERACTIVE_METHODS = ("editmessagetext", "editmessagereplymarkup",
+                       "editmessagecaption", "editmessagemedia")
+BULK_METHODS = ("sendphoto", "senddocument", "sendmediagroup",
+                "sendvideo", "sendaudio", "sendanimation")
+# methods that are not counted by flood limits although look like sends
+UNLIMITED_METHODS = ("sendchataction",)
+
+Request = Callable[..., Awaitable]
+
+
+def is_limited(method: str) -> bool:
+    """Whether method (lower case) sends or changes messages in a chat
+    """
+    return method.startswith(("send", "edit", "copy", "forward")) \
+        and method not in UNLIMITED_METHODS
+
+
+class TokenBucket:
+    """`rate` tokens per second, at most `capacity` are stored
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_take(self, now: float) -> bool:
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def reserve(self, now: float) -> float:
+        """Take a token in advance, returns seconds to wait before use
+        """
+        self._refill(now)
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def refund(self) -> None:
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def pause(self, seconds: float, now: float) -> None:
+        """Give no tokens for `seconds` (after flood error)
+        """
+        self._refill(now)
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class SchedulerMetrics:
+    """Counters of outbound requests"""
+    sent: int = 0
+    flood_errors: int = 0
+    throttled: int = 0  # requests that had to wait for a token
+    wait_seconds: float = 0.0
+    queue_depth: int = 0  # requests waiting right now
+    max_queue_depth: int = 0
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+class SendScheduler:
+    """Delays outbound requests to fit global and per-chat token buckets.
+
+    Each chat has its own bucket (group chats a slower one) served in
+    arrival order. When the global bucket is empty, requests queue up and
+    interactive edits go before new messages, which go before uploads and
+    messages to `bulk_chats`. On 429 the chat (or the whole bot for
+    requests without chat) is paused for `retry_after` seconds and the
+    request is repeated up to `max_retries` times.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1,
+                 chat_burst: float = 5, group_rate: float = 20 / 60,
+                 max_retries: int = 3, bulk_chats: tuple = (),
+                 max_idle_chats: int = 10000):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.bulk_chats = {str(chat_id) for chat_id in bulk_chats}
+        self.max_idle_chats = max_idle_chats
+        self.metrics = SchedulerMetrics()
+
+        self._global = TokenBucket(global_rate, capacity=max(global_rate, 1))
+        self._chats: Dict[str, TokenBucket] = {}
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._pump: Optional[asyncio.Task] = None
+
+    def priority(self, method: str, chat_id: Optional[str]) -> int:
+        if chat_id in self.bulk_chats or method in BULK_METHODS:
+            return PRIORITY_BULK
+        if method in INTERACTIVE_METHODS:
+            return PRIORITY_INTERACTIVE
+        return PRIORITY_SEND
+
+    def queue_depths(self) -> Dict[int, int]:
+        """Number of requests waiting for the global bucket per priority
+        """
+        depths = {PRIORITY_INTERACTIVE: 0, PRIORITY_SEND: 0, PRIORITY_BULK: 0}
+        for priority, _seq, future in self._waiters:
+            if not future.done():
+                depths[priority] += 1
+        return depths
+
+    def _chat_bucket(self, chat_id: str) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_idle_chats:
+                self._forget_idle_chats()
+            # group and channel ids are negative
+            rate = self.group_rate if chat_id.startswith("-") \
+                else self.chat_rate
+            bucket = TokenBucket(rate, capacity=self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _forget_idle_chats(self) -> None:
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items()
+                        if bucket.is_full(now)]:
+            del self._chats[chat_id]
+
+    async def _acquire(self, chat_id: Optional[str], priority: int) -> None:
+        started = time.monotonic()
+        self.metrics.queue_depth += 1
+        self.metrics.max_queue_depth = max(self.metrics.max_queue_depth,
+                                           self.metrics.queue_depth)
+        try:
+            if chat_id is not None:
+                delay = self._chat_bucket(chat_id).reserve(started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if self._waiters or not self._global.try_take(time.monotonic()):
+                await self._wait_global(priority)
+        finally:
+            self.metrics.queue_depth -= 1
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            self.metrics.throttled += 1
+            self.metrics.wait_seconds += waited
+
+    async def _wait_global(self, priority: int) -> None:
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters,
+                       (priority, next(self._sequence), future))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.get_event_loop().create_task(
+                self._pump_global())
+        await future
+
+    async def _pump_global(self) -> None:
+        """Hand out global tokens to waiters in priority order
+        """
+        while self._waiters:
+            delay = self._global.reserve(time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # waiter is chosen after sleep, so late interactive edits
+            # still overtake bulk sends queued earlier
+            while self._waiters:
+                _priority, _seq, future = heapq.heappop(self._waiters)
+                if not future.done():
+                    future.set_result(None)
+                    break
+            else:
+                self._global.refund()
+
+    def _pause(self, chat_id: Optional[str], seconds: float) -> None:
+        now = time.monotonic()
+        if chat_id is None:
+            self._global.pause(seconds, now)
+        else:
+            self._chat_bucket(chat_id).pause(seconds, now)
+
+    async def submit(self, request: Request, method: str,
+                     data: Optional[dict] = None,
+                     files: Optional[dict] = None, **kwargs):
+        """Make `request` once limits allow, repeating it on flood errors
+        """
+        name = method.lower()
+        if not is_limited(name):
+            return await request(method, data, files, **kwargs)
+
+        chat_id = (data or {}).get("chat_id")
+        chat_id = None if chat_id is None else str(chat_id)
+        priority = self.priority(name, chat_id)
+        for attempt in itertools.count():
+            await self._acquire(chat_id, priority)
+            try:
+                result = await request(method, data, files, **kwargs)
+            except exceptions.RetryAfter as err:
+                self.metrics.flood_errors += 1
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(f"Flood limit on {method} to chat {chat_id}, "
+                               f"retry in {err.timeout}s")
+                self._pause(chat_id, err.timeout)
+                _rewind(files)
+                continue
+            self.metrics.sent += 1
+            return result
+
+
+def _rewind(files: Optional[dict]) -> None:
+    """Files were read by failed request, prepare them to be sent again
+    """
+    for value in (files or {}).values():
+        file = getattr(value, "file", value)
+        if hasattr(file, "seek"):
+            file.seek(0)
+
+
+class ScheduledBot(Bot):
+    """Bot whose API requests pass through `scheduler`
+    """
+
+    def __init__(self, *args, scheduler: Optional[SendScheduler] = None,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+
+    async def _timed_request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as err:
+            metrics.API_ERRORS.inc(method, type(err).__name__)
+            raise
+        finally:
+            metrics.API_LATENCY.observe(time.perf_counter() - started,
+                                        method)
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        if self.scheduler is None:
+            return await self._timed_request(method, data, files, **kwargs)
+        return await self.scheduler.submit(self._timed_request, method,
+                                           data, files, **kwargs)
+
+
+def create_scheduler(config: Config) -> Optional[SendScheduler]:
+    """Scheduler configured for the app or None if rate limiting is off.
+    Worker processes share the global limit
+    """
+    if not config.send_rate_limit:
+        return None
+    return SendScheduler(
+        global_rate=config.send_global_rate / max(config.workers, 1),
+        chat_rate=config.send_chat_rate,
+        chat_burst=config.send_chat_burst,
+        group_rate=config.send_group_rate,
+        max_retries=config.send_max_retries,
+        bulk_chats=(config.control_chat_id,),
+    )
@@ -0,0 +1,409 @@
+"""Full-text search over theory materials
+
+Text of theory PDFs (requires pypdf) is split into passages once and
+kept in a persistent inverted index of word stems. A PDF is read
+again only when its size or mtime changes, searches never open PDFs.
+Passages are ranked by BM25.
+"""
+import asyncio
+import heapq
+import json
+import logging
+import math
+import os
+import re
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from functools import lru_cache
+from html import escape
+from json import JSONDecodeError
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, NamedTuple, \
+    Optional, Set, Tuple
+
+from src.bot.results import write_json_atomic
+from src.bot.states import Theory
+
+logger = logging.getLogger(__name__)
+
+# bump when stemming or passage splitting changes, index is rebuilt
+INDEX_FORMAT = 1
+
+WORD = re.compile(r"[^\W_]+")
+VOWELS = frozenset("аеиоуыэюя")
+STOP_WORDS = frozenset(
+    "а без в во все да для до же за и из или к как ко ли на над не "
+    "ни но о об от по под при с со так то у что это".split())
+
+PERFECTIVE_GERUND = (("в", "вши", "вшись"),
+                     ("ив", "ивши", "ившись", "ыв", "ывши", "ывшись"))
+ADJECTIVE = ((), ("ее", "ие", "ые", "ое", "ими", "ыми", "ей", "ий", "ый",
+                  "ой", "ем", "им", "ым", "ом", "его", "ого", "ему", "ому",
+                  "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею"))
+PARTICIPLE = (("ем", "нн", "вш", "ющ", "щ"), ("ивш", "ывш", "ующ"))
+REFLEXIVE = ((), ("ся", "сь"))
+VERB = (("ла", "на", "ете", "йте", "ли", "й", "л", "ем", "н", "ло", "но",
+         "ет", "ют", "ны", "ть", "ешь", "нно"),
+        ("ила", "ыла", "ена", "ейте", "уйте", "ите", "или", "ыли", "ей",
+         "уй", "ил", "ыл", "им", "ым", "ен", "ило", "ыло", "ено", "ят",
+         "ует", "уют", "ит", "ыт", "ены", "ить", "ыть", "ишь", "ую", "ю"))
+NOUN = ((), ("а", "ев", "ов", "ие", "ье", "е", "иями", "ями", "ами", "еи",
+             "ии", "и", "ией", "ей", "ой", "ий", "й", "иям", "ям", "ием",
+             "ем", "ам", "ом", "о", "у", "ах", "иях", "ях", "ы", "ь", "ию",
+             "ью", "ю", "ия", "ья", "я"))
+SUPERLATIVE = ((), ("ейш", "ейше"))
+DERIVATIONAL = ("ост", "ость")
+
+PASSAGE_LENGTH = 600  # longer paragraphs are split by sentences
+SNIPPET_LENGTH = 240
+
+
+class SearchError(Exception):
+    """Raise when theory can not be indexed
+    """
+
+
+class Passage(NamedTuple):
+    topic: str  # theory index
+    text: str
+
+
+class SearchHit(NamedTuple):
+    topic: str
+    score: float
+    snippet: str  # html with matched words in bold
+
+
+def _ending(word: str, endings: Tuple[str, ...], after_a: bool) -> int:
+    """Length of the longest of endings the word has, 0 if none
+    """
+    size = 0
+    for ending in endings:
+        if len(ending) > size and word.endswith(ending) and (
+                not after_a or word[:-len(ending)].endswith(("а", "я"))):
+            size = len(ending)
+    return size
+
+
+def _strip(word: str, groups: Tuple[tuple, tuple]) -> Optional[str]:
+    """Word without the longest ending of the class, None if it has
+    none; endings of the first group must follow "а" or "я"
+    """
+    size = max(_ending(word, groups[0], after_a=True),
+               _ending(word, groups[1], after_a=False))
+    return word[:-size] if size else None
+
+
+def _region(word: str, start: int) -> int:
+    """Start of the region after the first non-vowel following a vowel
+    """
+    for index in range(start + 1, len(word)):
+        if word[index] not in VOWELS and word[index - 1] in VOWELS:
+            return index + 1
+    return len(word)
+
+
+@lru_cache(maxsize=100000)
+def stem(word: str) -> str:
+    """Snowball stemmer for Russian, other words are returned as is
+    """
+    word = word.lower().replace("ё", "е")
+    rv_start = next((index + 1 for index, letter in enumerate(word)
+                     if letter in VOWELS), None)
+    if rv_start is None:
+        return word
+    r2_start = _region(word, _region(word, 0))
+    prefix, rv = word[:rv_start], word[rv_start:]
+
+    stripped = _strip(rv, PERFECTIVE_GERUND)
+    if stripped is None:
+        stripped = _strip(rv, REFLEXIVE)
+        if stripped is not None:
+            rv = stripped
+        stripped = _strip(rv, ADJECTIVE)
+        if stripped is not None:
+            participle = _strip(stripped, PARTICIPLE)
+            stripped = participle if participle is not None else stripped
+        else:
+            stripped = _strip(rv, VERB)
+            if stripped is None:
+                stripped = _strip(rv, NOUN)
+    if stripped is not None:
+        rv = stripped
+
+    if rv.endswith("и"):
+        rv = rv[:-1]
+
+    size = _ending(rv, DERIVATIONAL, after_a=False)
+    if size and rv_start + len(rv) - size >= r2_start:
+        rv = rv[:-size]
+
+    stripped = _strip(rv, SUPERLATIVE)
+    if stripped is not None:
+        rv = stripped
+    if rv.endswith("нн"):
+        rv = rv[:-1]
+    elif stripped is None and rv.endswith("ь"):
+        rv = rv[:-1]
+    return prefix + rv
+
+
+def terms(text: str) -> Iterator[Tuple[str, re.Match]]:
+    """Stems of words of the text with their matches, without stop words
+    """
+    for match in WORD.finditer(text):
+        word = match.group().lower()
+        if len(word) > 1 and word not in STOP_WORDS:
+            yield stem(word), match
+
+
+def split_passages(text: str) -> List[str]:
+    """Paragraphs of text extracted from PDF, long ones are split by
+    sentences
+    """
+    passages = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        lines = [line.strip() for line in paragraph.splitlines()]
+        # word broken at line end keeps its hyphen: санитарно-
+        joined = ""
+        for line in filter(None, lines):
+            separator = "" if not joined or joined.endswith("-") else " "
+            joined += separator + line
+        while len(joined) > PASSAGE_LENGTH:
+            cut = joined.rfind(". ", 0, PASSAGE_LENGTH)
+            cut = cut + 1 if cut > 0 else PASSAGE_LENGTH
+            passages.append(joined[:cut].strip())
+            joined = joined[cut:].strip()
+        if joined:
+            passages.append(joined)
+    return passages
+
+
+def extract_passages(path: Path) -> List[str]:
+    """Passages of all pages of the PDF
+    """
+    try:
+        import pypdf
+    except ImportError:
+        raise SearchError("pypdf is required for theory search")
+    reader = pypdf.PdfReader(str(path))
+    return [passage for page in reader.pages
+            for passage in split_passages(page.extract_text() or "")]
+
+
+class IndexData(NamedTuple):
+    sources: Dict[str, dict]  # file: topic, signature, passage range
+    passages: List[Passage]
+    lengths: List[int]  # terms in passage
+    postings: Dict[str, List[Tuple[int, int]]]  # stem: [(passage, tf)]
+    vocabulary: List[str]  # sorted stems, for prefix search
+
+    @classmethod
+    def build(cls, sources: Dict[str, dict],
+              passages: List[Passage]) -> "IndexData":
+        lengths = []
+        postings: Dict[str, list] = defaultdict(list)
+        for number, passage in enumerate(passages):
+            counts = Counter(term for term, _ in terms(passage.text))
+            lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                postings[term].append((number, count))
+        return cls(sources, passages, lengths, dict(postings),
+                   sorted(postings))
+
+    @property
+    def average_length(self) -> float:
+        return sum(self.lengths) / len(self.lengths) if self.lengths else 0
+
+
+EMPTY_INDEX = IndexData({}, [], [], {}, [])
+
+
+class SearchIndex:
+    """Inverted index of theory passages persisted in json file.
+
+    `refresh` runs in a thread and swaps the whole index at once, so
+    searches in the event loop see either the old or the new one.
+    """
+
+    def __init__(self, path: Path, k1: float = 1.2, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.data: Optional[IndexData] = None  # not loaded yet
+        self._watcher: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.data is not None
+
+    def _read(self) -> IndexData:
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                saved = json.load(file)
+        except FileNotFoundError:
+            return EMPTY_INDEX
+        except (OSError, JSONDecodeError) as err:
+            logger.error(f"Search index {self.path} not loaded: {err}")
+            return EMPTY_INDEX
+        if saved.get("format") != INDEX_FORMAT:
+            return EMPTY_INDEX
+        postings = {term: [tuple(posting) for posting in term_postings]
+                    for term, term_postings in saved["postings"].items()}
+        return IndexData(saved["sources"],
+                         [Passage(*passage) for passage in saved["passages"]],
+                         saved["lengths"], postings, sorted(postings))
+
+    def _save(self, data: IndexData) -> None:
+        try:
+            write_json_atomic(self.path, dict(
+                format=INDEX_FORMAT, sources=data.sources,
+                passages=data.passages, lengths=data.lengths,
+                postings=data.postings))
+        except OSError as err:
+            logger.error(f"Search index not saved: {err}")
+
+    @staticmethod
+    def _signature(path: Path) -> list:
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def refresh(self, theory: Dict[str, Theory]) -> bool:
+        """Load saved index and index PDFs that changed since it was
+        built, returns whether the index was rebuilt
+        """
+        old = self.data if self.data is not None else self._read()
+        sources: Dict[str, dict] = {}
+        passages: List[Passage] = []
+        changed = set(old.sources) != {str(material.file_path)
+                                       for material in theory.values()}
+        for topic, material in theory.items():
+            key = str(material.file_path)
+            try:
+                signature = self._signature(material.file_path)
+            except OSError as err:
+                logger.error(f"Theory {key} not indexed: {err}")
+                continue
+            known = old.sources.get(key)
+            if known is not None and known["signature"] == signature \
+                    and known["topic"] == topic:
+                start, end = known["passages"]
+                texts = [passage.text for passage in old.passages[start:end]]
+            else:
+                changed = True
+                try:
+                    texts = extract_passages(material.file_path)
+                except SearchError:
+                    raise
+                except Exception as err:  # broken PDF is kept empty
+                    logger.error(f"Theory {key} not indexed: {err}")
+                    texts = []
+            sources[key] = dict(topic=topic, signature=signature,
+                                passages=[len(passages),
+                                          len(passages) + len(texts)])
+            passages.extend(Passage(topic, text) for text in texts)
+
+        if not changed:
+            self.data = old
+            return False
+        data = IndexData.build(sources, passages)
+        self._save(data)
+        self.data = data
+        logger.info(f"Search index built: {len(sources)} files, "
+                    f"{len(passages)} passages, {len(data.postings)} terms")
+        return True
+
+    def _expand(self, data: IndexData, term: str) -> List[str]:
+        """Stems starting with an unfinished last word of the query
+        """
+        start = bisect_left(data.vocabulary, term)
+        expanded = []
+        for candidate in data.vocabulary[start:start + 20]:
+            if not candidate.startswith(term):
+                break
+            expanded.append(candidate)
+        return expanded
+
+    def search(self, query: str, limit: int = 5) -> List[SearchHit]:
+        """Passages best matching the query
+        """
+        data = self.data
+        if data is None or not data.passages:
+            return []
+        query_terms = [term for term, _ in terms(query)]
+        if query_terms and query_terms[-1] not in data.postings \
+                and len(query_terms[-1]) >= 3:
+            query_terms[-1:] = self._expand(data, query_terms[-1])
+        matched: Set[str] = set()
+        scores: Dict[int, float] = defaultdict(float)
+        average_length = data.average_length
+        for term in set(query_terms):
+            term_postings = data.postings.get(term)
+            if not term_postings:
+                continue
+            matched.add(term)
+            frequency = len(term_postings)
+            idf = math.log(1 + (len(data.passages) - frequency + 0.5)
+                           / (frequency + 0.5))
+            for number, count in term_postings:
+                norm = 1 - self.b + self.b * data.lengths[number] \
+                    / average_length
+                scores[number] += idf * count * (self.k1 + 1) \
+                    / (count + self.k1 * norm)
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [SearchHit(data.passages[number].topic, score,
+                          snippet(data.passages[number].text, matched))
+                for number, score in best]
+
+    async def _watch(self, theory: Callable[[], Dict[str, Theory]],
+                     interval: float) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.refresh, theory())
+            except SearchError as err:
+                logger.error(f"Theory search is not updated: {err}")
+                if self.data is None:  # saved index is better than none
+                    self.data = await loop.run_in_executor(None, self._read)
+                return
+            await asyncio.sleep(interval)
+
+    def start_watching(self, theory: Callable[[], Dict[str, Theory]],
+                       interval: float) -> None:
+        """Build index in background and check PDFs of current theory
+        for changes periodically
+        """
+        if self._watcher is None:
+            self._watcher = asyncio.get_event_loop().create_task(
+                self._watch(theory, interval))
+
+    def stop_watching(self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+
+def snippet(text: str, matched: Set[str],
+            length: int = SNIPPET_LENGTH) -> str:
+    """Part of the passage around the first matched word, matched words
+    in bold
+    """
+    found = [match for term, match in terms(text) if term in matched]
+    start = 0
+    if found and len(text) > length:
+        start = max(0, found[0].start() - length // 3)
+        start = text.rfind(" ", 0, start) + 1 if start else 0
+    end = min(len(text), start + length)
+    if end < len(text):
+        end = text.rfind(" ", start, end) if " " in text[start:end] else end
+    parts = ["…" if start else ""]
+    position = start
+    for match in found:
+        if match.start() < start or match.end() > end:
+            continue
+        parts.append(escape(text[position:match.start()]))
+        parts.append(f"<b>{escape(match.group())}</b>")
+        position = match.end()
+    parts.append(escape(text[position:end]))
+    parts.append("…" if end < len(text) else "")
+    return "".join(parts)
@@ -0,0 +1,268 @@
+"""Reminders and expiry of abandoned quiz sessions
+
+All timers live in one hashed timer wheel driven by a single
+task, instead of a task per user. Every update of a user in a quiz
+moves their timers forward; after a restart they are rebuilt from
+the time FSM records were last written.
+"""
+import asyncio
+import logging
+import math
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, \
+    Set, Tuple
+
+from aiogram import types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher import Dispatcher
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.storage import BaseStorage
+
+from src.bot import metrics
+
+logger = logging.getLogger(__name__)
+
+SessionCallback = Callable[[int, int], Awaitable]  # chat id, user id
+
+
+class TimerWheel:
+    """Hashed timer wheel: `slots` slots of `resolution` seconds, a timer
+    waits in the slot of its tick for as many rounds as it takes.
+
+    Scheduling and cancelling are O(1). A tick looks at timers of one
+    slot only, about len(wheel) / slots of them, so ticks cost the same
+    however timers are spread, with no bursts when many come due
+    together. Timers never fire early, and at most one tick late.
+    """
+
+    def __init__(self, resolution: float = 1.0, slots: int = 4096,
+                 now: Optional[float] = None):
+        self.resolution = resolution
+        self._slots: List[Dict[Hashable, int]] = [{} for _ in range(slots)]
+        # key: slot the timer is in, the slot maps key to its tick
+        self._timers: Dict[Hashable, Dict[Hashable, int]] = {}
+        self.current = math.floor(
+            (time.time() if now is None else now) / resolution)
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._timers
+
+    def schedule(self, key: Hashable, deadline: float) -> None:
+        """Fire `key` at `deadline` (unix time), replaces its previous
+        timer
+        """
+        self.cancel(key)
+        tick = max(math.ceil(deadline / self.resolution), self.current + 1)
+        slot = self._slots[tick % len(self._slots)]
+        slot[key] = tick
+        self._timers[key] = slot
+
+    def cancel(self, key: Hashable) -> bool:
+        slot = self._timers.pop(key, None)
+        if slot is None:
+            return False
+        del slot[key]
+        return True
+
+    def deadline(self, key: Hashable) -> Optional[float]:
+        slot = self._timers.get(key)
+        return slot[key] * self.resolution if slot is not None else None
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Move to `now` (unix time), returns keys of timers that are due
+        """
+        target = math.floor(now / self.resolution)
+        first = self.current + 1
+        self.current = max(target, self.current)
+        expired: List[Hashable] = []
+        if not self._timers:
+            return expired
+        # slots passed since the last call, each at most once
+        for tick in range(first, min(target, first + len(self._slots) - 1)
+                          + 1):
+            slot = self._slots[tick % len(self._slots)]
+            if not slot:
+                continue
+            due = [key for key, deadline in slot.items()
+                   if deadline <= target]
+            for key in due:
+                del slot[key]
+                del self._timers[key]
+            expired.extend(due)
+        return expired
+
+
+async def active_records(storage: BaseStorage) \
+        -> List[Tuple[str, str, float]]:
+    """Chat, user and time of the last change of FSM records with
+    a state
+    """
+    if hasattr(storage, "active_records"):
+        return await storage.active_records()
+    if isinstance(storage, MemoryStorage):
+        # changes are not timed, timers start over
+        now = time.time()
+        return [(chat, user, now)
+                for chat, users in storage.data.items()
+                for user, record in users.items()
+                if record.get("state") is not None]
+    return []
+
+
+class SessionTimers:
+    """Calls `reminder` callback once a user in a quiz is idle for
+    `remind_after` seconds and `expiry` callback after `expire_after`
+    seconds, 0 disables either.
+
+    Reminders missed while the bot was down are not sent late.
+    """
+
+    def __init__(self, remind_after: float, expire_after: float,
+                 resolution: float = 1.0, concurrency: int = 10):
+        self.remind_after = remind_after
+        self.expire_after = expire_after
+        self.wheel = TimerWheel(resolution)
+        self._callbacks: Dict[str, SessionCallback] = {}
+        self._ticker: Optional[asyncio.Task] = None
+        self._firing: Set[asyncio.Task] = set()
+        self.concurrency = concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.remind_after or self.expire_after)
+
+    def reminder(self, callback: SessionCallback) -> SessionCallback:
+        """Decorator registering reminder callback"""
+        self._callbacks["remind"] = callback
+        return callback
+
+    def expiry(self, callback: SessionCallback) -> SessionCallback:
+        """Decorator registering expiry callback"""
+        self._callbacks["expire"] = callback
+        return callback
+
+    def touch(self, chat: int, user: int,
+              at: Optional[float] = None) -> None:
+        """User was active in a quiz at `at` (now by default)
+        """
+        at = time.time() if at is None else at
+        if self.remind_after:
+            self.wheel.schedule(("remind", chat, user),
+                                at + self.remind_after)
+        if self.expire_after:
+            self.wheel.schedule(("expire", chat, user),
+                                at + self.expire_after)
+
+    def cancel(self, chat: int, user: int) -> None:
+        """User is not in a quiz anymore
+        """
+        self.wheel.cancel(("remind", chat, user))
+        self.wheel.cancel(("expire", chat, user))
+
+    def expiry_pending(self, chat: int, user: int) -> bool:
+        """Whether expiry of the user is scheduled, e.g. set again by
+        an update after it fired
+        """
+        return ("expire", chat, user) in self.wheel
+
+    async def rebuild(self, storage: BaseStorage,
+                      shard: Optional[Tuple[int, int]] = None) -> int:
+        """Timers of sessions in storage, `shard` (index, count) keeps
+        users of one worker process only
+        """
+        now = time.time()
+        count = 0
+        for chat, user, updated_at in await active_records(storage):
+            chat, user = int(chat), int(user)
+            if shard is not None and user % shard[1] != shard[0]:
+                continue
+            if self.remind_after and now - updated_at < self.remind_after:
+                self.wheel.schedule(("remind", chat, user),
+                                    updated_at + self.remind_after)
+            if self.expire_after:
+                self.wheel.schedule(("expire", chat, user),
+                                    updated_at + self.expire_after)
+            count += 1
+        return count
+
+    async def _fire(self, kind: str, chat: int, user: int) -> None:
+        try:
+            async with self._semaphore:
+                await self._callbacks[kind](chat, user)
+            metrics.SESSION_EVENTS.inc(kind)
+        except Exception as err:
+            logger.error(f"Error in session {kind} of user {user}: {err}",
+                         exc_info=err)
+
+    async def _tick_loop(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.wheel.resolution)
+            for kind, chat, user in self.wheel.advance(time.time()):
+                if kind not in self._callbacks:
+                    continue
+                task = loop.create_task(self._fire(kind, chat, user))
+                self._firing.add(task)
+                task.add_done_callback(self._firing.discard)
+
+    async def start(self, dispatcher: Dispatcher,
+                    shard: Optional[Tuple[int, int]] = None) -> None:
+        """Rebuild timers from storage of the dispatcher and run them
+        """
+        if not self.enabled or self._ticker is not None:
+            return
+        start = time.perf_counter()
+        count = await self.rebuild(dispatcher.storage, shard)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        logger.info(f"Session timers of {count} users rebuilt in "
+                    f"{time.perf_counter() - start:.3f}s")
+        metrics.SESSION_TIMERS.set_function(lambda: {(): len(self.wheel)})
+        self._ticker = asyncio.get_event_loop().create_task(
+            self._tick_loop())
+
+    async def close(self) -> None:
+        if self._ticker is not None:
+            self._ticker.cancel()
+            self._ticker = None
+        if self._firing:
+            await asyncio.wait(set(self._firing))
+
+
+class SessionTimersMiddleware(BaseMiddleware):
+    """Moves timers of the user forward after each update in a quiz and
+    cancels them once the quiz is over
+    """
+
+    def __init__(self, sessions: SessionTimers):
+        super().__init__()
+        self.sessions = sessions
+
+    async def _track(self, chat: int, user: int) -> None:
+        state = await self.manager.dispatcher.storage.get_state(
+            chat=chat, user=user)
+        if state is None:
+            self.sessions.cancel(chat, user)
+        else:
+            self.sessions.touch(chat, user)
+
+    async def on_post_process_message(self, message: types.Message,
+                                      results: list, data: dict) -> None:
+        await self._track(message.chat.id, message.from_user.id)
+
+    async def on_post_process_callback_query(
+            self, callback: types.CallbackQuery, results: list,
+            data: dict) -> None:
+        if callback.message is not None:
+            await self._track(callback.message.chat.id,
+                              callback.from_user.id)
+
+
+def setup_sessions(dispatcher: Dispatcher, sessions: SessionTimers) -> None:
+    """Register middleware tracking activity in quizzes
+    """
+    if sessions.enabled:
+        dispatcher.middleware.setup(SessionTimersMiddleware(sessions))
@@ -0,0 +1,50 @@
+"""Timing of startup phases
+
+Imported first by the entry point, so the timer covers imports
+of aiogram and app modules as well.
+"""
+import os
+import time
+from typing import List, Optional, Tuple
+
+
+def process_age() -> Optional[float]:
+    """Seconds since the process was started, including interpreter
+    startup (linux only)
+    """
+    try:
+        with open("/proc/self/stat", "r") as file:
+            # fields after command name, which may contain spaces
+            fields = file.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime", "r") as file:
+            uptime = float(file.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+
+
+class StartupTimer:
+    """Durations of startup phases, each phase lasts from the end of
+    the previous one till `mark`
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+        self._last = self.started
+
+    def mark(self, name: str) -> None:
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def report(self) -> str:
+        total = time.perf_counter() - self.started
+        breakdown = ", ".join(f"{name} {seconds:.3f}s"
+                              for name, seconds in self.phases)
+        age = process_age()
+        process = f" (process {age:.2f}s)" if age is not None else ""
+        return f"Started in {total:.3f}s{process}: {breakdown}"
+
+
+timer = StartupTimer()
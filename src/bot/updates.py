@@ -0,0 +1,19 @@
+"""Fields of raw telegram updates
+"""
+
+# update fields that contain user event, with sender in "from"
+USER_EVENTS = ("message", "edited_message", "callback_query",
+               "inline_query", "chosen_inline_result", "shipping_query",
+               "pre_checkout_query", "poll_answer", "my_chat_member",
+               "chat_member", "chat_join_request")
+
+
+def update_user_id(update: dict) -> int:
+    """Id of user that caused the update, 0 if there is none
+    """
+    for kind in USER_EVENTS:
+        event = update.get(kind)
+        if event:
+            sender = event.get("from") or event.get("user") or {}
+            return sender.get("id", 0)
+    return 0
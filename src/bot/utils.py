@@ -1,85 +1,140 @@
 """Utility functions
 """
-import json
+import asyncio
 import logging
-from json import JSONDecodeError
-from pathlib import Path
-from typing import List, Optional
+from datetime import datetime
+from functools import lru_cache
+from html import escape
+from typing import Dict, List, Optional
+from weakref import WeakValueDictionary
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-from src.bot.states import questions, Question
+from src.bot.dependencies import banks
+from src.bot.quiz import QuizBank, encode_indexes, result_line
+from src.bot.results import ResultsUnavailable, ResultsStats, \
+    ResultsStore, AsyncResults, Attempt, Standing, open_results_store, \
+    open_async_results
+from src.bot.search import SearchHit
+from src.bot.states import Theory
 from src.config import Config
 
 logger = logging.getLogger(__name__)
 
+_user_locks: WeakValueDictionary = WeakValueDictionary()
 
-class ResultsUnavailable(Exception):
-    """Raise when can not get results
+
+def correct_questions(user_answers: dict) -> List[str]:
+    """Indexes of questions (q_1, q_2, ...) answered correctly
+    according to the question bank answers were given in
     """
+    return result_bank(user_answers).correct_questions(user_answers)
 
 
-def is_correct(answer: List[str], question: Question) -> bool:
-    """Determine whether the answer is correct for provided question
+def encode_answers(user_answers: dict) -> dict:
+    """Convert results stored with answer texts into answer indexes
     """
-    check_for_order = question.options.check_answer_order
-    if check_for_order:
-        # order is important
-        return answer == question.correct_answer
-
-    # order not important
-    return set(answer) == set(question.correct_answer)
+    return banks.current.encode_answers(user_answers)
 
 
 def count_score(user_answers: dict) -> int:
     """Count how many correct answers user gave.
     Returns integer of correct answers
     """
-    count = 0
-    for question_number, answer in user_answers.items():
-        question = questions.get(question_number)
-        if is_correct(answer, question):
-            count += 1
-    return count
+    return len(correct_questions(user_answers))
+
+
+def results_store(config: Config) -> ResultsStore:
+    """Results store configured for the app
+    """
+    return open_results_store(config, scorer=correct_questions,
+                              encoder=encode_answers)
 
 
 def read_results(config: Config) -> dict:
-    """Read from json file results
+    """Read all results from configured results store
     """
-    try:
-        with open(config.logs_path/Path("results.json"), "r", encoding="utf-8") as file:
-            results = json.load(file)
-    except (FileNotFoundError, JSONDecodeError) as err:
-        logger.error(f"Error reading results: {err}")
-        raise ResultsUnavailable
-    return results
+    return results_store(config).as_dict()
 
 
 def save_results(config: Config, results: dict) -> None:
-    """Save new version of results
+    """Save new version of all results (rewrites whole store)
     """
-    try:
-        with open(config.logs_path/Path("results.json"), 'w',
-                  encoding='utf-8') as file:
-            json.dump(results, file, ensure_ascii=False, indent=4)
-    except (FileNotFoundError, JSONDecodeError) as err:
-        logger.error(f"Error saving results: {err}")
-        logger.info(f"Results not saved: {results}")
+    results_store(config).replace(results)
 
 
-def create_answers_keyboard(question: Question,
-                            exclude_answers: Optional[List[str]] = None) \
-        -> InlineKeyboardMarkup:
-    """Create inline keyboard that consists of available answers
-    and next button"""
+def user_lock(user_id: str) -> asyncio.Lock:
+    """Lock that serializes handlers of the same user,
+    so quick repeated taps do not interleave between awaits
+    """
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _user_locks[user_id] = lock
+    return lock
+
+
+def async_results(config: Config) -> AsyncResults:
+    """Non-blocking access to results store, use it inside handlers
+    """
+    return open_async_results(config, scorer=correct_questions,
+                              encoder=encode_answers)
+
+
+def answers_mask(answer_indexes: List[int]) -> int:
+    """Bitmask of selected answers: bit i is set if answer i selected
+    """
+    mask = 0
+    for index in answer_indexes:
+        mask |= 1 << index
+    return mask
+
+
+def add_selection(selection: str, answer_index: int) -> Optional[str]:
+    """Code of selected answers with `answer_index` appended,
+    None if it is already selected
+    """
+    digit = encode_indexes([answer_index])
+    if digit in selection:
+        return None
+    return selection + digit
+
+
+def session_bank(user_data: dict) -> QuizBank:
+    """Question bank the session was started with, raises
+    QuizBankUnavailable if it can not be loaded
+    """
+    return banks.get(user_data.get("bank"))
+
+
+def result_bank(user_answers: dict) -> QuizBank:
+    """Question bank the stored result was given in, current one if
+    it can not be loaded
+    """
+    return banks.get(user_answers.get("bank"), fallback=True)
 
+
+def answers_from_indexes(bank: QuizBank, user_data: dict) -> dict:
+    """Convert session data {q_1: "20", ...} into answers to be stored
+    {"bank": version, question id: "20"} for every question of the session
+    """
+    return bank.session_answers(user_data)
+
+
+@lru_cache(maxsize=1024)
+def create_answers_keyboard(bank: QuizBank, question_index: str,
+                            selected_mask: int = 0,
+                            order: str = "") -> InlineKeyboardMarkup:
+    """Create inline keyboard that consists of available answers
+    (not selected in `selected_mask`) shown in `order` and next button.
+    Keyboards are memoized, returned object must not be modified
+    """
+    question = bank.questions[question_index]
     inline_keyboard = InlineKeyboardMarkup()
-    if not exclude_answers:  # костыльно
-        exclude_answers = []
 
-    for index, answer in enumerate(question.answers):
+    for index, answer in question.shown_answers(order):
         # skip answer
-        if answer in exclude_answers:
+        if selected_mask & (1 << index):
             continue
 
         inline_keyboard.add(
@@ -92,59 +147,114 @@ def create_answers_keyboard(question: Question,
     return inline_keyboard
 
 
-def format_question_text(question: Question, question_index: str) -> str:
-    """Format question text, check for additional options
-    :parameter question - Questions object
-    :parameter question_index - str in a form (q_1)
-    :returns str in html formatted way
-    """
-    q_number = number_from_index(question_index)
-
-    header = f"👉 <b>Вопрос №{q_number}</b>: "
-
-    if question.options.repeat_answers:
-        extra = "\n\n<i>Варианты ответа</i>:\n"
-        for answer in question.answers:
-            extra += f"{answer}\n"
-    else:
-        extra = "\n"
-
-    return header + question.text + extra
-
-
-def format_results_text(user_answers: dict, include_header: bool = True):
-    """Format in HTML style results
+def format_results_text(bank: QuizBank, user_answers: dict,
+                        include_header: bool = True):
+    """Format in HTML style results of answers {question id: answers},
+    questions are numbered in order they were asked
     """
-    correct_answers = count_score(user_answers)
+    # results of older versions hold answered questions only
+    user_answers = bank.encode_answers(user_answers)
+    quiz = bank.questions
+    marks = [_index in quiz and quiz[_index].is_correct(answer)
+             for _index, answer in user_answers.items() if _index != "bank"]
+    correct_answers = sum(marks)
 
     header = "👍 Вы ответили на все вопросы викторины!\n"
     result = f"Правильных ответов: <b>{correct_answers}</b> " \
-             f"из <b>{len(questions)}</b>\n"
-    details = "<i>Подробности</i>:\n"
-    for _index, question in questions.items():
-        q_number = number_from_index(_index)
-        user_answer = user_answers.get(_index, [])
-        emoji = "✅" if is_correct(user_answer, question) else "❌"
-        details += f"Вопрос {q_number} - {emoji}\n"
+             f"из <b>{len(marks)}</b>\n"
+    details = "<i>Подробности</i>:\n" + "".join(
+        result_line(position, mark)
+        for position, mark in enumerate(marks, start=1)
+    )
 
     if include_header:
         return header + result + details
     return result + details
 
 
-def format_all_users_stats(results: dict) -> str:
-    """Count stats for all users and format in html friendly way"""
-    totals = results["total"]
-    total_participants = len(totals)
-    if total_participants == 0:
+def format_all_users_stats(stats: ResultsStats, title: str,
+                           user_score: Optional[int] = None) -> str:
+    """Format precomputed stats of users of the quiz in html friendly
+    way, `user_score` is compared with scores in the same quiz only"""
+    if stats.participants == 0:
         return "\nОго! Еще никто не принимал участия в квизе, " \
                "у вас есть возможность стать первым!"
-    average_mark = sum(totals.values()) / total_participants
 
     header = "\n<i>Статистика:</i>\n"
-    stats = f"Всего участников квиза - {total_participants}\n" \
-            f"Среднее количество правильных ответов - {average_mark:.2f}"
-    return header + stats
+    text = f"Всего участников квиза «{escape(title)}» - " \
+           f"{stats.participants}\n" \
+           f"Среднее количество правильных ответов - {stats.average():.2f}"
+    if user_score is not None:
+        text += f"\nВаш результат лучше, чем у " \
+                f"{stats.percentile_rank(user_score):.0f}% участников"
+    return header + text
+
+
+def quiz_title(name: str) -> str:
+    quiz = banks.current.quizzes.get(name)
+    return quiz.title if quiz is not None else name
+
+
+def format_leaderboard(title: str, leaders: List[Attempt],
+                       standing: Optional[Standing] = None) -> str:
+    """Format top users of quiz and place of the user in html,
+    users with the same score share place
+    """
+    header = f"🏆 <b>Рейтинг: {escape(title)}</b>\n"
+    if not leaders:
+        return header + "Этот квиз еще никто не прошел, " \
+                        "у вас есть возможность стать первым!"
+
+    text = ""
+    place = 0
+    for position, attempt in enumerate(leaders, start=1):
+        if position == 1 or attempt.score != leaders[position - 2].score:
+            place = position
+        text += f"{place}. {escape(attempt.name or 'Участник')} - " \
+                f"{attempt.score} из {attempt.questions}\n"
+    if standing is not None:
+        text += f"\nВаш лучший результат - {standing.best.score} " \
+                f"из {standing.best.questions}, место {standing.rank} " \
+                f"из {standing.participants}"
+    return header + text
+
+
+def format_search_hits(hits: List[SearchHit],
+                       theory: Dict[str, Theory]) -> str:
+    """Format found theory passages in html"""
+    passages = []
+    for hit in hits:
+        material = theory.get(hit.topic)
+        title = material.button_text if material else "Справочник"
+        passages.append(f"📖 <b>{escape(title)}</b>\n{hit.snippet}")
+    return "\n\n".join(passages)
+
+
+def search_keyboard(hits: List[SearchHit],
+                    theory: Dict[str, Theory]) -> InlineKeyboardMarkup:
+    """Buttons opening theory materials of found passages
+    """
+    inline_keyboard = InlineKeyboardMarkup()
+    for topic in dict.fromkeys(hit.topic for hit in hits):
+        if topic in theory:
+            inline_keyboard.add(InlineKeyboardButton(
+                text=theory[topic].button_text,
+                callback_data=f"show_theory|{topic}"
+            ))
+    return inline_keyboard
+
+
+def format_attempts(attempts: List[Attempt]) -> str:
+    """Format latest attempts of user in html"""
+    if not attempts:
+        return ""
+    text = "\n\n<i>Последние попытки:</i>\n"
+    for attempt in attempts:
+        finished = datetime.fromtimestamp(attempt.finished_at)
+        text += f"{finished:%d.%m.%Y %H:%M} - " \
+                f"{escape(quiz_title(attempt.quiz))}: " \
+                f"{attempt.score} из {attempt.questions}\n"
+    return text
 
 
 def number_from_index(index: str) -> int:
@@ -0,0 +1,144 @@
+"""Webhook mode: receive updates over HTTP instead of long polling
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional, Set
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+from src.config import Config
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+DispatcherHook = Callable[[Dispatcher], Awaitable[None]]
+UpdateProcessor = Callable[[types.Update], Awaitable[None]]
+
+
+class WebhookServer:
+    """Accepts updates on `path` and dispatches them to `dispatcher`
+    (or passes them to `process` if it is provided).
+
+    At most `max_concurrency` updates are processed at once; when the
+    limit is reached the request waits, so Telegram slows down instead
+    of piling up tasks. On shutdown new updates are rejected and
+    in-flight handlers are given `drain_timeout` seconds to finish.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, path: str,
+                 secret_token: Optional[str] = None,
+                 max_concurrency: int = 100, drain_timeout: float = 30,
+                 process: Optional[UpdateProcessor] = None):
+        self.dispatcher = dispatcher
+        self.process = process or self._dispatch
+        self.path = path
+        self.secret_token = secret_token
+        self.drain_timeout = drain_timeout
+        self.max_concurrency = max_concurrency
+
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._in_flight: Set[asyncio.Task] = set()
+        self._closing = False
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.on_shutdown.append(self._drain)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret_token is not None \
+                and request.headers.get(SECRET_HEADER) != self.secret_token:
+            return web.Response(status=403)
+        if self._closing:
+            # Telegram will redeliver the update later
+            return web.Response(status=503)
+
+        update = types.Update(**await request.json())
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        await self._semaphore.acquire()
+        task = asyncio.get_event_loop().create_task(self._process(update))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+        return web.json_response({})
+
+    async def _dispatch(self, update: types.Update) -> None:
+        Bot.set_current(self.dispatcher.bot)
+        Dispatcher.set_current(self.dispatcher)
+        await self.dispatcher.process_update(update)
+
+    async def _process(self, update: types.Update) -> None:
+        try:
+            await self.process(update)
+        except Exception as err:
+            logger.exception(f"Error processing update "
+                             f"{update.update_id}: {err}")
+        finally:
+            self._semaphore.release()
+
+    async def _drain(self, app: web.Application) -> None:
+        self._closing = True
+        if self._in_flight:
+            logger.info(f"Waiting for {len(self._in_flight)} "
+                        f"in-flight updates")
+            _done, pending = await asyncio.wait(set(self._in_flight),
+                                                timeout=self.drain_timeout)
+            if pending:
+                logger.error(f"{len(pending)} updates were not processed "
+                             f"before shutdown")
+
+
+def make_webhook_app(dispatcher: Dispatcher, config: Config,
+                     on_startup: Optional[DispatcherHook] = None,
+                     on_shutdown: Optional[DispatcherHook] = None,
+                     process: Optional[UpdateProcessor] = None) \
+        -> web.Application:
+    """aiohttp app that serves webhook, registers it in Telegram
+    on startup and releases resources after draining on shutdown
+    """
+    server = WebhookServer(
+        dispatcher, path=config.webhook_path,
+        secret_token=config.webhook_secret,
+        max_concurrency=config.webhook_max_concurrency,
+        drain_timeout=config.webhook_drain_timeout,
+        process=process
+    )
+    app = server.make_app()
+
+    async def startup(_app: web.Application) -> None:
+        if on_startup is not None:
+            await on_startup(dispatcher)
+        if config.webhook_url:
+            await dispatcher.bot.set_webhook(
+                config.webhook_url.rstrip("/") + config.webhook_path,
+                secret_token=config.webhook_secret,
+                max_connections=config.webhook_max_concurrency,
+            )
+            logger.info(f"Webhook set to {config.webhook_url}")
+
+    async def cleanup(_app: web.Application) -> None:
+        if on_shutdown is not None:
+            await on_shutdown(dispatcher)
+        await dispatcher.storage.close()
+        await dispatcher.storage.wait_closed()
+        await (await dispatcher.bot.get_session()).close()
+
+    app.on_startup.append(startup)
+    # runs after WebhookServer drained in-flight updates
+    app.on_shutdown.append(cleanup)
+    return app
+
+
+def start_webhook(dispatcher: Dispatcher, config: Config,
+                  on_startup: Optional[DispatcherHook] = None,
+                  on_shutdown: Optional[DispatcherHook] = None,
+                  process: Optional[UpdateProcessor] = None) -> None:
+    """Run webhook server until interrupted
+    """
+    app = make_webhook_app(dispatcher, config, on_startup=on_startup,
+                           on_shutdown=on_shutdown, process=process)
+    web.run_app(app, host=config.webhook_host, port=config.webhook_port,
+                print=None)
@@ -0,0 +1,208 @@
+"""Multi-process mode: front process receives updates and shards them
+by user id to worker processes
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+from typing import List, Optional
+
+from aiogram import Bot, Dispatcher, types
+
+from src.bot.updates import update_user_id
+from src.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """Worker processes with a queue each. Updates of the same user
+    always go to the same worker, so their FSM session and per-user lock
+    stay within one process
+    """
+
+    def __init__(self, workers: int, max_concurrency: int = 100,
+                 max_restarts: int = 5):
+        self._context = multiprocessing.get_context("spawn")
+        self.max_concurrency = max_concurrency
+        self.max_restarts = max_restarts
+        self.restarts = [0] * workers
+        self.queues = [self._context.Queue() for _ in range(workers)]
+        # workers log through the front process, which writes the file
+        self.log_queue = self._context.Queue()
+        self._log_listener = None
+        self.processes = [self._process(index) for index in range(workers)]
+
+    def _process(self, index: int) -> multiprocessing.Process:
+        return self._context.Process(
+            target=worker_main, name=f"quiz-worker-{index}",
+            args=(index, self.queues[index], self.log_queue,
+                  self.max_concurrency))
+
+    def start(self) -> None:
+        from src.bot.logs import listen
+        self._log_listener = listen(self.log_queue)
+        for process in self.processes:
+            process.start()
+        logger.info(f"Started {len(self.processes)} workers")
+
+    def _restart(self, index: int) -> None:
+        """Replace dead worker, gives up after `max_restarts` restarts
+        of the same worker
+        """
+        process = self.processes[index]
+        if self.restarts[index] >= self.max_restarts:
+            raise RuntimeError(f"Worker {index} died with exit code "
+                               f"{process.exitcode} {self.restarts[index]} "
+                               f"times after restarts, giving up")
+        self.restarts[index] += 1
+        # updates still queued are lost: dead process may hold lock
+        # of the queue, so the new worker gets a queue of its own
+        logger.error(f"Worker {index} died with exit code "
+                     f"{process.exitcode}, restarting it, updates queued "
+                     f"for it are lost")
+        self.queues[index] = self._context.Queue()
+        self.processes[index] = self._process(index)
+        self.processes[index].start()
+
+    def dispatch(self, update: dict) -> None:
+        shard = update_user_id(update) % len(self.queues)
+        if not self.processes[shard].is_alive():
+            self._restart(shard)
+        self.queues[shard].put(update)
+
+    def stop(self) -> None:
+        """Ask workers to finish queued updates and wait for them
+        """
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join()
+        self._log_listener.stop()
+        logger.info("Workers stopped")
+
+
+def worker_main(index: int, queue: multiprocessing.Queue,
+                log_queue: multiprocessing.Queue,
+                max_concurrency: int) -> None:
+    """Worker process entry point
+    """
+    from src.bot.logs import forward_to
+    forward_to(log_queue)
+    # shutdown is driven by the front process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.get_event_loop().run_until_complete(
+        _worker_loop(index, queue, max_concurrency))
+
+
+async def _worker_loop(index: int, queue: multiprocessing.Queue,
+                       max_concurrency: int) -> None:
+    # Do not delete (used to register handlers via decorators)
+    from src.bot import handlers  # noqa: F401
+    from src.bot import metrics, utils
+    from src.bot.dependencies import banks, config, dp, edits, errors, \
+        search, sessions
+
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    in_flight = set()
+
+    async def process(update: types.Update) -> None:
+        try:
+            await dp.process_update(update)
+        except Exception as err:
+            logger.exception(f"Worker {index} failed to process update "
+                             f"{update.update_id}: {err}")
+        finally:
+            semaphore.release()
+
+    banks.start_watching(config.quiz_reload_interval)
+    search.start_watching(lambda: banks.current.theory,
+                          config.search_refresh_interval)
+    # storage may be shared, each worker keeps timers of its users
+    await sessions.start(dp, shard=(index, config.workers))
+    if config.metrics_port is not None:
+        await metrics.start_metrics_server(config.metrics_host,
+                                           config.metrics_port + index)
+    logger.info(f"Worker {index} ready")
+    while True:
+        raw_update = await loop.run_in_executor(None, queue.get)
+        if raw_update is None:
+            break
+        await semaphore.acquire()
+        task = loop.create_task(process(types.Update(**raw_update)))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    if in_flight:
+        await asyncio.wait(set(in_flight))
+    banks.stop_watching()
+    search.stop_watching()
+    await sessions.close()
+    await edits.close()
+    await utils.async_results(config).close()
+    await errors.close()
+    await metrics.stop_metrics_servers()
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    await (await dp.bot.get_session()).close()
+
+
+async def _poll(bot: Bot, pool: WorkerPool, error_sleep: float = 1,
+                max_error_sleep: float = 60) -> None:
+    offset: Optional[int] = None
+    sleep = error_sleep
+    while True:
+        try:
+            updates: List[types.Update] = await bot.get_updates(
+                offset=offset, timeout=20)
+        except Exception as err:
+            # network errors and telegram hiccups must not stop workers
+            logger.exception(f"Error getting updates, retrying in "
+                             f"{sleep:.0f}s: {err}")
+            await asyncio.sleep(sleep)
+            sleep = min(sleep * 2, max_error_sleep)
+            continue
+        sleep = error_sleep
+        for update in updates:
+            pool.dispatch(update.to_python())
+            offset = update.update_id + 1
+
+
+def start_workers(dispatcher: Dispatcher, config: Config) -> None:
+    """Run front process with `config.workers` worker processes.
+    Results must go to a store shared by processes
+    """
+    if config.results_backend != "sqlite":
+        raise ValueError("Multi-worker mode requires results_backend=sqlite")
+
+    pool = WorkerPool(config.workers,
+                      max_concurrency=config.worker_max_concurrency)
+    pool.start()
+
+    if config.run_mode == "webhook":
+        from src.bot.webhook import start_webhook
+
+        async def process(update: types.Update) -> None:
+            pool.dispatch(update.to_python())
+
+        try:
+            start_webhook(dispatcher, config, process=process)
+        finally:
+            pool.stop()
+        return
+
+    loop = asyncio.get_event_loop()
+    polling = loop.create_task(_poll(dispatcher.bot, pool))
+    loop.add_signal_handler(signal.SIGTERM, polling.cancel)
+    try:
+        loop.run_until_complete(polling)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        pool.stop()
+        session = loop.run_until_complete(dispatcher.bot.get_session())
+        loop.run_until_complete(session.close())
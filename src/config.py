@@ -4,6 +4,7 @@ import logging
 
 from pydantic import BaseSettings
 from pathlib import Path
+from typing import Dict, Optional
 
 logger = logging.getLogger(__name__)
 logger.info(f"{Path.cwd()}")
@@ -14,3 +15,83 @@ class Config(BaseSettings):
     assets_path: Path = Path('./assets/')  # adapted for docker
     logs_path: Path = Path('./logs')  # adapted for docker
     control_chat_id: int = -734044255
+    api_server: Optional[str] = None  # base url of self-hosted Bot API
+
+    # Results storage: "journal" (append-only), "sqlite" (can be shared
+    # by several worker processes) or "json" (legacy single file)
+    results_backend: str = "journal"
+    results_compact_every: int = 1000
+
+    # FSM storage: "sqlite" (survives restarts) or "memory"
+    fsm_storage: str = "sqlite"
+    fsm_db_path: Optional[Path] = None  # logs_path/fsm.sqlite3 by default
+    fsm_session_ttl: int = 24 * 60 * 60  # seconds
+    fsm_flush_interval: float = 0.2  # seconds
+    # User idle in a quiz is reminded once after session_remind_after,
+    # the session is ended and its data freed after session_expire_after
+    # seconds, 0 disables either
+    session_remind_after: float = 60 * 60
+    session_expire_after: float = 12 * 60 * 60
+
+    # Telegram file ids of uploaded assets, logs_path/file_ids.json by default
+    media_cache_path: Optional[Path] = None
+
+    # How to receive updates: "polling" or "webhook"
+    run_mode: str = "polling"
+    webhook_url: Optional[str] = None  # public base url, set on startup
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8080
+    webhook_path: str = "/webhook"
+    webhook_secret: Optional[str] = None
+    webhook_max_concurrency: int = 100
+    webhook_drain_timeout: float = 30  # seconds
+
+    # More than one worker runs handlers in separate processes,
+    # requires results_backend=sqlite
+    workers: int = 1
+    worker_max_concurrency: int = 100
+
+    # Outbound rate limits (Telegram flood limits), messages per second
+    send_rate_limit: bool = True
+    send_global_rate: float = 30
+    send_chat_rate: float = 1
+    send_chat_burst: float = 5
+    send_group_rate: float = 20 / 60
+    send_max_retries: int = 3  # after 429 Too Many Requests
+    # Rapid edits of a message are coalesced, only the latest rendering
+    # is sent after the delay
+    edit_delay: float = 0.3  # seconds
+
+    # Logs go to logs_path/logs.txt through a queue written by a
+    # background thread: "json" lines with user id and handler or "text"
+    log_format: str = "json"
+    log_level: str = "INFO"
+    # "size" (log_max_bytes), "time" (log_rotate_when, as in
+    # TimedRotatingFileHandler) or "none"; rotated files are gzipped
+    log_rotation: str = "size"
+    log_max_bytes: int = 10 * 2 ** 20
+    log_rotate_when: str = "midnight"
+    log_backup_count: int = 10
+    # share of INFO records kept by logger name, e.g. {"aiohttp.access": 0.1}
+    log_sampling: Dict[str, float] = {}
+    log_queue_size: int = 10000  # INFO records are dropped when full
+
+    # Errors are sent to control chat as digests collected over the window
+    error_report_window: float = 60  # seconds
+    error_reports_per_minute: int = 2
+
+    # Prometheus metrics on http://metrics_host:metrics_port/metrics,
+    # in multi-worker mode worker N serves them on metrics_port + N
+    metrics_port: Optional[int] = None
+    metrics_host: str = "127.0.0.1"
+
+    # Question bank (json, or yaml if PyYAML is installed),
+    # assets_path/quiz.json by default; checked for changes periodically
+    quiz_bank_path: Optional[Path] = None
+    quiz_reload_interval: float = 5  # seconds
+
+    # Index of theory PDFs for /search and inline queries (requires
+    # pypdf), logs_path/search_index.json by default; PDFs are checked
+    # for changes periodically
+    search_index_path: Optional[Path] = None
+    search_refresh_interval: float = 60  # seconds